@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+"""End-to-end throughput of the injector against a local elasticsearch
+stand-in (see ``test/elasticsearch_server.py``), whose latency and failures
+can be configured to reproduce a slow or overloaded cluster.
+
+Usage (after sourcing source.sh)::
+
+  python benchmarks/bench_cluster.py --clients 20 --lines 10000 --latency 0.05 --reject-ratio 0.1
+"""
+
+import argparse, json, socket, threading, time, logging
+from elasticsearch import Elasticsearch
+from es_injectors import elasticsearch_injector as es
+from test.elasticsearch_server import ElasticsearchServer
+
+def send_lines(port, client_id, nb_lines):
+  client_socket = socket.create_connection(('127.0.0.1', port))
+  data = ''.join('put metric' + str(client_id) + ' ' + str(i) + ' ' + str(1454962560000 + i) +
+                 ' host=machine' + str(client_id) + '\n' for i in range(0, nb_lines))
+  client_socket.sendall(data.encode('utf-8'))
+  client_socket.close()
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--clients", default=20, type=int, help='Number of concurrent clients (default: 20)')
+  parser.add_argument("--lines", default=10000, type=int, help='Number of lines per client (default: 10000)')
+  parser.add_argument("--latency", default=0, type=float, help='Latency of each bulk request in seconds (default: 0)')
+  parser.add_argument("--reject-ratio", default=0, type=float, help='Ratio of bulk requests rejected with a 429')
+  parser.add_argument("--item-failure-ratio", default=0, type=float, help='Ratio of bulk items failing')
+  parser.add_argument("--bulk-threads", default=1, type=int, help='Number of bulk requests sent concurrently (default: 1)')
+  parser.add_argument("--timeout", default=60, type=float, help='Seconds to wait for all the documents (default: 60)')
+  args = parser.parse_args()
+
+  logging.basicConfig(format='%(asctime)s %(message)s', level=logging.ERROR)
+
+  cluster = ElasticsearchServer(latency=args.latency, reject_ratio=args.reject_ratio,
+                                item_failure_ratio=args.item_failure_ratio)
+  cluster.start()
+  client = Elasticsearch([cluster.url])
+  sender = es.ElasticsearchSender(es.OpenTsdbParser(), client, 'bench', max_delay=1,
+                                  thread_count=args.bulk_threads)
+  server = es.AggregatorServer('127.0.0.1', 0, sender)
+  server.start()
+  while server.bound_port is None:
+    time.sleep(0.01)
+
+  expected = args.clients * args.lines
+  start = time.time()
+  clients = [threading.Thread(target=send_lines, args=(server.bound_port, i, args.lines))
+             for i in range(0, args.clients)]
+  for thread in clients:
+    thread.start()
+  for thread in clients:
+    thread.join()
+  sent = time.time() - start
+
+  # Rejected documents are retried, but may be given up: we wait until
+  # nothing more is indexed nor waiting to be retried
+  last_count = -1
+  while cluster.count('bench') + cluster.nb_failed_items < expected and time.time() - start < args.timeout:
+    sender.flush()
+    if cluster.count('bench') == last_count and not sender.nb_buffered:
+      break
+    last_count = cluster.count('bench')
+    time.sleep(0.2)
+  total = time.time() - start
+
+  print(json.dumps({
+    'lines': expected,
+    'sent_lines_per_second': expected / sent,
+    'indexed': cluster.count('bench'),
+    'indexed_per_second': cluster.count('bench') / total,
+    'bulk_requests': cluster.nb_bulk_requests,
+    'rejected_requests': cluster.nb_rejected,
+    'failed_items': cluster.nb_failed_items,
+    'retried_docs': sender.stats.retries}, indent=2, sort_keys=True))
+  cluster.stop()
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+"""Pre-aggregation of the points received, before they are indexed.
+
+Points are grouped by series (metric name and tags) into fixed time windows,
+and one document per series and window is emitted when the window closes.
+Its metric field holds the average of the window, and ``<metric>_min``,
+``<metric>_max``, ``<metric>_sum``, ``<metric>_count`` and ``<metric>_last``
+the other statistics, as the rollup documents of `rollup`.
+"""
+
+import threading, time
+
+class WindowAggregator:
+  """Aggregates points in windows of `window` seconds.
+
+  A window is closed once the most recent timestamp received is `grace`
+  seconds past its end, or when `expire()` is called `grace` seconds past
+  its end. Points arriving for a closed window are late: they are emitted
+  right away, as a window of their own (with a count of 1).
+
+  The most recent timestamp received only counts up to the current time, so
+  that points from the future (e.g. an agent with a wrong clock) do not
+  close the windows early. Points more than `max_future` seconds ahead are
+  emitted right away too, as the late ones.
+
+  :param window: The length of the windows, in seconds
+  :param grace: The time given to late points, in seconds
+  :param max_future: How far ahead of the current time points are still
+                     aggregated, in seconds
+  :param clock: The function returning the current time, in seconds
+  """
+
+  def __init__(self, window=10, grace=5, max_future=300, clock=time.time):
+    self.window = window
+    self.window_ms = int(window * 1000)
+    self.grace_ms = int(grace * 1000)
+    self.max_future_ms = int(max_future * 1000)
+    self.clock = clock
+    # window start -> {(metric name, tags): [tags, count, sum, min, max, last, last timestamp]}
+    self.windows = {}
+    # Every window starting before is closed
+    self.closed_until = 0
+    self.watermark = 0
+    self.nb_late = 0
+    self.nb_future = 0
+    self.lock = threading.Lock()
+
+  @property
+  def nb_series(self):
+    with self.lock:
+      return sum(len(series) for series in self.windows.values())
+
+  def add(self, parsed):
+    """Adds points to their window.
+
+    :param parsed: A list of (metric_name, doc), as returned by
+                   `OpenTsdbParser.parse_many()`. The documents are modified
+    :returns: The list of (metric_name, doc) to index: late and future
+              points, and the aggregates of the windows closed meanwhile
+    """
+    late = []
+    window_ms = self.window_ms
+    now = int(self.clock() * 1000)
+    future = now + self.max_future_ms
+    with self.lock:
+      windows = self.windows
+      for metric_name, doc in parsed:
+        value = doc.pop(metric_name)
+        timestamp = doc.pop('timestamp')
+        start = timestamp - timestamp % window_ms
+        if start < self.closed_until or timestamp > future:
+          if timestamp > future:
+            self.nb_future += 1
+          else:
+            self.nb_late += 1
+          late.append(self.aggregate(metric_name, start, [doc, 1, value, value, value, value, timestamp]))
+          continue
+
+        if timestamp > self.watermark:
+          self.watermark = min(timestamp, now)
+        key = (metric_name, frozenset(doc.items()))
+        series = windows.get(start)
+        if series is None:
+          series = windows[start] = {}
+        point = series.get(key)
+        if point is None:
+          series[key] = [doc, 1, value, value, value, value, timestamp]
+        else:
+          point[1] += 1
+          point[2] += value
+          if value < point[3]:
+            point[3] = value
+          if value > point[4]:
+            point[4] = value
+          if timestamp >= point[6]:
+            point[5] = value
+            point[6] = timestamp
+
+      return late + self.close(self.watermark)
+
+  def expire(self, now=None, force=False):
+    """Returns the aggregates of the windows closed at `now` (in seconds,
+    the current time by default), or of all the windows if `force`."""
+    if now is None:
+      now = self.clock()
+    with self.lock:
+      return self.close(None if force else max(self.watermark, int(now * 1000)))
+
+  def close(self, timestamp):
+    """Closes the windows ending `grace` before `timestamp` (in ms), or all
+    the windows if `timestamp` is None. The lock must be held."""
+    docs = []
+    for start in sorted(self.windows):
+      end = start + self.window_ms
+      if timestamp is not None and end + self.grace_ms > timestamp:
+        break
+      for (metric_name, tags), point in self.windows.pop(start).items():
+        docs.append(self.aggregate(metric_name, start, point))
+      if end > self.closed_until:
+        self.closed_until = end
+    return docs
+
+  @staticmethod
+  def aggregate(metric_name, start, point):
+    doc, count, total, minimum, maximum, last, last_timestamp = point
+    doc['timestamp'] = start
+    doc[metric_name] = total / count
+    doc[metric_name + '_min'] = minimum
+    doc[metric_name + '_max'] = maximum
+    doc[metric_name + '_sum'] = total
+    doc[metric_name + '_count'] = count
+    doc[metric_name + '_last'] = last
+    return (metric_name, doc)
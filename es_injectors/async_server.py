@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+"""An asyncio version of `AggregatorServer`, serving every client connection
+from a single thread. It requires Python >= 3.5.
+"""
+
+import asyncio, threading, logging, socket, sys
+
+DEFAULT_BACKLOG = 1024
+DEFAULT_MAX_CONNECTIONS = 10000
+# Longest line accepted from a client (bytes)
+LINE_LIMIT = 64 * 1024
+# Bytes read at once from a client
+READ_SIZE = 64 * 1024
+
+# asyncio.Task.current_task() before Python 3.7
+current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+class StreamSocket:
+  """Exposes the ``sendall`` method used by injectors (to answer to
+     ``version``) on top of an asyncio stream writer."""
+
+  def __init__(self, writer):
+    self.writer = writer
+
+  def sendall(self, data):
+    self.writer.write(data)
+
+class AsyncAggregatorServer(threading.Thread):
+  """Drop-in replacement for `AggregatorServer`: the same injector receives
+     the same ``push(lines)`` calls, but connections are handled as asyncio
+     tasks of a single event loop instead of one thread each.
+  """
+
+  def __init__(self, bind_host, bind_port, injector, backlog=DEFAULT_BACKLOG,
+               max_connections=DEFAULT_MAX_CONNECTIONS, stats=None, reuse_port=False):
+    """
+    :param bind_host: The host on which to listen
+    :param bind_port: The port on which to listen
+    :param injector: an object having ``push(string list)`` and ``flush()``
+                     defined
+    :param backlog: The backlog of the listening socket
+    :param max_connections: Connections received above this number are
+                            closed right away
+    :param stats: The `stats.Stats` counting the lines received. Defaults to
+                  the ``stats`` of the injector, if any
+    :param reuse_port: Set ``SO_REUSEPORT``, so that several processes can
+                       listen to the same port (see `workers`)
+    """
+    threading.Thread.__init__(self, name='AsyncAggregatorServer: '+bind_host + ':' + str(bind_port))
+    self.setDaemon(True)
+    self.host = bind_host
+    self.port = bind_port
+    self.injector = injector
+    self.backlog = backlog
+    self.max_connections = max_connections
+    self.nb_connections = 0
+    self.stats = stats if stats is not None else getattr(injector, 'stats', None)
+    self.reuse_port = reuse_port
+    self.loop = None
+    self.server = None
+    # Set on the loop once the injector accepts documents again
+    self.resumed = None
+    self.waiting_resume = False
+    # The tasks serving the connections, cancelled by `stop()`
+    self.tasks = set()
+    self.logger = logging.getLogger('AsyncAggregatorServer')
+
+  def run(self):
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+    self.resumed = asyncio.Event()
+    try:
+      try:
+        self.server = self.loop.run_until_complete(
+          asyncio.start_server(self.handle_client, self.host, self.port,
+                               backlog=self.backlog, limit=LINE_LIMIT,
+                               reuse_address=True, reuse_port=self.reuse_port or None))
+        self.logger.info('Socket bind completed: ' + socket.gethostname() + ':' + str(self.port))
+      except OSError as msg:
+        self.logger.critical('Bind failed: ' + str(msg))
+        self.logger.critical('Exiting...')
+        sys.exit(1)
+
+      self.logger.info('Socket now listening to ' + str(self.port))
+      self.loop.run_until_complete(self.server.wait_closed())
+      if self.tasks:
+        self.loop.run_until_complete(asyncio.gather(*self.tasks, return_exceptions=True))
+    finally:
+      self.loop.close()
+      self.injector.flush()
+      self.logger.info('Close socket, flush buffer and quit')
+
+  def stop(self):
+    """Stops listening and closes the connections of the clients still
+    connected, so that `run()` flushes the injector and returns. Can be
+    called from any thread."""
+    if self.loop is not None and self.server is not None:
+      try:
+        self.loop.call_soon_threadsafe(self.close)
+      except RuntimeError:
+        # Already stopped: the loop is closed
+        pass
+
+  def close(self):
+    self.server.close()
+    for task in self.tasks:
+      task.cancel()
+
+  async def wait_accepting(self, accepting):
+    """Returns once `accepting` (a ``threading.Event``) is set, without
+    blocking the loop. A single thread waits for it, however many
+    connections are paused, and wakes them up through `resumed`."""
+    if not self.waiting_resume:
+      self.waiting_resume = True
+      self.resumed.clear()
+      thread = threading.Thread(target=self.wait_resume, args=(accepting,), name='AsyncAggregatorServer: resume')
+      thread.daemon = True
+      thread.start()
+    await self.resumed.wait()
+
+  def wait_resume(self, accepting):
+    accepting.wait()
+    try:
+      self.loop.call_soon_threadsafe(self.resume)
+    except RuntimeError:
+      # The loop is closed
+      pass
+
+  def resume(self):
+    self.waiting_resume = False
+    self.resumed.set()
+
+  async def handle_client(self, reader, writer):
+    ip, port = writer.get_extra_info('peername')[:2]
+    connection = str(ip) + ':' + str(port)
+    prefix = '[' + connection + ']'
+
+    if self.nb_connections >= self.max_connections:
+      self.logger.warning(prefix + ' Too many connections (' + str(self.nb_connections) + '), closing')
+      writer.close()
+      return
+
+    self.nb_connections += 1
+    task = current_task()
+    self.tasks.add(task)
+    self.logger.info('[+] New connection from ' + str(ip) + ':' + str(port))
+    stream_socket = StreamSocket(writer)
+    # Once its buffer is full, the reader stops reading the socket while the
+    # injector is not accepting documents
+    accepting = getattr(self.injector, 'accepting', None)
+    try:
+      # The end of the last line read, not complete yet
+      remainder = b''
+      while True:
+        while accepting is not None and not accepting.is_set():
+          await self.wait_accepting(accepting)
+        data = await reader.read(READ_SIZE)
+        if not data:
+          if remainder:
+            self.injector.push([remainder.decode('utf-8', 'replace')], socket=stream_socket, logging_prefix=prefix)
+          self.logger.info('[-] Connection closed by ' + str(ip) + ':' + str(port))
+          return
+        end = data.rfind(b'\n')
+        if end == -1:
+          remainder += data
+          if len(remainder) > LINE_LIMIT:
+            self.logger.warning(prefix + ' Line longer than ' + str(LINE_LIMIT) + ' bytes, closing')
+            return
+          continue
+        # All the complete lines read are pushed at once
+        lines = (remainder + data[:end]).decode('utf-8', 'replace').split('\n')
+        remainder = data[end + 1:]
+        if self.stats is not None:
+          self.stats.add_lines(connection, len(lines))
+        self.injector.push(lines, socket=stream_socket, logging_prefix=prefix)
+        if writer.transport.get_write_buffer_size():
+          await writer.drain()
+    except ConnectionError as msg:
+      self.logger.info('[-] Connection lost with ' + str(ip) + ':' + str(port) + ': ' + str(msg))
+    except asyncio.CancelledError:
+      # By `stop()`: the task ends normally, once the connection is closed
+      self.logger.info('[-] Connection closed with ' + str(ip) + ':' + str(port) + ' on stop')
+    finally:
+      self.nb_connections -= 1
+      self.tasks.discard(task)
+      if self.stats is not None:
+        self.stats.connection_closed(connection)
+      writer.close()
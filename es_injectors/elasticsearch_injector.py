@@ -1,10 +1,14 @@
 #!/usr/bin/python
 
-import socket, threading, argparse, logging, os, sys, time
+import socket, threading, argparse, logging, os, sys, time, collections, json, signal, hashlib, struct, errno, select
+from array import array
 import logging
 from logging.handlers import RotatingFileHandler
-from elasticsearch import Elasticsearch
-from elasticsearch import helpers
+from multiprocessing.pool import ThreadPool
+from elasticsearch import Elasticsearch, TransportError
+from es_injectors.stats import Stats, StatsServer
+from es_injectors.retry import RetryQueue, DeadLetterFile, is_retryable, error_type
+from es_injectors.compression import Codec, CODECS, DEFAULT_LEVEL, encoding_of, decompress
 
 VERSION = "0.0.1"
 
@@ -14,6 +18,109 @@ LOG_PATH = os.path.expanduser('~/es_injector/injector.log')
 
 INDEX_NAME = 'test-metrics'
 
+# The array typecode of the timestamps (in ms): Python 2 has no 'q', and its
+# 'l' only has 64 bits on some platforms. Doubles hold them exactly otherwise
+try:
+  TIMESTAMP_TYPECODE = array('q').typecode
+except ValueError:
+  TIMESTAMP_TYPECODE = 'l' if array('l').itemsize >= 8 else 'd'
+
+# Number of bytes read at once from a client socket
+RECV_SIZE = 64 * 1024
+# Size above which an incomplete line received from a client is dropped
+MAX_LINE_SIZE = 64 * 1024
+
+# Receive buffer of the UDP socket (bytes)
+UDP_RCVBUF = 4 * 1024 * 1024
+# Largest UDP datagram
+MAX_DATAGRAM_SIZE = 65535
+# Number of datagrams read before pushing them
+UDP_MAX_BATCH = 1024
+# Socket option reporting the datagrams dropped by the kernel (Linux only)
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40 if sys.platform.startswith('linux') else None)
+
+# Initial estimate of the size of a document, until a batch is shipped (bytes)
+DOC_BYTES = 200
+# Maximum size of a bulk request, and of the buffer (bytes)
+CHUNK_BYTES = 5 * 1024 * 1024
+BUFFER_BYTES = 32 * 1024 * 1024
+
+# Size above which the parser caches are reset
+MAX_CACHED_SERIES = 100000
+# Size above which the cache of time-based index names is reset
+MAX_CACHED_INDICES = 10000
+
+BulkResult = collections.namedtuple('BulkResult', ['nb_success', 'errors', 'delivered', 'retry'])
+
+def split_docs(body):
+  """Returns the documents of a bulk request body, each one being its
+  action and source lines"""
+  lines = body.split(b'\n')
+  return [lines[i] + b'\n' + lines[i + 1] + b'\n' for i in range(0, len(lines) - 1, 2)]
+
+def chunk_bounds(docs, chunk_size, chunk_bytes=None):
+  """Returns the (start, end) positions of the consecutive chunks of `docs`
+  holding up to `chunk_size` documents and, unless None, `chunk_bytes`
+  bytes. A document larger than `chunk_bytes` is alone in its chunk."""
+  if chunk_bytes is None or not docs or max(map(len, docs)) * chunk_size <= chunk_bytes:
+    return [(i, min(i + chunk_size, len(docs))) for i in range(0, len(docs), chunk_size)]
+  bounds = []
+  start = size = 0
+  for i, length in enumerate(map(len, docs)):
+    if i > start and (i - start >= chunk_size or size + length > chunk_bytes):
+      bounds.append((start, i))
+      start = i
+      size = 0
+    size += length
+  if start < len(docs):
+    bounds.append((start, len(docs)))
+  return bounds
+
+def index_template(index, es_version, refresh_interval=None):
+  """Returns the index template for the metrics indices matching `index`
+  (the part before any ``strftime`` directive, followed by '*'): timestamps
+  are `epoch_millis` dates, numbers are doubles and strings (tags) are not
+  analyzed.
+
+  :param es_version: The version of elasticsearch, as a string
+  :param refresh_interval: The ``refresh_interval`` setting of the indices
+                           (e.g. '60s'). The default of elasticsearch is
+                           kept if None
+  """
+  major = int(es_version.split('.')[0])
+  pattern = index.split('%')[0].rstrip('*') + '*'
+  if major >= 5:
+    string_mapping = {'type': 'keyword'}
+  else:
+    string_mapping = {'type': 'string', 'index': 'not_analyzed', 'doc_values': True}
+
+  mapping = {
+    'dynamic_templates': [
+      {'strings': {'match_mapping_type': 'string', 'mapping': string_mapping}},
+      {'doubles': {'match_mapping_type': 'double', 'mapping': {'type': 'double'}}},
+      {'longs': {'match_mapping_type': 'long', 'mapping': {'type': 'double'}}}
+    ],
+    'properties': {
+      'timestamp': {'type': 'date', 'format': 'epoch_millis'}
+    }
+  }
+  if major < 6:
+    mapping['_all'] = {'enabled': False}
+
+  template = {'mappings': {'_default_': mapping}}
+  if refresh_interval is not None:
+    template['settings'] = {'index': {'refresh_interval': refresh_interval}}
+  if major >= 6:
+    template['index_patterns'] = [pattern]
+  else:
+    template['template'] = pattern
+  return template
+
+def put_index_template(es, index, name='metrics', refresh_interval=None):
+  """Installs `index_template()` for `index` on the cluster"""
+  es.indices.put_template(name=name, body=index_template(index, es.info()['version']['number'],
+                                                         refresh_interval))
+
 class OpenTsdbParser:
   """A parser building metrics from opentsdb syntax
 
@@ -22,6 +129,11 @@ class OpenTsdbParser:
 
   def __init__(self, time_unit='ms'):
     self.time_unit = time_unit
+    # Caches used by `parse_points()` and `parse_json()`: the metric names
+    # with '.' replaced by '-', and the (metric_name, tags_key, tags) of the
+    # series already parsed, by (metric name, tags string)
+    self.metric_names = {}
+    self.series = {}
     self.logger = logging.getLogger('OpenTsdbParser')
 
   def parse(self, metric, logging_prefix=''):
@@ -56,9 +168,303 @@ class OpenTsdbParser:
 
     return (metric_name, doc)
 
+  def parse_many(self, metrics, errors=None):
+    """Parses a whole batch of metrics at once. Contrary to `parse()`, values
+    are returned as floats and timestamps as integers (in ms), and invalid
+    lines are counted instead of being logged.
+
+    :param metrics: An iterable of strings
+    :param errors: An optional dict, in which the number of invalid metrics
+                   is incremented for each reason: ``invalid_put_line``,
+                   ``incorrect_metric``, ``invalid_value``,
+                   ``invalid_timestamp`` or ``invalid_tag``
+    :returns: The list of (metric_name, doc) for the valid metrics
+    """
+    # The loop of `parse_points()`, building the documents right away
+    docs = []
+    append = docs.append
+    series = self.series
+    to_float = float
+    to_int = int
+    multiplier = 1000 if self.time_unit == 's' else 1
+    for metric in metrics:
+      elements = metric.split(' ', 4)
+      try:
+        if len(elements) == 5:
+          put, name, value, timestamp, tags_key = elements
+        else:
+          put, name, value, timestamp = elements
+          tags_key = None
+        value = to_float(value)
+        timestamp = to_int(timestamp) * multiplier
+        # False for NaN and infinity
+        if put != 'put' or value - value != 0:
+          raise ValueError
+        metric_name, tags_key, tags = series[name, tags_key]
+      except (ValueError, KeyError):
+        point = self.parse_series(elements, errors)
+        if point is None:
+          continue
+        metric_name, tags_key, tags = point
+      doc = tags.copy()
+      doc[metric_name] = value
+      doc['timestamp'] = timestamp
+      append((metric_name, doc))
+    return docs
+
+  def parse_points(self, metrics, errors=None):
+    """Same as `parse_many()`, but without building documents.
+
+    The lines of the series already seen take a fast path: one split, and
+    one lookup of the cached sanitized metric name and parsed tags, since
+    agents send the same series over and over. The other lines go through
+    `parse_series()`.
+
+    :returns: The list of (metric_name, tags_key, tags, value, timestamp) for
+              the valid metrics. `tags_key` is the string of the tags as
+              received, and `tags` their dict, which is shared and must not
+              be modified. Both are the same objects for all the points of a
+              series
+    """
+    points = []
+    append = points.append
+    series = self.series
+    to_float = float
+    to_int = int
+    multiplier = 1000 if self.time_unit == 's' else 1
+    for metric in metrics:
+      elements = metric.split(' ', 4)
+      try:
+        if len(elements) == 5:
+          put, name, value, timestamp, tags_key = elements
+        else:
+          # None tells the lines without tags from the ones ending with a space
+          put, name, value, timestamp = elements
+          tags_key = None
+        value = to_float(value)
+        timestamp = to_int(timestamp) * multiplier
+        # False for NaN and infinity
+        if put != 'put' or value - value != 0:
+          raise ValueError
+        point = series[name, tags_key]
+      except (ValueError, KeyError):
+        point = self.parse_series(elements, errors)
+        if point is None:
+          continue
+      append(point + (value, timestamp))
+    return points
+
+  def parse_series(self, elements, errors=None):
+    """Validates the line split in `elements` which missed the fast path of
+    `parse_points()`, and caches its series.
+
+    :returns: The (metric_name, tags_key, tags) of the series, or None if the
+              line is invalid, after incrementing its reason in `errors`
+    """
+    if elements[0] != 'put':
+      reason = 'invalid_put_line'
+    elif len(elements) < 4:
+      reason = 'incorrect_metric'
+    else:
+      # The reason is set before each step, so that an invalid line
+      # raises a single exception
+      try:
+        reason = 'invalid_value'
+        value = float(elements[2])
+        if value - value == 0:
+          reason = 'invalid_timestamp'
+          int(elements[3])
+          reason = 'invalid_tag'
+          if len(elements) == 5:
+            tags_key = key = elements[4]
+            tags = dict([tag.split('=') for tag in tags_key.split(' ')])
+          else:
+            tags_key, key, tags = '', None, {}
+          series = self.series
+          if len(series) >= MAX_CACHED_SERIES:
+            series.clear()
+          series[elements[1], key] = point = (elements[1].replace('.', '-'), tags_key, tags)
+          return point
+      except ValueError:
+        pass
+    if errors is not None:
+      errors[reason] = errors.get(reason, 0) + 1
+    return None
+
+  def parse_json(self, points, errors=None):
+    """Parses data points of the OpenTSDB HTTP API: dicts with a ``metric``,
+    a ``timestamp`` (in seconds, or in milliseconds above 10 digits, as
+    OpenTSDB does), a numeric ``value`` and a dict of ``tags``.
+
+    :param points: A list of dicts, as decoded from json
+    :param errors: An optional dict, in which the number of invalid points
+                   is incremented for each reason
+    :returns: The list of (metric_name, tags_key, tags, value, timestamp) for
+              the valid points, as `parse_points()`, and the list of the
+              (point, reason) of the invalid ones
+    """
+    parsed = []
+    invalid = []
+    names = self.metric_names
+    for point in points:
+      try:
+        metric = point['metric']
+        tags = point.get('tags') or {}
+        if not metric or not hasattr(metric, 'replace') or not isinstance(tags, dict):
+          raise TypeError
+      except (TypeError, KeyError, AttributeError):
+        invalid.append((point, 'incorrect_metric'))
+        continue
+      try:
+        value = float(point['value'])
+        if value - value != 0:
+          raise ValueError
+      except (TypeError, KeyError, ValueError):
+        invalid.append((point, 'invalid_value'))
+        continue
+      try:
+        timestamp = int(point['timestamp'])
+        if timestamp < 10000000000:
+          timestamp *= 1000
+      except (TypeError, KeyError, ValueError):
+        invalid.append((point, 'invalid_timestamp'))
+        continue
+
+      metric_name = names.get(metric)
+      if metric_name is None:
+        if len(names) >= MAX_CACHED_SERIES:
+          names.clear()
+        metric_name = names[metric] = metric.replace('.', '-')
+      # Tag values are strings, as in the line protocol
+      tags = dict((name, tag_value if hasattr(tag_value, 'encode') else str(tag_value))
+                  for name, tag_value in tags.items())
+      parsed.append((metric_name, tuple(sorted(tags.items())), tags, value, timestamp))
+
+    if errors is not None:
+      for point, reason in invalid:
+        errors[reason] = errors.get(reason, 0) + 1
+    return parsed, invalid
+
+class FlusherThread(threading.Thread):
+  """This thread ships the batches handed over by an `ElasticsearchSender`,
+     so that no bulk request is ever done while holding the sender lock.
+     It also triggers the time-based flush every `max_delay` seconds, even
+     when no data is received.
+  """
+  def __init__(self, sender):
+    """
+    :param sender: The `ElasticsearchSender` whose batches are shipped
+    """
+    threading.Thread.__init__(self, name='Flusher: ' + str(sender.index))
+    self.setDaemon(True)
+    self.sender = sender
+    self.stopped = threading.Event()
+
+  def run(self):
+    sender = self.sender
+    while not self.stopped.is_set():
+      timeout = max(0, sender.last_flush + sender.max_delay - time.time())
+      if sender.backlogged:
+        # The spool is replayed every second
+        timeout = min(timeout, 1)
+      if sender.aggregator is not None:
+        timeout = min(timeout, sender.aggregator.window)
+      next_retry = sender.retry_queue.next_due()
+      if next_retry is not None:
+        timeout = max(0, min(timeout, next_retry - time.time()))
+      sender.wakeup.wait(timeout)
+      sender.wakeup.clear()
+      try:
+        sender.expire_windows()
+        if time.time() - sender.last_flush >= sender.max_delay:
+          sender.swap()
+        sender.ship_pending()
+      except Exception:
+        # The documents shipped are given up by `ship_pending()`: the
+        # flusher keeps running for the next batches
+        sender.logger.exception('Flush failed')
+
+  def stop(self):
+    self.stopped.set()
+    self.sender.wakeup.set()
+
+class SeriesBuffer:
+  """Points waiting to be shipped, stored in columns: the id of their series
+  (see `ElasticsearchSender.add_points()`), their timestamp and their value.
+  A point takes 20 bytes, and its document is only rendered by `bodies()`.
+
+  Documents which are not plain points (e.g. aggregates) are kept already
+  serialized in `serialized`.
+
+  :param prefixes: The list of the rendered prefixes of the series: the bulk
+                   action line and the beginning of the document, up to the
+                   value. It is shared with the sender, which only appends
+                   to it
+  :param dedup: The prefixes are pairs: the action line up to the end of the
+                ``_id``, which the timestamp completes, and the beginning of
+                the document. Points of the same series and timestamp are
+                then sent once, with the last value received
+  """
+
+  def __init__(self, prefixes, dedup=False):
+    self.prefixes = prefixes
+    self.dedup = dedup
+    # The number of points dropped by `bodies()`, as duplicates
+    self.nb_duplicates = 0
+    # The size of the documents rendered by `bodies()`, before compression
+    self.nb_bytes = 0
+    self.ids = array('I')
+    self.timestamps = array(TIMESTAMP_TYPECODE)
+    self.values = array('d')
+    self.serialized = []
+
+  def __len__(self):
+    return len(self.ids) + len(self.serialized)
+
+  def bodies(self, chunk_size, codec=None, chunk_bytes=None):
+    """Returns the bulk request bodies of the buffer, as a list of
+    (body, number of documents), each holding up to `chunk_size` documents
+    and `chunk_bytes` bytes (before compression, see `chunk_bounds()`).
+    They are compressed while being joined if a `compression.Codec` is
+    given"""
+    prefixes = self.prefixes
+    timestamps = self.timestamps
+    if TIMESTAMP_TYPECODE == 'd':
+      timestamps = [int(timestamp) for timestamp in timestamps]
+    if self.dedup:
+      # Keyed by _id: the same tags may be received in different orders
+      points = dict(((prefixes[series_id][0], timestamp), (series_id, value))
+                    for series_id, timestamp, value in zip(self.ids, timestamps, self.values))
+      self.nb_duplicates = len(self.ids) - len(points)
+      docs = []
+      append = docs.append
+      for (action, timestamp), (series_id, value) in points.items():
+        timestamp = str(timestamp)
+        append(action + timestamp + '"}}\n' + prefixes[series_id][1] + repr(value) + ',"timestamp":' + timestamp + '}\n')
+    else:
+      docs = [prefixes[series_id] + repr(value) + ',"timestamp":' + str(timestamp) + '}\n'
+              for series_id, timestamp, value in zip(self.ids, timestamps, self.values)]
+    serialized = self.serialized
+    self.nb_bytes = sum(map(len, docs)) + sum(map(len, serialized))
+    bodies = []
+    for chunk in (docs, serialized):
+      for start, end in chunk_bounds(chunk, chunk_size, chunk_bytes):
+        if codec is not None:
+          body = codec.compress_docs(chunk[start:end])
+        elif chunk is docs:
+          body = ''.join(chunk[start:end]).encode('utf-8')
+        else:
+          body = b''.join(chunk[start:end])
+        bodies.append((body, end - start))
+    return bodies
+
 class ElasticsearchSender:
 
-  def __init__(self, parser, es, index, buffer_size = 5000, max_delay = 60, time_unit='ms'):
+  def __init__(self, parser, es, index, buffer_size = 5000, max_delay = 60, time_unit='ms',
+               background_flush=True, chunk_size=500, thread_count=1, max_in_flight=4,
+               spool=None, replay_rate=10000, stats=None, aggregator=None, dedup=False,
+               high_watermark=None, low_watermark=None, retry_queue=None, dead_letters=None,
+               compression=None, buffer_bytes=None, chunk_bytes=None, sizer=None):
     """An elasticsearch injector for data respecting the following format:
 
     metric_name metric_value timestamp(in `time_unit`) [key=value, [key=value]]
@@ -66,76 +472,613 @@ class ElasticsearchSender:
     It injects into elasticsearch considering it must send the date as
     `epoch_millis`. Thus, if `time_unit` == 's', it will add 3 trailling zeros.
 
+    Points are buffered in a `SeriesBuffer`: each series (index, metric name
+    and tags) is interned to an integer id, and its documents are only
+    rendered when they are shipped.
+
+    Full buffers are swapped for empty ones under the lock and shipped by a
+    `FlusherThread`, so `push()` never waits for elasticsearch.
+
     :param es: An Elasticsearch instance
+    :param index: The index name. It may be a ``strftime`` pattern (e.g.
+                  ``metrics-%Y.%m.%d``), in which case every document is sent
+                  to the index of its own timestamp (in UTC)
     :param buffer_size: The buffer size before using the bulk elastic API.
-                        `flush()` is called after (buffer_size + 1) messages.
-    :param max_delay: A `flush()` will be done when receiving a valid data if
-                      the last flush has been done for more than `max_delay` (seconds)
+                        The buffer is handed over after (buffer_size + 1) messages.
+    :param max_delay: A flush will be done if the last flush has been done for
+                      more than `max_delay` (seconds), even without new data
     :param time_unit:
+    :param background_flush: Start the `FlusherThread`. Otherwise, full
+                             buffers are only shipped by `flush()`
+    :param chunk_size: The number of documents in each bulk request, unless
+                       a `sizer` is given
+    :param thread_count: The number of bulk requests sent concurrently
+    :param max_in_flight: The maximum number of bulk requests waiting for
+                          their response when `thread_count` is above 1
+    :param spool: An optional `spool.Spool`, in which bulk requests are
+                  written before being sent, and kept until elasticsearch
+                  received them
+    :param replay_rate: The number of spooled documents sent per second
+                        when elasticsearch is reachable again, besides the
+                        new batches
+    :param stats: The `stats.Stats` to update. A new one is created by default
+    :param aggregator: An optional `aggregation.WindowAggregator`. Points are
+                       then indexed as one document per series and window
+    :param dedup: Give each point an ``_id`` derived from its metric name,
+                  tags and timestamp, so that points sent again overwrite
+                  the previous ones instead of being duplicated, and only
+                  send the last of the points of a series and timestamp
+                  found in a batch. It does not apply to the aggregates
+    :param high_watermark: The number of documents buffered or waiting to be
+                           shipped above which `accepting` is cleared: the
+                           clients stop reading from their sockets, so that
+                           TCP flow control slows down the agents. None (the
+                           default) for no limit
+    :param low_watermark: The number of documents below which `accepting` is
+                          set again. Defaults to half `high_watermark`
+    :param retry_queue: The `retry.RetryQueue` of the documents rejected by
+                        an overloaded or unavailable cluster. A default one
+                        is created if None. With a spool, the requests which
+                        could not be sent at all are spooled instead
+    :param dead_letters: An optional sink (e.g. `retry.DeadLetterFile`) to
+                         which the documents given up are added: the ones
+                         failing permanently (e.g. mapping conflicts), or
+                         retried too many times
+    :param compression: An optional `compression.Codec` compressing the
+                        bulk requests, and the spooled ones
+    :param buffer_bytes: The estimated size of the buffer (in bytes of
+                         documents) above which it is handed over, whatever
+                         `buffer_size`. None for no limit
+    :param chunk_bytes: The maximum size of the documents of a bulk request,
+                        before compression. None for no limit
+    :param sizer: An optional `sizing.AdaptiveChunkSize`, adapting the number
+                  of documents per bulk request to the latency of the
+                  cluster. The buffer is then handed over above the larger
+                  of `buffer_size` and its `chunk_size`
 
     """
     self.parser = parser
     self.es = es
     self.index = index
+    self.time_based = '%' in index
+    self.indices = {}
     self.buffer_size = buffer_size
     self.max_delay = max_delay
     self.time_unit = time_unit
+    self.chunk_size = chunk_size
+    self.thread_count = thread_count
+    self.max_in_flight = max_in_flight
+    self.spool = spool
+    self.replay_rate = replay_rate
+    # The token bucket limiting the replay: documents which may be sent now
+    self.replay_tokens = replay_rate
+    self.replay_time = time.time()
+    self.backlogged = spool is not None and not spool.empty()
+    # Whether the last request could not reach elasticsearch: the batches
+    # are then only spooled, until the replay gets through
+    self.unavailable = False
+    # The spool positions following the requests delivered while
+    # backlogged, skipped by the replay
+    self.delivered = set()
+    self.aggregator = aggregator
+    self.dedup = dedup
+    self.high_watermark = high_watermark
+    if low_watermark is None and high_watermark is not None:
+      low_watermark = high_watermark // 2
+    self.low_watermark = low_watermark
+    # The number of documents buffered, queued or being shipped
+    self.nb_buffered = 0
+    # Set while the clients may read from their sockets
+    self.accepting = threading.Event()
+    self.accepting.set()
+    self.retry_queue = retry_queue if retry_queue is not None else RetryQueue()
+    self.dead_letters = dead_letters
+    self.compression = compression
+    self.buffer_bytes = buffer_bytes
+    self.chunk_bytes = chunk_bytes
+    self.sizer = sizer
+    # The estimated size of a document, from the last batch shipped
+    self.doc_bytes = DOC_BYTES
 
-    self.buffer = []
+    # (index, metric name, tags string) -> series id, and the rendered
+    # prefix of each series id
+    self.series = {}
+    self.prefixes = []
+    self.buffer = SeriesBuffer(self.prefixes, dedup)
+    self.actions = {}
+    self.encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+    self.pool = None
+    self.pending = collections.deque()
     self.last_flush = time.time()
     self.lock = threading.RLock()
+    self.ship_lock = threading.Lock()
+    self.wakeup = threading.Event()
 
     self.logger = logging.getLogger('ElasticsearchSender')
 
+    self.stats = stats if stats is not None else Stats()
+    self.stats.gauges['buffer_docs'] = lambda: len(self.buffer)
+    self.stats.gauges['pending_batches'] = lambda: len(self.pending)
+    self.stats.gauges['interned_series'] = lambda: len(self.prefixes)
+    self.stats.gauges['waiting_docs'] = lambda: self.nb_buffered
+    self.stats.gauges['reading_paused'] = lambda: int(not self.accepting.is_set())
+    self.stats.gauges['retry_docs'] = lambda: len(self.retry_queue)
+    if sizer is not None:
+      self.stats.gauges['chunk_size'] = lambda: self.sizer.chunk_size
+      self.stats.gauges['chunk_backoffs'] = lambda: self.sizer.nb_backoffs
+    if spool is not None:
+      self.stats.gauges['spool_bytes'] = lambda: self.spool.size
+      self.stats.gauges['backlogged'] = lambda: int(self.backlogged)
+    if aggregator is not None:
+      self.stats.gauges['aggregated_series'] = lambda: self.aggregator.nb_series
+      self.stats.gauges['late_points'] = lambda: self.aggregator.nb_late
+      self.stats.gauges['future_points'] = lambda: self.aggregator.nb_future
+
+    self.flusher = None
+    if background_flush:
+      self.flusher = FlusherThread(self)
+      self.flusher.start()
+
   def push(self, metrics, socket=None, logging_prefix=''):
     """
     :param metrics: An iterable of string, each repreasenting a metric data
     """
-    """A list of strings representing metrics"""
-    docs = list()
-    for metric in metrics:
+    if socket is not None and ('version' in metrics or 'stats' in metrics):
+      for metric in metrics:
+        if metric == 'version':
+          socket.sendall( (VERSION + '\n').encode() )
+        elif metric == 'stats':
+          socket.sendall(''.join(line + '\n' for line in self.stats.lines()).encode('utf-8'))
+      metrics = [metric for metric in metrics if metric != 'version' and metric != 'stats']
+
+    errors = {}
+    points = self.parser.parse_points(metrics, errors)
+    self.push_points(points, errors, logging_prefix)
+
+  def push_points(self, points, errors=None, logging_prefix=''):
+    """Adds points already parsed, to the buffer or to the aggregator.
+
+    :param points: A list of (metric_name, tags_key, tags, value, timestamp),
+                   as returned by `OpenTsdbParser.parse_points()`
+    :param errors: The number of invalid metrics by reason, for statistics
+    """
+    self.stats.add_docs(len(points), errors or {})
+    if errors:
+      self.logger.warning(logging_prefix + 'Invalid metrics received: ' + str(errors))
+
+    if self.aggregator is not None:
+      parsed = []
+      for metric_name, tags_key, tags, value, timestamp in points:
+        doc = tags.copy()
+        doc[metric_name] = value
+        doc['timestamp'] = timestamp
+        parsed.append((metric_name, doc))
+      self.append(self.aggregator.add(parsed))
+    else:
+      self.add_points(points)
+
+  def add_points(self, points):
+    """Adds points to the buffer, without building their documents.
+
+    :param points: A list of (metric_name, tags_key, tags, value, timestamp),
+                   as returned by `OpenTsdbParser.parse_points()`
+    """
+    if not points:
+      return
+
+    index = self.index
+    index_for = self.index_for if self.time_based else None
+    with self.lock:
+      series = self.series
+      prefixes = self.prefixes
+      ids = self.buffer.ids
+      timestamps = self.buffer.timestamps
+      values = self.buffer.values
+      for metric_name, tags_key, tags, value, timestamp in points:
+        if index_for is not None:
+          index = index_for(timestamp)
+        key = (index, metric_name, tags_key)
+        series_id = series.get(key)
+        if series_id is None:
+          series_id = series[key] = len(prefixes)
+          prefixes.append(self.prefix(index, metric_name, tags))
+        ids.append(series_id)
+        timestamps.append(timestamp)
+        values.append(value)
+      self.buffered(len(points))
+      if self.full():
+        self.swap()
+
+  def prefix(self, index, metric_name, tags):
+    """Renders the beginning of the documents of a series, up to the value.
+    With `dedup`, returns the action line up to the timestamp in the
+    ``_id`` and the beginning of the document."""
+    source = self.encoder.encode(tags)[:-1]
+    if tags:
+      source += ','
+    source += self.encoder.encode(metric_name) + ':'
+    if not self.dedup:
+      return self.action(index, metric_name) + source
+    return (self.action(index, metric_name)[:-3] + ',"_id":"' + self.series_id(metric_name, tags) + '-', source)
+
+  @staticmethod
+  def series_id(metric_name, tags):
+    """Returns a hash of the metric name and tags, whatever their order"""
+    key = metric_name + ''.join(' ' + name + '=' + value for name, value in sorted(tags.items()))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+  def append(self, parsed):
+    """Serializes documents and adds them to the buffer.
+
+    :param parsed: A list of (metric_name, doc)
+    """
+    if not parsed:
+      return
+
+    action = self.action
+    encode = self.encoder.encode
+    if self.time_based:
+      index_for = self.index_for
+      docs = [(action(index_for(doc['timestamp']), metric_name) + encode(doc) + '\n').encode('utf-8')
+              for metric_name, doc in parsed]
+    else:
+      docs = [(action(self.index, metric_name) + encode(doc) + '\n').encode('utf-8')
+              for metric_name, doc in parsed]
+
+    with self.lock:
+      self.buffer.serialized.extend(docs)
+      self.buffered(len(docs))
+      if self.full():
+        self.swap()
+
+  def full(self):
+    """Returns whether the buffer holds more than `buffer_size` documents
+    (and the chunk size of the `sizer`), or about `buffer_bytes` bytes"""
+    nb_docs = len(self.buffer)
+    if nb_docs > self.buffer_size and (self.sizer is None or nb_docs > self.sizer.chunk_size):
+      return True
+    return self.buffer_bytes is not None and nb_docs * self.doc_bytes > self.buffer_bytes
+
+  def current_chunk_size(self):
+    return self.sizer.chunk_size if self.sizer is not None else self.chunk_size
+
+  def buffered(self, nb_docs):
+    """Counts `nb_docs` more documents buffered (or less, once shipped),
+    and pauses or resumes the reads of the clients accordingly"""
+    with self.lock:
+      self.nb_buffered += nb_docs
+      if self.high_watermark is None:
+        return
+      if self.accepting.is_set() and self.nb_buffered >= self.high_watermark:
+        self.accepting.clear()
+        self.logger.warning(str(self.nb_buffered) + ' documents waiting for elasticsearch, pausing the reads')
+        # The buffer may be below `buffer_size`, and will not grow anymore
+        self.swap()
+      elif not self.accepting.is_set() and self.nb_buffered <= self.low_watermark:
+        self.accepting.set()
+        self.logger.info(str(self.nb_buffered) + ' documents waiting for elasticsearch, resuming the reads')
+
+  def expire_windows(self, force=False):
+    """Adds to the buffer the aggregates of the closed windows, or of all
+    the windows if `force`"""
+    if self.aggregator is not None:
+      self.append(self.aggregator.expire(force=force))
+
+  def action(self, index, doc_type):
+    """Returns the bulk action line for a document of `index` and
+    `doc_type`. Action lines are rendered once for each index and type."""
+    action = self.actions.get((index, doc_type))
+    if action is None:
+      if len(self.actions) >= MAX_CACHED_SERIES:
+        self.actions.clear()
+      action = self.actions[(index, doc_type)] = self.encoder.encode(
+        {'index': {'_index': index, '_type': doc_type}}) + '\n'
+    return action
 
-      if metric == 'version' and socket is not None:
-        socket.sendall( (VERSION + '\n').encode() )
+  def index_for(self, timestamp):
+    """Returns the index of a document, given its timestamp (epoch_millis),
+    when `index` is a ``strftime`` pattern. The names are cached by hour."""
+    hour = timestamp // 3600000
+    index = self.indices.get(hour)
+    if index is None:
+      if len(self.indices) >= MAX_CACHED_INDICES:
+        self.indices.clear()
+      index = self.indices[hour] = time.strftime(self.index, time.gmtime(hour * 3600))
+    return index
 
-      line = self.parser.parse(metric, logging_prefix=logging_prefix)
+  def swap(self):
+    """Replaces the buffer by an empty one and queues the full one for the
+    flusher. This is O(1), whatever the size of the buffer.
 
-      if line is None:
+    The series are forgotten once there are more than `MAX_CACHED_SERIES`:
+    the queued buffers keep the prefixes they refer to."""
+    with self.lock:
+      self.last_flush = time.time()
+      if not self.buffer:
+        return
+      if len(self.prefixes) >= MAX_CACHED_SERIES:
+        self.series = {}
+        self.prefixes = []
+      self.pending.append(self.buffer)
+      self.buffer = SeriesBuffer(self.prefixes, self.dedup)
+    self.wakeup.set()
+
+  def ship_pending(self, force_retries=False):
+    """Ships all the queued batches and the retries due (or all of them if
+    `force_retries`), then replays the spool if needed. The sender lock is
+    not held meanwhile."""
+    with self.ship_lock:
+      while self.pending:
+        batch = self.pending.popleft()
+        try:
+          self.ship(batch)
+        except Exception as e:
+          self.logger.exception('Could not ship ' + str(len(batch)) + ' documents')
+          self.give_up(batch, e)
+        finally:
+          self.buffered(-len(batch))
+      self.retry(force_retries)
+      if self.backlogged:
+        self.replay()
+
+  def ship(self, batch):
+    """Sends `batch` in bulk requests of `chunk_size` documents (or the
+    chunk size of the `sizer`) and `chunk_bytes` bytes at most. When
+    `thread_count` is above 1, up to `max_in_flight` requests are sent
+    concurrently by a pool of threads.
+
+    With a spool, the requests are written to it first, and only
+    acknowledged once elasticsearch received them. If it could not, the
+    following batches are only written to the spool until the replay gets
+    through again. The batches are then sent as usual while the spool is
+    replayed, and the requests they delivered are skipped by the replay
+    (unless the process restarts meanwhile)."""
+    bodies = batch.bodies(self.current_chunk_size(), self.compression, self.chunk_bytes)
+    nb_sent = len(batch) - batch.nb_duplicates
+    if nb_sent:
+      self.doc_bytes = batch.nb_bytes / float(nb_sent)
+    if self.spool is not None:
+      positions = []
+      self.spool.append((body for body, nb_docs in bodies), positions)
+      if self.unavailable:
+        self.backlogged = True
+        return
+
+    start = time.time()
+    nb_success, errors, delivered, retry = 0, [], True, []
+    if self.thread_count > 1:
+      if self.pool is None:
+        self.pool = ThreadPool(self.thread_count)
+      in_flight = collections.deque()
+      results = []
+      for body, nb_docs in bodies:
+        if len(in_flight) >= self.max_in_flight:
+          results.append(in_flight.popleft().get())
+        in_flight.append(self.pool.apply_async(self.send_body, (body, nb_docs)))
+      results.extend(result.get() for result in in_flight)
+    else:
+      results = [self.send_body(body, nb_docs) for body, nb_docs in bodies]
+
+    for result in results:
+      nb_success += result.nb_success
+      errors.extend(result.errors)
+      retry.extend(result.retry)
+      delivered = delivered and result.delivered
+    self.stats.add_flush(time.time() - start, nb_sent, len(errors) + len(retry), batch.nb_duplicates)
+    self.logger.info((nb_success, len(retry), [error for error, doc in errors]))
+
+    if self.spool is not None:
+      if delivered and not self.backlogged:
+        if positions:
+          self.spool.ack(positions[-1])
+      else:
+        self.delivered.update(position for result, position in zip(results, positions)
+                              if result.delivered)
+      if not delivered:
+        # The requests not delivered are replayed from the spool: only the
+        # items rejected by the requests which succeeded are retried
+        retry = [doc for result in results if result.delivered for doc in result.retry]
+        self.backlogged = self.unavailable = True
+        self.logger.warning('Elasticsearch unavailable, spooling to ' + self.spool.directory)
+    self.failed(errors, retry)
+
+  def give_up(self, batch, exception):
+    """Gives up the documents of `batch`, which could not be shipped
+    because of `exception`. They are dead-lettered if they can still be
+    rendered, and only counted otherwise: retrying them would most likely
+    fail the same way."""
+    error = {'index': {'error': {'type': 'ship_error', 'reason': str(exception)}, 'status': None}}
+    try:
+      docs = [doc for body, nb_docs in batch.bodies(max(1, len(batch))) for doc in split_docs(body)]
+    except Exception:
+      self.stats.add_dead_letters({'ship_error': len(batch)})
+      return
+    self.failed([(error, doc) for doc in docs], [])
+
+  def failed(self, errors, retry, attempt=0):
+    """Schedules the retry of the documents of `retry`, which failed
+    `attempt` times before, and gives up the documents of `errors` (a list
+    of (bulk response item, document))."""
+    if retry:
+      given_up = self.retry_queue.add(retry, attempt)
+      self.buffered(len(retry) - len(given_up))
+      self.stats.add_retries(len(retry) - len(given_up))
+      error = {'index': {'error': {'type': 'retries_exhausted'}, 'status': None}}
+      errors = errors + [(error, doc) for doc in given_up]
+    if not errors:
+      return
+
+    counts = {}
+    for error, doc in errors:
+      name = error_type(error)
+      counts[name] = counts.get(name, 0) + 1
+    self.stats.add_dead_letters(counts)
+    self.logger.warning(str(len(errors)) + ' documents given up: ' + str(counts))
+    if self.dead_letters is not None:
+      self.dead_letters.add(errors)
+
+  def retry(self, force=False):
+    """Sends the documents whose retry is due, or all of them if `force`"""
+    for attempt, docs in self.retry_queue.due(force=force):
+      try:
+        for start, end in chunk_bounds(docs, self.current_chunk_size(), self.chunk_bytes):
+          chunk = docs[start:end]
+          start = time.time()
+          result = self.send_body(self.join(chunk), len(chunk))
+          self.stats.add_flush(time.time() - start, len(chunk), len(result.errors) + len(result.retry))
+          self.failed(result.errors, result.retry, attempt)
+      finally:
+        self.buffered(-len(docs))
+
+  def join(self, docs):
+    """Returns the bulk request body of the serialized `docs`, compressed if
+    needed"""
+    if self.compression is None:
+      return b''.join(docs)
+    return self.compression.compress_docs(docs)
+
+  def replay(self):
+    """Sends the bulk requests of the spool, at `replay_rate` documents per
+    second on average, whatever the number of calls: each call sends the
+    documents earned since the previous one, up to one second of them. The
+    requests already delivered by `ship()` are skipped for free. The
+    sender stops being backlogged once the spool is empty."""
+    now = time.time()
+    self.replay_tokens = min(self.replay_rate, self.replay_tokens + (now - self.replay_time) * self.replay_rate)
+    self.replay_time = now
+    while True:
+      records = self.spool.read(1)
+      if not records:
+        self.backlogged = False
+        self.delivered.clear()
+        self.logger.info('Spool replayed')
+        return
+      body, position = records[0]
+      if position in self.delivered:
+        self.delivered.discard(position)
+        self.spool.ack(position)
         continue
+      if self.replay_tokens < 1:
+        return
+      start = time.time()
+      result = self.send_body(body, decompress(body).count(b'\n') // 2)
+      if not result.delivered:
+        self.unavailable = True
+        return
+      self.unavailable = False
+      nb_failed = len(result.errors) + len(result.retry)
+      self.stats.add_flush(time.time() - start, result.nb_success + nb_failed, nb_failed)
+      self.spool.ack(position)
+      self.failed(result.errors, result.retry)
+      # A request larger than the tokens left is sent anyway, and paid
+      # for by the next calls
+      self.replay_tokens -= result.nb_success + nb_failed
+
+  def send_body(self, body, nb_docs):
+    """Sends one bulk request.
+
+    :param body: The serialized documents, possibly compressed (see
+                 `compression.encoding_of()`)
+    :param nb_docs: The number of documents in `body`
+    :returns: A `BulkResult`. `errors` holds the (bulk response item,
+              document) which failed permanently, and `retry` the documents
+              which may succeed later (see `retry.is_retryable()`).
+              `delivered` is False when the request could not be done at
+              all, for a reason which may not last
+    """
+    self.stats.add_bulk_bytes(len(body))
+    encoding = encoding_of(body)
+    start = time.time()
+    try:
+      if encoding is None:
+        response = self.es.bulk(body=body)
+      else:
+        # Elasticsearch.bulk() would append a newline to the compressed body
+        response = self.es.transport.perform_request('POST', '/_bulk', body=body,
+                                                     headers={'content-type': 'application/x-ndjson',
+                                                              'content-encoding': encoding})
+    except TransportError as e:
+      if e.status_code == 429:
+        self.observe(start, nb_docs, nb_docs)
+      if is_retryable(e.status_code):
+        return BulkResult(0, [], False, split_docs(decompress(body)))
+      error = {'index': {'error': {'type': 'request_error', 'reason': str(e)}, 'status': e.status_code}}
+      return BulkResult(0, [(error, doc) for doc in split_docs(decompress(body))], True, [])
 
-      self.lock.acquire()
-      self.buffer.append({'_index': self.index,
-                          '_type': line[0],
-                          '_source': line[1]})
+    if not response.get('errors'):
+      self.observe(start, nb_docs)
+      return BulkResult(nb_docs, [], True, [])
+    docs = split_docs(decompress(body))
+    errors, retry = [], []
+    nb_rejected = 0
+    for item, doc in zip(response['items'], docs):
+      status = list(item.values())[0].get('status', 500)
+      if 200 <= status < 300:
+        continue
+      if is_retryable(status):
+        retry.append(doc)
+        nb_rejected += status == 429
+      else:
+        errors.append((item, doc))
+    self.observe(start, nb_docs, nb_rejected)
+    return BulkResult(nb_docs - len(errors) - len(retry), errors, True, retry)
 
-      current_time = time.time()
-      if len(self.buffer) > self.buffer_size or (current_time - self.last_flush) > 60:
-        self.flush()
-        self.last_flush = current_time
-      self.lock.release()
+  def observe(self, start, nb_docs, nb_rejected=0):
+    """Reports to the `sizer` a bulk request of `nb_docs` documents sent at
+    `start`, `nb_rejected` of which were rejected with a 429 status"""
+    if self.sizer is not None:
+      self.sizer.observe(time.time() - start, nb_docs, nb_rejected)
 
   def flush(self):
-    self.lock.acquire()
-    nb_success, errors = helpers.bulk(self.es, self.buffer, chunk_size = 500, raise_on_error = False, raise_on_exception = False)
-    del self.buffer[:]
-    self.lock.release()
+    """Ships the current buffer, the windows being aggregated and all the
+    queued batches, and returns once they have been sent."""
+    self.expire_windows(force=True)
+    self.swap()
+    self.ship_pending()
 
-    self.logger.info((nb_success, errors))
+  def close(self):
+    """Stops the `FlusherThread` and flushes what remains."""
+    if self.flusher is not None:
+      self.flusher.stop()
+      self.flusher.join()
+      self.flusher = None
+    self.flush()
+    # Last chance for the documents waiting to be retried
+    self.ship_pending(force_retries=True)
+    error = {'index': {'error': {'type': 'shutdown'}, 'status': None}}
+    for attempt, docs in self.retry_queue.due(force=True):
+      self.failed([(error, doc) for doc in docs], [])
+      self.buffered(-len(docs))
+    if self.pool is not None:
+      self.pool.close()
+      self.pool = None
+    if self.spool is not None:
+      self.spool.close()
+    if self.dead_letters is not None:
+      self.dead_letters.close()
 
 class ClientThread(threading.Thread):
   """This thread will listen to a socket and send to the `injector` all
-     lines received for processing. It uses socket.recv() to read data from the
-     socket, and maintains an internal buffer to deal with incomplete lines.
+     lines received for processing. It uses socket.recv_into() to read data
+     from the socket into a reusable buffer, and keeps the bytes after the
+     last new line for the next read. Only complete lines are decoded, so a
+     character split between two reads is never decoded partially.
 
-     `injector` must implement push(lines) and flush()
+     `injector` must implement push(lines) and flush(). If it has an
+     ``accepting`` event (see `ElasticsearchSender`), the socket is not read
+     while it is cleared. As every connection then reads at most
+     `recv_size` bytes at once, they resume reading in turn.
   """
-  def __init__(self, clientsocket, ip, port, injector):
+  def __init__(self, clientsocket, ip, port, injector, recv_size=RECV_SIZE, stats=None):
     """
     :param clientsocket: A socket from which data will be received
     :param ip: The ip of the client (only used for logging)
     :param port: The port of the client socket (only used for logging)
     :param injector: an object having ``push(string list)`` and ``flush()``
                      defined
+    :param recv_size: The maximum number of bytes read at once. All the
+                      complete lines read are given to a single ``push``
+    :param stats: An optional `stats.Stats` counting the lines received
     """
     threading.Thread.__init__(self, name='Client: ' + str(ip) + ':' + str(port))
     self.setDaemon(True)
@@ -143,71 +1086,94 @@ class ClientThread(threading.Thread):
     self.ip = ip
     self.port = port
     self.injector = injector
+    self.recv_size = recv_size
+    self.stats = stats
 
     self.logger = logging.getLogger('ClientThread')
 
     self.logger.info("[+] New thread for " + str(self.ip) + ':' + str(self.port))
 
   def run(self):
-    remainer = ''
+    connection = str(self.ip) + ':' + str(self.port)
+    logging_prefix = '[' + connection + ']'
+    data = bytearray(self.recv_size)
+    view = memoryview(data)
+    remainder = b''
+    accepting = getattr(self.injector, 'accepting', None)
     try:
       while True:
-        data = self.clientsocket.recv(1024).decode()
+        if accepting is not None:
+          accepting.wait()
+        nbytes = self.clientsocket.recv_into(data)
 
-        #print('Received: ' + data)
-        if not data:
-          self.clientsocket.close()
+        if not nbytes:
+          if remainder:
+            self.injector.push([remainder.decode('utf-8', 'replace')], socket=self.clientsocket,
+                               logging_prefix=logging_prefix)
           self.logger.info('[-] Connection closed by ' + str(self.ip) + ':' + str(self.port))
           return
-        #self.logger.debug('Received: ' + data)
 
-        end_with_new_line = data.endswith('\n')
-        #print('Endwish:' + str(end_with_new_line))
-        lines = data.split('\n')
+        end = data.rfind(b'\n', 0, nbytes)
+        if end == -1:
+          remainder += view[:nbytes].tobytes()
+          if len(remainder) > MAX_LINE_SIZE:
+            self.logger.warning(logging_prefix + ' Line longer than ' + str(MAX_LINE_SIZE) + ' bytes dropped')
+            remainder = b''
+          continue
 
-        if end_with_new_line:
-          # When ending with a new line, the last element of lines is the empty string ''
-          lines = lines[:-1]
-          if remainer == '':
-            self.injector.push(lines[:], socket=self.clientsocket, logging_prefix='['+str(self.ip)+':'+str(self.port)+']')
-          else:
-            end = lines.pop(0)
-            remainer += end
-            self.injector.push([remainer], socket=self.clientsocket)
-            remainer = ''
-            self.injector.push(lines, socket=self.clientsocket)
+        if remainder:
+          lines = remainder + view[:end].tobytes()
         else:
-          end = lines.pop(0)
-          remainer += end
-          if len(lines) > 0:
-            self.injector.push([remainer], socket=self.clientsocket)
-            self.injector.push(lines[:-1], socket=self.clientsocket)
-            remainer = lines[-1]
+          lines = view[:end].tobytes()
+        remainder = view[end + 1:nbytes].tobytes()
+
+        lines = lines.decode('utf-8', 'replace').split('\n')
+        if self.stats is not None:
+          self.stats.add_lines(connection, len(lines))
+        self.injector.push(lines, socket=self.clientsocket, logging_prefix=logging_prefix)
     finally:
+      if self.stats is not None:
+        self.stats.connection_closed(connection)
       self.clientsocket.close()
 
 class AggregatorServer(threading.Thread):
 
-  def __init__(self, bind_host, bind_port, injector):
+  def __init__(self, bind_host, bind_port, injector, backlog=10, recv_size=RECV_SIZE, stats=None,
+               reuse_port=False):
     """
-    :param clientsocket: A socket from which data will be received
-    :param ip: The ip of the client (only used for logging)
-    :param port: The port of the client socket (only used for logging)
+    :param bind_host: The host on which to listen
+    :param bind_port: The port on which to listen
     :param injector: an object having ``push(string list)`` and ``flush()``
                      defined
+    :param backlog: The backlog of the listening socket
+    :param recv_size: The number of bytes read at once from client sockets
+    :param stats: The `stats.Stats` counting the lines received. Defaults to
+                  the ``stats`` of the injector, if any
+    :param reuse_port: Set ``SO_REUSEPORT``, so that several processes can
+                       listen to the same port (see `workers`)
     """
     threading.Thread.__init__(self, name='AggregatorServer: '+bind_host + ':' + str(bind_port))
     self.setDaemon(True)
     self.host = bind_host
     self.port = bind_port
     self.injector = injector
+    self.backlog = backlog
+    self.recv_size = recv_size
+    self.stats = stats if stats is not None else getattr(injector, 'stats', None)
+    self.reuse_port = reuse_port
+    self.serversocket = None
+    self.stopped = False
+    # The port actually bound, once listening (useful when `bind_port` is 0)
+    self.bound_port = None
     self.logger = logging.getLogger('AggregatorServer')
 
   def run(self):
 
-    serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serversocket = self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
       serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) #= True # Prevent 'cannot bind to address' errors on restart
+      if self.reuse_port:
+        serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
       serversocket.bind((self.host, self.port)) #socket.gethostname()
       self.logger.info('Socket bind completed: ' + socket.gethostname() + ':' + str(self.port))
     except socket.error as msg:
@@ -215,13 +1181,20 @@ class AggregatorServer(threading.Thread):
       self.logger.critical('Exiting...')
       sys.exit(1)
 
-    serversocket.listen(10)
+    serversocket.listen(self.backlog)
+    self.bound_port = serversocket.getsockname()[1]
     self.logger.info('Socket now listening to ' + str(self.port))
 
     try:
-      while True:
-        (clientsocket, (ip, port)) = serversocket.accept()
-        new_thread = ClientThread(clientsocket, ip, port, self.injector)
+      while not self.stopped:
+        try:
+          (clientsocket, (ip, port)) = serversocket.accept()
+        except socket.error:
+          if self.stopped:
+            break
+          raise
+        new_thread = ClientThread(clientsocket, ip, port, self.injector, recv_size=self.recv_size,
+                                  stats=self.stats)
         new_thread.setDaemon(True)
         new_thread.start()
     finally:
@@ -230,10 +1203,251 @@ class AggregatorServer(threading.Thread):
       self.logger.info('Close socket, flush buffer and quit')
       #sys.exit(0)
 
+  def stop(self):
+    """Stops accepting connections: `run()` then flushes the injector and
+    returns. Can be called from any thread or from a signal handler."""
+    self.stopped = True
+    if self.serversocket is not None:
+      try:
+        self.serversocket.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+
+class UdpServer(threading.Thread):
+  """Receives put lines in UDP datagrams, each holding one or more lines
+     separated by new lines.
+
+     Once the socket is readable, the datagrams waiting are read without
+     blocking, up to `max_batch`, and all their lines are given to a single
+     ``push``. Datagrams dropped by the kernel because the receive
+     buffer was full are counted in `nb_dropped` (on Linux only).
+  """
+
+  def __init__(self, bind_host, bind_port, injector, rcvbuf=UDP_RCVBUF, max_batch=UDP_MAX_BATCH,
+               stats=None, reuse_port=False):
+    """
+    :param bind_host: The host on which to listen
+    :param bind_port: The port on which to listen
+    :param injector: an object having ``push(string list)`` and ``flush()``
+                     defined
+    :param rcvbuf: The size of the receive buffer of the socket, in bytes
+    :param max_batch: The maximum number of datagrams pushed at once
+    :param stats: The `stats.Stats` counting the lines received. Defaults to
+                  the ``stats`` of the injector, if any
+    :param reuse_port: Set ``SO_REUSEPORT``, so that several processes can
+                       listen to the same port (see `workers`)
+    """
+    threading.Thread.__init__(self, name='UdpServer: ' + bind_host + ':' + str(bind_port))
+    self.daemon = True
+    self.host = bind_host
+    self.port = bind_port
+    self.injector = injector
+    self.rcvbuf = rcvbuf
+    self.max_batch = max_batch
+    self.stats = stats if stats is not None else getattr(injector, 'stats', None)
+    self.reuse_port = reuse_port
+    self.stopped = False
+    self.bound_port = None
+    # Datagrams dropped by the kernel, as last reported
+    self.nb_dropped = 0
+    self.logger = logging.getLogger('UdpServer')
+    if self.stats is not None:
+      self.stats.gauges['udp_dropped'] = lambda: self.nb_dropped
+
+  def run(self):
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    overflow = SO_RXQ_OVFL
+    try:
+      udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+      if self.reuse_port:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+      if overflow is not None:
+        try:
+          udp_socket.setsockopt(socket.SOL_SOCKET, overflow, 1)
+        except socket.error:
+          overflow = None
+      udp_socket.bind((self.host, self.port))
+    except socket.error as msg:
+      self.logger.critical('Bind failed: ' + str(msg))
+      return
+    self.bound_port = udp_socket.getsockname()[1]
+    self.logger.info('Listening to UDP port ' + str(self.bound_port) + ' (receive buffer of ' +
+                     str(udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)) + ' bytes)')
+
+    ancillary_size = socket.CMSG_SPACE(4) if overflow is not None and hasattr(udp_socket, 'recvmsg') else 0
+    accepting = getattr(self.injector, 'accepting', None)
+    udp_socket.setblocking(False)
+    connection = 'udp:' + str(self.bound_port)
+    try:
+      while not self.stopped:
+        if accepting is not None and not accepting.wait(0.5):
+          continue
+        # The stop flag is checked every half second
+        if not select.select([udp_socket], [], [], 0.5)[0]:
+          continue
+        datagrams = []
+        try:
+          while len(datagrams) < self.max_batch:
+            self.receive(udp_socket, datagrams, ancillary_size)
+        except socket.error as e:
+          if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+        if not datagrams:
+          continue
+
+        lines = [line for line in b'\n'.join(datagrams).decode('utf-8', 'replace').split('\n') if line]
+        if self.stats is not None:
+          self.stats.add_lines(connection, len(lines))
+        self.injector.push(lines, logging_prefix='[' + connection + ']')
+    finally:
+      udp_socket.close()
+      self.injector.flush()
+      self.logger.info('Close UDP socket, flush buffer and quit')
+
+  def receive(self, udp_socket, datagrams, ancillary_size):
+    """Reads one datagram into `datagrams`"""
+    if not ancillary_size:
+      datagrams.append(udp_socket.recv(MAX_DATAGRAM_SIZE))
+      return
+    data, ancillary, flags, address = udp_socket.recvmsg(MAX_DATAGRAM_SIZE, ancillary_size)
+    for level, kind, value in ancillary:
+      if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(value) >= 4:
+        # The number of datagrams dropped since the socket was created
+        self.nb_dropped = struct.unpack('I', value[:4])[0]
+    datagrams.append(data)
+
+  def stop(self):
+    """Stops receiving: `run()` then flushes the injector and returns"""
+    self.stopped = True
+
+def serve(args, worker_id=None):
+  """Runs the injector configured by the command line `args` until SIGTERM
+  is received, then flushes it.
+
+  :param worker_id: The id of the process, when running several workers
+                    (see `workers`). Each worker gets its own spool
+                    directory, and its statistics on ``--stats-port`` +
+                    `worker_id`
+  """
+  parser = OpenTsdbParser()
+
+  es = Elasticsearch(['localhost'],
+                     sniff_on_start=True,
+                     sniff_on_connection_fail=True,
+                     sniffer_timeout=60*5,
+                     maxsize=10)
+  if not args.no_template and not worker_id:
+    put_index_template(es, args.index, refresh_interval=args.refresh_interval)
+  spool = None
+  if args.spool_dir is not None:
+    from es_injectors.spool import Spool
+    spool_dir = args.spool_dir
+    if worker_id is not None:
+      spool_dir = os.path.join(spool_dir, 'worker-' + str(worker_id))
+    spool = Spool(spool_dir, segment_size=args.spool_segment_size * 1024 * 1024,
+                  max_size=args.spool_max_size * 1024 * 1024)
+  aggregator = None
+  if args.aggregation_window is not None:
+    from es_injectors.aggregation import WindowAggregator
+    aggregator = WindowAggregator(window=args.aggregation_window, grace=args.aggregation_grace)
+  retry_queue = RetryQueue(max_attempts=args.retry_attempts, budget=args.retry_budget)
+  dead_letters = None
+  if args.dead_letter_file is not None:
+    path = args.dead_letter_file
+    if worker_id is not None:
+      path += '.' + str(worker_id)
+    dead_letters = DeadLetterFile(path)
+  compression = None
+  if args.compression != 'none':
+    compression = Codec(args.compression, args.compression_level)
+  sizer = None
+  if args.target_latency is not None:
+    from es_injectors.sizing import AdaptiveChunkSize
+    sizer = AdaptiveChunkSize(args.target_latency, initial=args.chunk_size, maximum=args.max_chunk_size)
+  es_injector = ElasticsearchSender(parser, es, args.index, thread_count=args.bulk_threads,
+                                    spool=spool, replay_rate=args.replay_rate, aggregator=aggregator,
+                                    dedup=args.dedup, high_watermark=args.high_watermark or None,
+                                    low_watermark=args.low_watermark, retry_queue=retry_queue,
+                                    dead_letters=dead_letters, compression=compression,
+                                    chunk_size=args.chunk_size, chunk_bytes=args.chunk_bytes or None,
+                                    buffer_bytes=args.buffer_bytes or None, sizer=sizer)
+
+  if args.stats_port is not None:
+    StatsServer(HOST, args.stats_port + (worker_id or 0), es_injector.stats).start()
+
+  reuse_port = worker_id is not None
+  if args.asyncio:
+    from es_injectors import async_server
+    server = async_server.AsyncAggregatorServer(HOST, args.port, es_injector,
+      backlog=args.backlog or async_server.DEFAULT_BACKLOG,
+      max_connections=args.max_connections or async_server.DEFAULT_MAX_CONNECTIONS,
+      reuse_port=reuse_port)
+  else:
+    server = AggregatorServer(HOST, args.port, es_injector, backlog=args.backlog or 10,
+                              recv_size=args.recv_size, reuse_port=reuse_port)
+  #server.setDaemon(True)
+  #server.start()
+
+  udp_server = None
+  if args.udp_port is not None:
+    udp_server = UdpServer(HOST, args.udp_port, es_injector, rcvbuf=args.udp_rcvbuf, reuse_port=reuse_port)
+    udp_server.start()
+
+  http_server = None
+  if args.http_port is not None:
+    from es_injectors.http_server import HttpServer
+    http_server = HttpServer(HOST, args.http_port, es_injector, reuse_port=reuse_port)
+    http_server.start()
+
+  def stop(signum, frame):
+    server.stop()
+    if udp_server is not None:
+      udp_server.stop()
+  signal.signal(signal.SIGTERM, stop)
+  server.run()
+  if udp_server is not None:
+    udp_server.stop()
+    udp_server.join()
+  if http_server is not None:
+    http_server.stop()
+  es_injector.close()
+
 if __name__ == '__main__':
 
   parser = argparse.ArgumentParser()
   parser.add_argument("--port", default=DEFAULT_PORT, type=int, help='Port on which to listen (default:' + str(DEFAULT_PORT) + ')')
+  parser.add_argument("--recv-size", default=RECV_SIZE, type=int, help='Number of bytes read at once from client sockets (default:' + str(RECV_SIZE) + ')')
+  parser.add_argument("--index", default=INDEX_NAME, help='Index name, which can be a strftime pattern such as metrics-%%Y.%%m.%%d (default: ' + INDEX_NAME + ')')
+  parser.add_argument("--no-template", action="store_true", help='Do not install the index template at startup')
+  parser.add_argument("--refresh-interval", default=None, help='refresh_interval of the indices set by the index template, such as 60s (default: the one of elasticsearch)')
+  parser.add_argument("--bulk-threads", default=1, type=int, help='Number of bulk requests sent concurrently (default: 1)')
+  parser.add_argument("--chunk-size", default=500, type=int, help='Number of documents per bulk request, or initial one with --target-latency (default: 500)')
+  parser.add_argument("--chunk-bytes", default=CHUNK_BYTES, type=int, help='Maximum size of a bulk request before compression, 0 for no limit (default: ' + str(CHUNK_BYTES) + ')')
+  parser.add_argument("--buffer-bytes", default=BUFFER_BYTES, type=int, help='Estimated size of the buffer above which it is flushed, 0 for no limit (default: ' + str(BUFFER_BYTES) + ')')
+  parser.add_argument("--target-latency", default=None, type=float, help='Adapt the number of documents per bulk request to keep their latency near this many seconds, halving it on 429 (disabled by default)')
+  parser.add_argument("--max-chunk-size", default=20000, type=int, help='Maximum number of documents per bulk request with --target-latency (default: 20000)')
+  parser.add_argument("--spool-dir", default=None, help='Directory of the write-ahead spool, replayed besides the new batches after an outage (disabled by default)')
+  parser.add_argument("--spool-segment-size", default=64, type=int, help='Size of the spool segments in MB (default: 64)')
+  parser.add_argument("--spool-max-size", default=1024, type=int, help='Maximum size of the spool in MB (default: 1024)')
+  parser.add_argument("--replay-rate", default=10000, type=int, help='Spooled documents replayed per second (default: 10000)')
+  parser.add_argument("--aggregation-window", default=None, type=float, help='Aggregate points in windows of this many seconds (disabled by default)')
+  parser.add_argument("--aggregation-grace", default=5, type=float, help='Seconds given to late points when aggregating (default: 5)')
+  parser.add_argument("--stats-port", default=None, type=int, help='Port on which to serve statistics over HTTP (disabled by default)')
+  parser.add_argument("--asyncio", action="store_true", help='Serve all the connections from a single asyncio event loop')
+  parser.add_argument("--backlog", default=None, type=int, help='Backlog of the listening socket')
+  parser.add_argument("--max-connections", default=None, type=int, help='Maximum number of concurrent connections (asyncio only)')
+  parser.add_argument("--dedup", action="store_true", help='Give documents an _id derived from their series and timestamp, and drop the duplicates of a batch')
+  parser.add_argument("--high-watermark", default=1000000, type=int, help='Documents waiting for elasticsearch above which clients are not read anymore, 0 for no limit (default: 1000000)')
+  parser.add_argument("--low-watermark", default=None, type=int, help='Documents waiting for elasticsearch below which clients are read again (default: half the high watermark)')
+  parser.add_argument("--retry-attempts", default=5, type=int, help='Number of retries of a document rejected by an overloaded or unavailable cluster (default: 5)')
+  parser.add_argument("--retry-budget", default=100000, type=int, help='Maximum number of documents waiting to be retried (default: 100000)')
+  parser.add_argument("--dead-letter-file", default=None, help='File to which the documents given up are appended (disabled by default)')
+  parser.add_argument("--compression", default='none', choices=('none',) + CODECS, help='Compression of the bulk requests and of the spool (default: none)')
+  parser.add_argument("--compression-level", default=DEFAULT_LEVEL, type=int, help='Compression level, from 1 (fastest) to 9 (smallest) (default: ' + str(DEFAULT_LEVEL) + ')')
+  parser.add_argument("--udp-port", default=None, type=int, help='UDP port on which to receive put lines, one or more per datagram (disabled by default)')
+  parser.add_argument("--udp-rcvbuf", default=UDP_RCVBUF, type=int, help='Receive buffer of the UDP socket in bytes (default: ' + str(UDP_RCVBUF) + ')')
+  parser.add_argument("--http-port", default=None, type=int, help='Port on which to serve the OpenTSDB /api/put HTTP endpoint (disabled by default)')
+  parser.add_argument("--workers", default=1, type=int, help='Number of processes listening to the port with SO_REUSEPORT (default: 1)')
   args = parser.parse_args()
 
 
@@ -243,10 +1457,9 @@ if __name__ == '__main__':
     os.makedirs(log_dir)
 
   logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
-  handler = RotatingFileHandler(LOG_PATH, maxBytes=4*1024, backupCount=5)
+  handler = RotatingFileHandler(LOG_PATH, maxBytes=10*1024*1024, backupCount=5)
   handler.setFormatter(logging.Formatter(fmt='%(asctime)s %(message)s'))
-  #logging.getLogger().handlers = []
-  #logging.getLogger().addHandler(handler)
+  logging.getLogger().addHandler(handler)
 
   logging.info('\n')
   logging.info('Starting es_injector')
@@ -254,18 +1467,9 @@ if __name__ == '__main__':
   tracer.setLevel(logging.INFO)
   tracer.addHandler(logging.FileHandler(os.path.join(log_dir, 'es_trace.log')))
 
-  parser = OpenTsdbParser()
-
-  es = Elasticsearch(['localhost'],
-                     sniff_on_start=True,
-                     sniff_on_connection_fail=True,
-                     sniffer_timeout=60*5,
-                     maxsize=10)
-  es_injector = ElasticsearchSender(parser, es, INDEX_NAME)
-
-  server = AggregatorServer(HOST, args.port, es_injector)
-  #server.setDaemon(True)
-  #server.start()
-
-  server.run()
-
+  if args.workers > 1:
+    from es_injectors.workers import Workers
+    if args.spool_dir is not None:
+      logging.info('Each worker spools to ' + os.path.join(args.spool_dir, 'worker-<id>'))
+    sys.exit(1 if Workers(args.workers, lambda worker_id: serve(args, worker_id)).run() else 0)
+  serve(args)
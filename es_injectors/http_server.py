@@ -0,0 +1,218 @@
+#!/usr/bin/python
+"""An HTTP endpoint compatible with the ``/api/put`` of OpenTSDB, for the
+collectors sending batches of data points as json, e.g.::
+
+  POST /api/put
+  [{"metric": "sys.cpu.user", "timestamp": 1454962560, "value": 42.42,
+    "tags": {"host": "machine1"}}, ...]
+
+Bodies may be compressed with gzip or deflate (``Content-Encoding``), and
+are decompressed while they are read. Points are given to the injector
+already parsed, without going through the line protocol. Connections are
+kept alive, and each one is served by its own thread.
+
+As OpenTSDB, it answers 204 when every point is valid, and 400 otherwise,
+with a summary of the failures. With ``?summary`` or ``?details``, it
+answers 200 with the number of valid and invalid points, and with
+``?details`` the invalid points and the reason of their failure.
+"""
+
+import json, threading, logging, zlib, socket
+try:
+  from http.server import HTTPServer, BaseHTTPRequestHandler
+  from socketserver import ThreadingMixIn
+except ImportError:
+  from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+  from SocketServer import ThreadingMixIn
+
+# Bytes read at once from the request body
+READ_SIZE = 64 * 1024
+# Largest body accepted, once decompressed (bytes)
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+class BodyTooLarge(Exception):
+  pass
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+  reuse_port = False
+
+  def server_bind(self):
+    if self.reuse_port:
+      self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    HTTPServer.server_bind(self)
+
+class PutHandler(BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_POST(self):
+    server = self.server.put_server
+    path, _, query = self.path.partition('?')
+    if path.rstrip('/') != '/api/put':
+      self.discard_body()
+      self.send_json(404, {'error': {'code': 404, 'message': 'Endpoint not found'}})
+      return
+
+    accepting = getattr(server.injector, 'accepting', None)
+    if accepting is not None:
+      # The body stays in the socket while the injector is paused
+      accepting.wait()
+    try:
+      body = self.read_body()
+      points = json.loads(body.decode('utf-8'))
+    except BodyTooLarge:
+      self.send_json(413, {'error': {'code': 413, 'message': 'Body larger than ' + str(MAX_BODY_SIZE) + ' bytes'}})
+      return
+    except (ValueError, zlib.error) as e:
+      self.send_json(400, {'error': {'code': 400, 'message': 'Invalid body: ' + str(e)}})
+      return
+    if isinstance(points, dict):
+      points = [points]
+    elif not isinstance(points, list):
+      self.send_json(400, {'error': {'code': 400, 'message': 'Expected a data point or a list of data points'}})
+      return
+
+    success, invalid = server.put(points, '[' + self.client_address[0] + ']')
+    options = query.split('&')
+    response = {'success': success, 'failed': len(invalid)}
+    if 'details' in options:
+      response['errors'] = [{'datapoint': point, 'error': reason} for point, reason in invalid]
+    if 'details' in options or 'summary' in options:
+      self.send_json(200, response)
+    elif invalid:
+      self.send_json(400, response)
+    else:
+      self.send_json(204)
+
+  def read_body(self):
+    """Returns the body of the request, decompressed while it is read"""
+    encoding = (self.headers.get('Content-Encoding') or 'identity').lower()
+    if encoding == 'gzip':
+      decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+      decompressor = zlib.decompressobj()
+    elif encoding == 'identity':
+      decompressor = None
+    else:
+      # The connection stays usable for the next request
+      self.discard_body()
+      raise ValueError('unsupported Content-Encoding ' + encoding)
+
+    parts = []
+    size = 0
+    try:
+      for data in self.read_chunks():
+        if decompressor is not None:
+          data = decompressor.decompress(data, MAX_BODY_SIZE - size + 1)
+          if decompressor.unconsumed_tail:
+            raise BodyTooLarge()
+        size += len(data)
+        if size > MAX_BODY_SIZE:
+          raise BodyTooLarge()
+        parts.append(data)
+      if decompressor is not None:
+        parts.append(decompressor.flush())
+    except (BodyTooLarge, ValueError, zlib.error):
+      # The rest of the body may still be in the socket
+      self.close_connection = True
+      raise
+    return b''.join(parts)
+
+  def read_chunks(self):
+    """Generator of the raw body, by pieces of at most `READ_SIZE` bytes"""
+    if (self.headers.get('Transfer-Encoding') or '').lower() == 'chunked':
+      while True:
+        length = int(self.rfile.readline().split(b';')[0].strip(), 16)
+        if length == 0:
+          # Trailers, up to an empty line
+          while self.rfile.readline().strip():
+            pass
+          return
+        while length > 0:
+          data = self.rfile.read(min(length, READ_SIZE))
+          if not data:
+            raise ValueError('truncated body')
+          length -= len(data)
+          yield data
+        self.rfile.readline()
+    else:
+      length = int(self.headers.get('Content-Length') or 0)
+      while length > 0:
+        data = self.rfile.read(min(length, READ_SIZE))
+        if not data:
+          raise ValueError('truncated body')
+        length -= len(data)
+        yield data
+
+  def discard_body(self):
+    try:
+      for data in self.read_chunks():
+        pass
+    except ValueError:
+      self.close_connection = True
+
+  def send_json(self, status, response=None):
+    body = json.dumps(response).encode('utf-8') if response is not None else b''
+    self.send_response(status)
+    if response is not None:
+      self.send_header('Content-Type', 'application/json; charset=UTF-8')
+    self.send_header('Content-Length', str(len(body)))
+    if self.close_connection:
+      self.send_header('Connection', 'close')
+    self.end_headers()
+    self.wfile.write(body)
+
+class HttpServer(threading.Thread):
+  """Serves ``/api/put`` on `bind_host`:`bind_port` (0 picks a free port,
+     available in `port`).
+
+     :param injector: An `ElasticsearchSender`, or any object having
+                      ``parser`` and ``push_points(points, errors)``
+     :param stats: The `stats.Stats` counting the points received. Defaults
+                   to the ``stats`` of the injector, if any
+     :param reuse_port: Set ``SO_REUSEPORT``, so that several processes can
+                        listen to the same port (see `workers`)
+  """
+
+  def __init__(self, bind_host, bind_port, injector, stats=None, reuse_port=False):
+    threading.Thread.__init__(self, name='HttpServer: ' + bind_host + ':' + str(bind_port))
+    self.daemon = True
+    self.injector = injector
+    self.stats = stats if stats is not None else getattr(injector, 'stats', None)
+    self.httpd = ThreadingHTTPServer((bind_host, bind_port), PutHandler, bind_and_activate=False)
+    self.httpd.reuse_port = reuse_port
+    try:
+      self.httpd.server_bind()
+      self.httpd.server_activate()
+    except socket.error:
+      self.httpd.server_close()
+      raise
+    self.httpd.put_server = self
+    self.port = self.httpd.server_address[1]
+    self.logger = logging.getLogger('HttpServer')
+
+  def put(self, points, logging_prefix=''):
+    """Gives the valid `points` to the injector.
+
+    :returns: The number of valid points, and the list of the (point,
+              reason) of the invalid ones
+    """
+    errors = {}
+    parsed, invalid = self.injector.parser.parse_json(points, errors)
+    if self.stats is not None:
+      self.stats.add_lines('http', len(points))
+    self.injector.push_points(parsed, errors, logging_prefix)
+    return len(parsed), invalid
+
+  def run(self):
+    self.logger.info('Serving /api/put on port ' + str(self.port))
+    self.httpd.serve_forever()
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
@@ -1,8 +1,14 @@
 #!/usr/bin/python3
 from datetime import timedelta, date, datetime
-import random, time, collections, copy, argparse, sys
+import random, time, collections, copy, argparse, sys, json, socket, threading, os
+from multiprocessing import Pool
 from elasticsearch import Elasticsearch
 from elasticsearch import helpers
+from es_injectors.compression import Codec, CODECS, DEFAULT_LEVEL
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 metrics_data = {
   "cpu": ["host", "cluster", "os"],
@@ -45,7 +51,8 @@ def next_tags_positions(tags, tags_positions, nb_tag_values):
 
     i -= 1;
 
-def generate_doc(index, metric_names, metric_tags, start_date, end_date, print_doc=False):
+def generate_doc(index, metric_names, metric_tags, start_date, end_date, print_doc=False,
+                 time_delta=timedelta(hours=1)):
   """Generator of documents to index"""
 
   for metric in metric_names:
@@ -63,7 +70,7 @@ def generate_doc(index, metric_names, metric_tags, start_date, end_date, print_d
       a = random.uniform(1, 5)
       b = random.uniform(5, 14)
 
-      for single_date in daterange(start_date, end_date):
+      for single_date in daterange(start_date, end_date, time_delta):
         date = int(time.mktime(single_date.timetuple())) * 1000
         # We need to duplicate the document for every new value
         doc = copy.deepcopy(doc)
@@ -76,14 +83,293 @@ def generate_doc(index, metric_names, metric_tags, start_date, end_date, print_d
       if not next_tags_positions(tags, tags_positions, 2):
         break
 
+def generate_series(metric_names, metric_tags, nb_tag_values=2):
+  """Generator of the (metric, tags) of all the series, in the order of
+     `generate_doc`"""
+  for metric in metric_names:
+    tags = metric_tags[metric]
+    tags_positions = [0] * len(tags)
+    while True:
+      yield metric, dict((tags[i], tags[i] + '_value' + str(tags_positions[i])) for i in range(0, len(tags)))
+      if not tags or not next_tags_positions(tags, tags_positions, nb_tag_values):
+        break
+
+def generate_bulk(index, metric_names, metric_tags, start_date, end_date, time_delta=timedelta(hours=1),
+                  chunk_size=5000, worker=0, nb_workers=1, nb_tag_values=2, seed=None):
+  """Generator of bulk request bodies (utf-8 bytes of `chunk_size`
+     documents at most), holding the same documents as `generate_doc`.
+
+     The timestamps are computed once, and the values of each series at
+     once (with NumPy when available). Documents are rendered to json
+     directly, without building a dict per point.
+
+     :param worker: Only the series whose position modulo `nb_workers` is
+                    `worker` are generated, to split the series between
+                    processes
+     :param seed: Seed of the random values
+  """
+  start = int(time.mktime(start_date.timetuple())) * 1000
+  end = int(time.mktime(end_date.timetuple())) * 1000
+  step = int(time_delta.total_seconds() * 1000)
+  # The end of every document, from its timestamp
+  suffixes = [',"timestamp":' + str(timestamp) + '}\n' for timestamp in range(start, end, step)]
+  if numpy is not None:
+    rng = numpy.random.RandomState(seed)
+  else:
+    rng = random.Random(seed)
+  encode = json.JSONEncoder(separators=(',', ':')).encode
+
+  docs = []
+  for position, (metric, tags) in enumerate(generate_series(metric_names, metric_tags, nb_tag_values)):
+    if position % nb_workers != worker:
+      continue
+    a = rng.uniform(1, 5)
+    b = rng.uniform(5, 14)
+    if numpy is not None:
+      values = rng.uniform(min(a, b), max(a, b), len(suffixes)).tolist()
+    else:
+      values = [rng.uniform(min(a, b), max(a, b)) for suffix in suffixes]
+    source = encode(tags)[:-1]
+    prefix = (encode({'index': {'_index': index, '_type': metric}}) + '\n' + source +
+              (',' if tags else '') + encode(metric) + ':')
+    docs.extend([prefix + repr(value) + suffix for value, suffix in zip(values, suffixes)])
+    while len(docs) >= chunk_size:
+      yield ''.join(docs[:chunk_size]).encode('utf-8')
+      del docs[:chunk_size]
+  if docs:
+    yield ''.join(docs).encode('utf-8')
+
+def inject_bulk(options):
+  """Sends the documents of `generate_bulk(**options)` to the elasticsearch
+     of `hosts` (popped from `options`). Meant to be run by a process of a
+     `multiprocessing.Pool`.
+
+     :returns: The (number of documents, number of failed documents)
+  """
+  options = dict(options)
+  es = Elasticsearch(options.pop('hosts'))
+  nb_docs = nb_failed = 0
+  for body in generate_bulk(**options):
+    response = es.bulk(body=body)
+    nb_docs += len(response['items'])
+    if response.get('errors'):
+      nb_failed += len([item for item in response['items']
+                        if not 200 <= list(item.values())[0].get('status', 500) < 300])
+  return nb_docs, nb_failed
+
+def write_bulk(options):
+  """Writes the documents of `generate_bulk(**options)` to the NDJSON bulk
+     file `output` (popped from `options`), compressed by the
+     `compression.Codec` `codec` (popped too) unless it is None. Meant to be
+     run by a process of a `multiprocessing.Pool`.
+
+     :returns: The (number of documents, 0)
+  """
+  options = dict(options)
+  output = open(options.pop('output'), 'wb')
+  codec = options.pop('codec')
+  if codec is not None:
+    output = codec.writer(output)
+  nb_docs = 0
+  with output:
+    for body in generate_bulk(**options):
+      output.write(body)
+      nb_docs += body.count(b'\n') // 2
+  return nb_docs, 0
+
+def worker_path(path, worker):
+  """Returns the path of the file of `worker`: ``bulk.ndjson.gz`` becomes
+     ``bulk-1.ndjson.gz``"""
+  directory, name = os.path.split(path)
+  base, dot, extension = name.partition('.')
+  return os.path.join(directory, base + '-' + str(worker) + dot + extension)
+
+def series_lines(series):
+  """Returns, for each (metric, tags) of `series`, the beginning of its put
+     lines and their end (the tags)"""
+  return [('put ' + metric + ' ', ''.join(' ' + name + '=' + value for name, value in sorted(tags.items())) + '\n')
+          for metric, tags in series]
+
+def generate_lines(series, start, time_delta, rng=random):
+  """Infinite generator of the put lines of `series` in timestamp order,
+     as agents send them: one block of lines per timestamp, with a point of
+     every series, every `time_delta`.
+
+     :param series: A list of (metric, tags)
+     :param start: The first timestamp, in ms
+  """
+  lines = series_lines(series)
+  step = int(time_delta.total_seconds() * 1000)
+  timestamp = start
+  while True:
+    timestamp_str = ' ' + str(timestamp)
+    yield ''.join([head + '%.2f' % rng.uniform(1, 14) + timestamp_str + tail for head, tail in lines])
+    timestamp += step
+
+class LoadConnection(threading.Thread):
+  """Sends the lines of some series over one connection, as an agent would:
+     the points of all its series for a timestamp at once, at a fixed
+     rate. The schedule is open-loop: a late send does not delay the next
+     ones, and the latency of a send is measured from the time at which it
+     was due, so a slow server shows up in the latencies.
+
+     :param address: The (host, port) of the `AggregatorServer`
+     :param series: The list of (metric, tags) sent
+     :param rate: The number of lines per second
+     :param start: The first timestamp sent, in ms
+     :param time_delta: The interval between two timestamps sent
+     :param end_time: The time at which to stop (as `time.time()`)
+  """
+
+  def __init__(self, address, series, rate, start, time_delta, end_time, seed=None):
+    threading.Thread.__init__(self, name='LoadConnection: ' + str(len(series)) + ' series')
+    self.daemon = True
+    self.address = address
+    self.series = series
+    self.interval = len(series) / float(rate)
+    self.start_timestamp = start
+    self.time_delta = time_delta
+    self.end_time = end_time
+    self.rng = random.Random(seed)
+    self.nb_lines = 0
+    self.latencies = []
+    self.error = None
+
+  def run(self):
+    try:
+      connection = socket.create_connection(self.address)
+    except socket.error as e:
+      self.error = str(e)
+      return
+    blocks = generate_lines(self.series, self.start_timestamp, self.time_delta, self.rng)
+    # Connections are spread over the interval, instead of sending together
+    due = time.time() + self.rng.uniform(0, self.interval)
+    try:
+      while due < self.end_time:
+        block = next(blocks).encode('utf-8')
+        delay = due - time.time()
+        if delay > 0:
+          time.sleep(delay)
+        connection.sendall(block)
+        self.latencies.append(time.time() - due)
+        self.nb_lines += len(self.series)
+        due += self.interval
+    except socket.error as e:
+      self.error = str(e)
+    finally:
+      connection.close()
+
+def percentile(values, ratio):
+  """Returns the `ratio` percentile of the sorted list `values`"""
+  if not values:
+    return 0
+  return values[min(len(values) - 1, int(ratio * len(values)))]
+
+def run_load(address, series, nb_connections, rate, duration, time_delta=timedelta(seconds=10), start=None):
+  """Plays `series` back to `address` over `nb_connections` connections,
+     which share the series and the `rate` (lines per second), during
+     `duration` seconds.
+
+     A block of points of every series is sent every ``len(series) / rate``
+     seconds, and its timestamp is `time_delta` after the previous one: time
+     goes `speedup` times faster than the real time. Unless `start` is
+     given, the first timestamp is in the past, so that the last one sent is
+     about the current time, and no point is in the future.
+
+     :returns: A dict reporting the target and achieved rates, the speed-up
+               of the timestamps and the latencies of the sends in ms
+  """
+  period = len(series) / float(rate)
+  speedup = time_delta.total_seconds() / period
+  if start is None:
+    start = int((time.time() - duration * speedup) * 1000)
+  nb_connections = min(nb_connections, len(series))
+  end_time = time.time() + duration
+  connections = [LoadConnection(address, series[i::nb_connections], rate * len(series[i::nb_connections]) / float(len(series)),
+                                start, time_delta, end_time, seed=i)
+                 for i in range(0, nb_connections)]
+  started = time.time()
+  for connection in connections:
+    connection.start()
+  for connection in connections:
+    connection.join()
+  elapsed = time.time() - started
+
+  latencies = sorted(latency * 1000 for connection in connections for latency in connection.latencies)
+  nb_lines = sum(connection.nb_lines for connection in connections)
+  return {
+    'connections': nb_connections,
+    'series': len(series),
+    'failed_connections': len([connection for connection in connections if connection.error is not None]),
+    'lines': nb_lines,
+    'target_rate': rate,
+    'achieved_rate': nb_lines / elapsed,
+    'speedup': speedup,
+    'latency_ms': {'p50': percentile(latencies, 0.5), 'p90': percentile(latencies, 0.9),
+                   'p99': percentile(latencies, 0.99), 'max': latencies[-1] if latencies else 0},
+  }
+
 if __name__ == "__main__":
   import unittest
 
 
   parser = argparse.ArgumentParser()
   parser.add_argument("--test", '-t', action="store_true", help="Run tests")
+  parser.add_argument("--bulk", action="store_true", help="Generate the documents series by series, as arrays, straight into bulk requests")
+  parser.add_argument("--processes", default=1, type=int, help="Number of processes sharing the series (--bulk only, default: 1)")
+  parser.add_argument("--index", default='test-metrics', help="Index name (default: test-metrics)")
+  parser.add_argument("--days", default=7, type=float, help="Number of days of data, until now (default: 7)")
+  parser.add_argument("--interval", default=3600, type=float, help="Seconds between two points of a series (default: 3600). With --load, timestamps then go --interval * --rate / number of series times faster than the real time, and end at the current time")
+  parser.add_argument("--nb-metrics", default=NB_METRICS, type=int, help="Number of metrics (default: " + str(NB_METRICS) + ")")
+  parser.add_argument("--nb-tags", default=number_tags, type=int, help="Number of tags per metric (default: " + str(number_tags) + ")")
+  parser.add_argument("--nb-tag-values", default=2, type=int, help="Number of values per tag (--bulk and --load only, default: 2)")
+  parser.add_argument("--load", default=None, metavar='HOST:PORT', help="Send put lines to the injector listening on HOST:PORT, instead of indexing")
+  parser.add_argument("--connections", default=100, type=int, help="Number of connections (--load only, default: 100)")
+  parser.add_argument("--rate", default=10000, type=float, help="Total number of lines per second (--load only, default: 10000)")
+  parser.add_argument("--duration", default=60, type=float, help="Seconds of load (--load only, default: 60)")
+  parser.add_argument("--output", default=None, help="Write the bulk requests to this NDJSON file instead of indexing them, one file per process (--bulk only)")
+  parser.add_argument("--compression", default='none', choices=('none',) + CODECS, help="Compression of the --output files (default: none)")
+  parser.add_argument("--compression-level", default=DEFAULT_LEVEL, type=int, help="Compression level, from 1 (fastest) to 9 (smallest) (default: " + str(DEFAULT_LEVEL) + ")")
+  parser.add_argument("--chunk-size", default=5000, type=int, help="Number of documents per bulk request (--bulk only, default: 5000)")
   args = parser.parse_args()
 
+  if args.load is not None:
+    host, port = args.load.rsplit(':', 1)
+    names = ['metric_' + str(i) for i in range(0, args.nb_metrics)]
+    metric_tags = dict((metric, [metric + '_tag_' + str(i) for i in range(0, args.nb_tags)]) for metric in names)
+    series = list(generate_series(names, metric_tags, args.nb_tag_values))
+    report = run_load((host, int(port)), series, args.connections, args.rate, args.duration,
+                      time_delta=timedelta(seconds=args.interval))
+    print(json.dumps(report, indent=2, sort_keys=True))
+    sys.exit(0)
+
+  if args.bulk:
+    end_date = datetime.utcnow()
+    start_date = end_date - timedelta(days=args.days)
+    names = ['metric_' + str(i) for i in range(0, args.nb_metrics)]
+    metric_tags = dict((metric, [metric + '_tag_' + str(i) for i in range(0, args.nb_tags)]) for metric in names)
+    options = [{'hosts': ['localhost'], 'index': args.index, 'metric_names': names, 'metric_tags': metric_tags,
+                'start_date': start_date, 'end_date': end_date, 'time_delta': timedelta(seconds=args.interval),
+                'chunk_size': args.chunk_size, 'worker': worker, 'nb_workers': args.processes,
+                'nb_tag_values': args.nb_tag_values, 'seed': worker}
+               for worker in range(0, args.processes)]
+    if args.output is not None:
+      codec = Codec(args.compression, args.compression_level) if args.compression != 'none' else None
+      for option in options:
+        del option['hosts']
+        option['codec'] = codec
+        option['output'] = args.output if args.processes == 1 else worker_path(args.output, option['worker'])
+    start = time.time()
+    pool = Pool(args.processes)
+    results = pool.map(inject_bulk if args.output is None else write_bulk, options)
+    pool.close()
+    nb_docs = sum(result[0] for result in results)
+    nb_failed = sum(result[1] for result in results)
+    duration = time.time() - start
+    print(str(nb_docs) + ' documents (' + str(nb_failed) + ' failed) in ' + str(round(duration, 1)) + 's: ' +
+          str(int(nb_docs / duration)) + ' documents/s')
+    sys.exit(0)
+
   if not args.test:
     end_date = datetime.utcnow()
     start_date = end_date - timedelta(days=7)
@@ -125,6 +411,86 @@ if __name__ == "__main__":
       self.maxDiff = None
       self.assertEqual(docs, correct_result)
 
+    def test_generate_bulk(self):
+      end_date = datetime.utcnow()
+      start_date = end_date - timedelta(minutes=50)
+      metric_tags = {"metric_1": ["tag1_1", "tag1_2", "tag1_3"]}
+      expected = list(generate_doc('test-metrics', ["metric_1"], metric_tags, start_date, end_date,
+                                   time_delta=timedelta(minutes=10)))
+      self.assertEqual(len(expected), 40)
+
+      docs = []
+      for worker in range(0, 3):
+        for body in generate_bulk('test-metrics', ["metric_1"], metric_tags, start_date, end_date,
+                                  time_delta=timedelta(minutes=10), chunk_size=7, worker=worker, nb_workers=3):
+          lines = body.decode('utf-8').splitlines()
+          self.assertTrue(len(lines) <= 14)
+          for i in range(0, len(lines), 2):
+            doc = json.loads(lines[i + 1])
+            doc.update(json.loads(lines[i])['index'])
+            docs.append(doc)
+      key = lambda doc: (doc['tag1_1'], doc['tag1_2'], doc['tag1_3'], doc['timestamp'])
+      self.assertEqual(sorted(map(key, docs)), sorted(map(key, expected)))
+      for doc in docs:
+        self.assertTrue(1 <= doc['metric_1'] <= 14)
+        self.assertEqual((doc['_index'], doc['_type']), ('test-metrics', 'metric_1'))
+
+    def test_write_bulk(self):
+      import tempfile, shutil, gzip
+      directory = tempfile.mkdtemp()
+      self.addCleanup(shutil.rmtree, directory)
+      end_date = datetime.utcnow()
+      options = {'index': 'test-metrics', 'metric_names': ["metric_1"], 'metric_tags': {"metric_1": ["tag1_1", "tag1_2"]},
+                 'start_date': end_date - timedelta(minutes=50), 'end_date': end_date,
+                 'time_delta': timedelta(minutes=10), 'chunk_size': 7, 'seed': 0}
+      expected = b''.join(generate_bulk(**options))
+      path = worker_path(os.path.join(directory, 'bulk.ndjson.gz'), 1)
+      self.assertEqual(os.path.basename(path), 'bulk-1.ndjson.gz')
+      options.update({'output': path, 'codec': Codec('gzip', 6)})
+      self.assertEqual(write_bulk(options), (20, 0))
+      with gzip.open(path) as bulk_file:
+        self.assertEqual(bulk_file.read(), expected)
+      self.assertTrue(os.path.getsize(path) < len(expected) / 4)
+
+    def test_generate_lines(self):
+      series = list(generate_series(["metric_1"], {"metric_1": ["tag1_2", "tag1_1"]}))
+      blocks = generate_lines(series, 1454962560000, timedelta(seconds=10))
+      lines = (next(blocks) + next(blocks)).splitlines()
+      self.assertEqual(len(lines), 8)
+      # Time-major: every series at a timestamp, then the next timestamp
+      self.assertEqual([line.split(' ')[3] for line in lines], ['1454962560000'] * 4 + ['1454962570000'] * 4)
+      self.assertEqual(lines[1].split(' ')[:2], ['put', 'metric_1'])
+      self.assertEqual(lines[1].split(' ')[4:], ['tag1_1=tag1_1_value1', 'tag1_2=tag1_2_value0'])
+      self.assertTrue(1 <= float(lines[0].split(' ')[2]) <= 14)
+
+    def test_run_load(self):
+      server_socket = socket.socket()
+      server_socket.bind(('127.0.0.1', 0))
+      server_socket.listen(10)
+      received = []
+
+      def receive(connection):
+        while True:
+          data = connection.recv(65536)
+          if not data:
+            break
+          received.append(data)
+
+      def accept():
+        for i in range(0, 4):
+          threading.Thread(target=receive, args=(server_socket.accept()[0],)).start()
+      threading.Thread(target=accept).start()
+
+      series = list(generate_series(["metric_1"], {"metric_1": ["tag1_1", "tag1_2", "tag1_3"]}))
+      report = run_load(server_socket.getsockname(), series, 4, 400, 0.5)
+      server_socket.close()
+      time.sleep(0.1)
+      self.assertEqual(report['connections'], 4)
+      self.assertEqual(report['failed_connections'], 0)
+      self.assertTrue(100 <= report['lines'] <= 300)
+      self.assertEqual(b''.join(received).count(b'\n'), report['lines'])
+      self.assertTrue(report['latency_ms']['p50'] <= report['latency_ms']['max'])
+
   # We need to clear the arguments, since they will be interpreted by unittest
   sys.argv[1:] = []
   unittest.main()
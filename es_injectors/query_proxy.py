@@ -0,0 +1,547 @@
+#!/usr/bin/python
+"""An HTTP proxy in front of elasticsearch, caching the ``date_histogram``
+queries of dashboards such as Grafana::
+
+  python es_injectors/query_proxy.py --port 9201 --upstream http://localhost:9200
+
+Grafana then uses ``http://localhost:9201`` as the url of its elasticsearch
+datasource.
+
+A search is cached when its only aggregation is a ``date_histogram`` with a
+fixed interval, over a ``range`` filter in epoch milliseconds on the same
+field (what Grafana sends), and no sub-aggregation of the histogram is a
+pipeline aggregation depending on other buckets (e.g. ``derivative``). Its
+range is split into:
+
+- the buckets of the closed blocks (`BLOCK_BUCKETS` buckets, aligned on the
+  epoch), ending more than `live_delay` seconds ago. They do not change
+  anymore, so they are kept in an LRU cache, bounded by the size of their
+  json, and only the blocks missing from it are requested,
+- the partial bucket at the start of the range, if it does not start on a
+  bucket, and the live tail, from the first block still open. They are
+  always requested.
+
+Everything missing is requested at once with ``_msearch``, and the buckets
+are merged into the response elasticsearch would have given. Other requests
+are forwarded as is. Documents indexed more than `live_delay` late (e.g.
+replayed from a spool) are not seen by the cached blocks.
+"""
+
+import argparse, collections, copy, json, logging, re, socket, threading, time
+try:
+  from http.server import BaseHTTPRequestHandler
+  from http.client import HTTPConnection, HTTPSConnection, HTTPException
+  from urllib.parse import urlparse
+except ImportError:
+  from BaseHTTPServer import BaseHTTPRequestHandler
+  from httplib import HTTPConnection, HTTPSConnection, HTTPException
+  from urlparse import urlparse
+from es_injectors.compression import decompress
+from es_injectors.http_server import ThreadingHTTPServer
+
+DEFAULT_PORT = 9201
+DEFAULT_UPSTREAM = 'http://localhost:9200'
+# Size of the cached buckets, as json (bytes)
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+# Seconds after which a bucket is considered complete
+DEFAULT_LIVE_DELAY = 300
+# Number of buckets of a cached block
+BLOCK_BUCKETS = 60
+
+INTERVAL_UNITS = {'ms': 1, 's': 1000, 'm': 60 * 1000, 'h': 3600 * 1000, 'd': 24 * 3600 * 1000}
+UTC_TIME_ZONES = ('UTC', 'utc', 'Z', '+00:00', 'Etc/UTC')
+# Response headers of the upstream not forwarded to the client
+HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'content-length')
+# Pipeline aggregations computed from the neighbouring buckets, or from all
+# of them: their values depend on the buckets requested together
+PIPELINE_AGGREGATIONS = ('derivative', 'moving_avg', 'moving_fn', 'serial_diff', 'cumulative_sum',
+                         'bucket_sort')
+
+def parse_interval(interval):
+  """Returns the duration of a fixed interval (e.g. ``10s`` or ``1h``) in
+  milliseconds, or None for a calendar interval (e.g. ``1M``)"""
+  if isinstance(interval, int):
+    return interval if interval > 0 else None
+  match = re.match(r'^(\d+)(ms|s|m|h|d)$', str(interval))
+  if match is None or int(match.group(1)) == 0:
+    return None
+  return int(match.group(1)) * INTERVAL_UNITS[match.group(2)]
+
+def find_range(query, field):
+  """Returns the (container, key) of the only ``range`` filter on `field` in
+  the ``filter`` or ``must`` clauses of the ``bool`` `query`, or None"""
+  clauses = query.get('bool') if isinstance(query, dict) else None
+  if not isinstance(clauses, dict):
+    return None
+  found = []
+  for occur in ('filter', 'must'):
+    container = clauses.get(occur)
+    if isinstance(container, dict):
+      container, keys = clauses, [occur]
+    elif isinstance(container, list):
+      keys = range(0, len(container))
+    else:
+      continue
+    for key in keys:
+      if 'range' in container[key] and field in container[key]['range']:
+        found.append((container, key))
+  return found[0] if len(found) == 1 else None
+
+def has_pipeline(aggregation):
+  """Returns True if `aggregation` has a sub-aggregation (at any depth) in
+  `PIPELINE_AGGREGATIONS`"""
+  for option in ('aggs', 'aggregations'):
+    sub_aggregations = aggregation.get(option)
+    if sub_aggregations is None:
+      continue
+    if not isinstance(sub_aggregations, dict):
+      return True
+    for sub_aggregation in sub_aggregations.values():
+      if not isinstance(sub_aggregation, dict) or set(sub_aggregation) & set(PIPELINE_AGGREGATIONS) \
+         or has_pipeline(sub_aggregation):
+        return True
+  return False
+
+class HistogramQuery:
+  """A search whose buckets can be cached (see `parse()`).
+
+  :param body: The search body
+  :param name: The name of its ``date_histogram`` aggregation
+  :param interval: The interval of the buckets, in milliseconds
+  :param gte: The start of the range, in epoch milliseconds
+  :param lte: The end of the range (included)
+  :param key: The key of the search in the cache, without its range
+  """
+
+  def __init__(self, body, name, interval, gte, lte, key):
+    self.body = body
+    self.name = name
+    self.interval = interval
+    self.gte = gte
+    self.lte = lte
+    self.key = key
+    histogram = body['aggs'][name]['date_histogram']
+    self.field = histogram['field']
+    self.min_doc_count = histogram.get('min_doc_count', 0)
+    self.bounded = 'extended_bounds' in histogram
+
+  @classmethod
+  def parse(cls, header, body, path='/_msearch', params=''):
+    """Returns the `HistogramQuery` of a search of ``_msearch``, or None if
+    it can not be cached. The `path` of the request (which may name the
+    indices) and its query string `params` are part of the key."""
+    if not isinstance(body, dict) or str(body.get('size')) != '0' or set(body) - set(['size', 'query', 'aggs']):
+      return None
+    aggs = body.get('aggs')
+    if not isinstance(aggs, dict) or len(aggs) != 1:
+      return None
+    name, aggregation = list(aggs.items())[0]
+    histogram = aggregation.get('date_histogram') if isinstance(aggregation, dict) else None
+    if not isinstance(histogram, dict) or 'field' not in histogram or has_pipeline(aggregation):
+      return None
+    if histogram.get('keyed') or histogram.get('offset') or histogram.get('order', {'_key': 'asc'}) != {'_key': 'asc'} \
+       or histogram.get('time_zone', 'UTC') not in UTC_TIME_ZONES or 'missing' in histogram:
+      return None
+    interval = parse_interval(histogram.get('fixed_interval', histogram.get('interval')))
+    found = find_range(body.get('query'), histogram['field'])
+    if interval is None or found is None:
+      return None
+    container, position = found
+    bounds = container[position]['range'][histogram['field']]
+    if set(bounds) - set(['gte', 'lte', 'format']) or bounds.get('format', 'epoch_millis') != 'epoch_millis':
+      return None
+    try:
+      gte, lte = int(bounds['gte']), int(bounds['lte'])
+    except (KeyError, TypeError, ValueError):
+      return None
+    if gte > lte:
+      return None
+
+    # Same key whatever the range, and the bounds of the histogram
+    normalized = copy.deepcopy(body)
+    container, position = find_range(normalized.get('query'), histogram['field'])
+    container[position] = {'range': {}}
+    for option in ('extended_bounds', 'min_doc_count'):
+      normalized['aggs'][name]['date_histogram'].pop(option, None)
+    header = dict((option, value) for option, value in header.items() if option != 'preference')
+    key = json.dumps([path, params, header, normalized], sort_keys=True)
+    return cls(body, name, interval, gte, lte, key)
+
+  def piece(self, start, end):
+    """Returns the body of the search of every bucket between `start` and
+    `end` (included), empty ones too"""
+    body = copy.deepcopy(self.body)
+    container, position = find_range(body['query'], self.field)
+    container[position] = {'range': {self.field: {'gte': start, 'lte': end, 'format': 'epoch_millis'}}}
+    histogram = body['aggs'][self.name]['date_histogram']
+    histogram['min_doc_count'] = 0
+    histogram['extended_bounds'] = {'min': start, 'max': end}
+    return body
+
+  def merge(self, buckets, responses):
+    """Returns the response of the search, from its `buckets` sorted by key
+    and the `responses` of its pieces requested"""
+    if not self.bounded:
+      # Elasticsearch only returns the buckets between the first and the
+      # last documents
+      nonempty = [i for i, bucket in enumerate(buckets) if bucket['doc_count']]
+      buckets = buckets[nonempty[0]:nonempty[-1] + 1] if nonempty else []
+    total = sum(bucket['doc_count'] for bucket in buckets)
+    if self.min_doc_count:
+      buckets = [bucket for bucket in buckets if bucket['doc_count'] >= self.min_doc_count]
+    response = {'took': sum(response.get('took', 0) for response in responses),
+                'timed_out': any(response.get('timed_out') for response in responses),
+                '_shards': {'total': 0, 'successful': 0, 'skipped': 0, 'failed': 0},
+                'hits': {'total': total, 'max_score': 0.0, 'hits': []},
+                'aggregations': {self.name: {'buckets': buckets}},
+                'status': 200}
+    if responses:
+      response['_shards'] = responses[-1].get('_shards', response['_shards'])
+      if isinstance(responses[-1].get('hits', {}).get('total'), dict):
+        response['hits']['total'] = {'value': total, 'relation': 'eq'}
+    return response
+
+class LruCache:
+  """Least recently used values, evicted once their total size is above
+  `max_size`"""
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.size = 0
+    self.values = collections.OrderedDict()
+    self.nb_hits = 0
+    self.nb_misses = 0
+    self.nb_evictions = 0
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.values)
+
+  def get(self, key):
+    with self.lock:
+      entry = self.values.pop(key, None)
+      if entry is None:
+        self.nb_misses += 1
+        return None
+      self.values[key] = entry
+      self.nb_hits += 1
+      return entry[0]
+
+  def put(self, key, value, size):
+    if size > self.max_size:
+      return
+    with self.lock:
+      previous = self.values.pop(key, None)
+      if previous is not None:
+        self.size -= previous[1]
+      self.values[key] = (value, size)
+      self.size += size
+      while self.size > self.max_size:
+        evicted_key, (evicted, evicted_size) = self.values.popitem(last=False)
+        self.size -= evicted_size
+        self.nb_evictions += 1
+
+class Upstream:
+  """HTTP client of the elasticsearch at `url`, with a keep-alive
+  connection per thread"""
+
+  def __init__(self, url, timeout=60):
+    parsed = urlparse(url)
+    self.connection_class = HTTPSConnection if parsed.scheme == 'https' else HTTPConnection
+    self.host = parsed.hostname
+    self.port = parsed.port or (443 if parsed.scheme == 'https' else 9200)
+    self.timeout = timeout
+    self.local = threading.local()
+
+  def request(self, method, path, body=None, headers=None):
+    """Returns the (status, headers, body) of the response. A request failing
+    on a connection kept alive is retried once on a new one."""
+    for attempt in (0, 1):
+      connection = getattr(self.local, 'connection', None)
+      if connection is None:
+        connection = self.local.connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+      try:
+        connection.request(method, path, body, headers or {})
+        response = connection.getresponse()
+        return response.status, response.getheaders(), response.read()
+      except (socket.error, HTTPException):
+        connection.close()
+        self.local.connection = None
+        if attempt:
+          raise
+
+class QueryCache:
+  """Answers ``_msearch`` requests, from the cache when possible (see the
+  module documentation).
+
+  :param upstream: The `Upstream` elasticsearch
+  :param max_size: The maximum size of the cached buckets, as json (bytes)
+  :param live_delay: The number of seconds after which a bucket is complete
+  :param block_buckets: The number of buckets of a cached block
+  :param clock: Returns the current time, in seconds
+  """
+
+  def __init__(self, upstream, max_size=DEFAULT_CACHE_SIZE, live_delay=DEFAULT_LIVE_DELAY,
+               block_buckets=BLOCK_BUCKETS, clock=time.time):
+    self.upstream = upstream
+    self.cache = LruCache(max_size)
+    self.live_delay = live_delay
+    self.block_buckets = block_buckets
+    self.clock = clock
+    self.lock = threading.Lock()
+    self.nb_searches = 0
+    self.nb_cached_searches = 0
+    self.cached_buckets = 0
+    self.fetched_buckets = 0
+    self.logger = logging.getLogger('QueryCache')
+
+  def snapshot(self):
+    """Returns the statistics of the cache as a dict"""
+    with self.lock:
+      return {'searches': self.nb_searches, 'cached_searches': self.nb_cached_searches,
+              'cached_buckets': self.cached_buckets, 'fetched_buckets': self.fetched_buckets,
+              'cache_entries': len(self.cache), 'cache_bytes': self.cache.size,
+              'cache_hits': self.cache.nb_hits, 'cache_misses': self.cache.nb_misses,
+              'cache_evictions': self.cache.nb_evictions}
+
+  def plan(self, query):
+    """Returns the segments of the buckets of `query`, in order: either
+    ``('cached', buckets)`` or ``('fetch', start, end, blocks)``, `blocks`
+    being the start of the blocks to cache from the fetched buckets, and the
+    keys (`first`, `end`) between which the buckets of blocks are used.
+    Returns None if no block is closed"""
+    interval = query.interval
+    span = interval * self.block_buckets
+    closed = int((self.clock() - self.live_delay) * 1000) // span * span
+    # The buckets entirely in the range, and in closed blocks
+    first = -(-query.gte // interval) * interval
+    end = min((query.lte + 1) // interval * interval, closed)
+    if end <= first:
+      return None
+
+    segments = []
+    if query.gte < first:
+      segments.append(('fetch', query.gte, first - 1, []))
+    missing = []
+    for block in range(first // span * span, end, span):
+      buckets = self.cache.get((query.key, block))
+      if buckets is None:
+        missing.append(block)
+        continue
+      if missing:
+        segments.append(('fetch', missing[0], missing[-1] + span - 1, missing))
+        missing = []
+      segments.append(('cached', [bucket for bucket in buckets if first <= bucket['key'] < end]))
+    if missing:
+      segments.append(('fetch', missing[0], missing[-1] + span - 1, missing))
+    if end <= query.lte:
+      segments.append(('fetch', end, query.lte, []))
+    return first, end, segments
+
+  def msearch(self, path, searches, params=''):
+    """Returns the (status, body) of the ``_msearch`` of `searches`, a list
+    of (header, body) sent to `path`"""
+    plans = []
+    requests = []
+    for header, body in searches:
+      query = HistogramQuery.parse(header, body, path, params)
+      plan = self.plan(query) if query is not None else None
+      if plan is None:
+        plans.append((None, len(requests), None))
+        requests.append((header, body))
+        continue
+      positions = []
+      first, end, segments = plan
+      for segment in segments:
+        if segment[0] == 'fetch':
+          positions.append(len(requests))
+          requests.append((header, query.piece(segment[1], segment[2])))
+        else:
+          positions.append(None)
+      plans.append((query, positions, plan))
+
+    responses = []
+    if requests:
+      payload = ''.join(json.dumps(header) + '\n' + json.dumps(body) + '\n' for header, body in requests)
+      status, headers, data = self.upstream.request('POST', path + ('?' + params if params else ''),
+                                                    payload.encode('utf-8'),
+                                                    {'Content-Type': 'application/x-ndjson'})
+      if status != 200:
+        return status, data
+      responses = json.loads(data.decode('utf-8'))['responses']
+
+    results = []
+    nb_cached_searches = nb_cached_buckets = nb_fetched_buckets = 0
+    for query, positions, plan in plans:
+      if query is None:
+        results.append(responses[positions])
+        continue
+      fetched = [responses[position] for position in positions if position is not None]
+      failed = [response for response in fetched if 'error' in response or response.get('timed_out')]
+      if failed:
+        results.append(failed[0])
+        continue
+      first, end, segments = plan
+      buckets = []
+      for position, segment in zip(positions, segments):
+        if position is None:
+          buckets.extend(segment[1])
+          nb_cached_buckets += len(segment[1])
+          continue
+        kind, start, stop, blocks = segment
+        segment_buckets = responses[position]['aggregations'][query.name]['buckets']
+        nb_fetched_buckets += len(segment_buckets)
+        if blocks:
+          self.store(query, blocks, segment_buckets)
+          # Blocks may extend beyond the range
+          segment_buckets = [bucket for bucket in segment_buckets if first <= bucket['key'] < end]
+        buckets.extend(segment_buckets)
+      nb_cached_searches += 1
+      results.append(query.merge(buckets, fetched))
+
+    with self.lock:
+      self.nb_searches += len(searches)
+      self.nb_cached_searches += nb_cached_searches
+      self.cached_buckets += nb_cached_buckets
+      self.fetched_buckets += nb_fetched_buckets
+    return 200, json.dumps({'responses': results}).encode('utf-8')
+
+  def store(self, query, blocks, buckets):
+    """Caches the `buckets` fetched for the closed `blocks`"""
+    span = query.interval * self.block_buckets
+    by_block = dict((block, []) for block in blocks)
+    for bucket in buckets:
+      block = bucket['key'] // span * span
+      if block in by_block:
+        by_block[block].append(bucket)
+    for block, block_buckets in by_block.items():
+      self.cache.put((query.key, block), block_buckets, len(json.dumps(block_buckets)))
+
+class ProxyHandler(BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    self.proxy()
+
+  def do_POST(self):
+    self.proxy()
+
+  def do_PUT(self):
+    self.proxy()
+
+  def do_DELETE(self):
+    self.proxy()
+
+  def do_HEAD(self):
+    self.proxy()
+
+  def proxy(self):
+    proxy = self.server.proxy
+    length = int(self.headers.get('Content-Length') or 0)
+    body = self.rfile.read(length) if length else b''
+    path, _, params = self.path.partition('?')
+    parts = [part for part in path.split('/') if part]
+    try:
+      if path == '/_proxy/stats':
+        self.send(200, json.dumps(proxy.cache.snapshot(), sort_keys=True).encode('utf-8'))
+        return
+      searches = None
+      if self.command in ('GET', 'POST') and body and parts and len(parts) <= 3:
+        searches = self.searches(parts, params, body)
+      if searches is None:
+        self.forward(body)
+        return
+      if parts[-1] == '_msearch':
+        status, data = proxy.cache.msearch(path, searches, params)
+      else:
+        status, data = proxy.cache.msearch('/' + '/'.join(parts[:-1] + ['_msearch']), searches)
+        if status == 200:
+          response = json.loads(data.decode('utf-8'))['responses'][0]
+          status = response.pop('status', 200)
+          data = json.dumps(response).encode('utf-8')
+      self.send(status, data)
+    except (socket.error, HTTPException) as e:
+      proxy.logger.warning('Elasticsearch unreachable: ' + str(e))
+      error = {'error': {'type': 'proxy_error', 'reason': str(e)}, 'status': 502}
+      self.send(502, json.dumps(error).encode('utf-8'))
+
+  def searches(self, parts, params, body):
+    """Returns the list of (header, body) of a ``_msearch`` or ``_search``
+    request, or None if it is not one"""
+    try:
+      if self.headers.get('Content-Encoding'):
+        body = decompress(body)
+      if parts[-1] == '_msearch':
+        lines = [json.loads(line) for line in body.decode('utf-8').split('\n') if line.strip()]
+        if len(lines) % 2:
+          return None
+        return [(lines[i], lines[i + 1]) for i in range(0, len(lines), 2)]
+      if parts[-1] == '_search' and not params:
+        return [({}, json.loads(body.decode('utf-8')))]
+    except (ValueError, IOError):
+      pass
+    return None
+
+  def forward(self, body):
+    headers = dict((name, value) for name, value in self.headers.items()
+                   if name.lower() not in ('host', 'connection', 'content-length', 'accept-encoding'))
+    status, response_headers, data = self.server.proxy.upstream.request(self.command, self.path, body or None, headers)
+    self.send(status, data, [(name, value) for name, value in response_headers
+                             if name.lower() not in HOP_HEADERS])
+
+  def send(self, status, data, headers=None):
+    self.send_response(status)
+    if headers is None:
+      headers = [('Content-Type', 'application/json; charset=UTF-8')]
+    for name, value in headers:
+      self.send_header(name, value)
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    if self.command != 'HEAD':
+      self.wfile.write(data)
+
+class QueryProxy(threading.Thread):
+  """Serves the caching proxy of the elasticsearch at `upstream_url` on
+  `bind_host`:`bind_port` (0 picks a free port, available in `port`).
+  ``/_proxy/stats`` returns the statistics of the cache.
+
+  :param max_size: The maximum size of the cached buckets (bytes)
+  :param live_delay: The number of seconds after which a bucket is complete
+  :param clock: Returns the current time, in seconds
+  """
+
+  def __init__(self, bind_host, bind_port, upstream_url, max_size=DEFAULT_CACHE_SIZE,
+               live_delay=DEFAULT_LIVE_DELAY, clock=time.time):
+    threading.Thread.__init__(self, name='QueryProxy: ' + bind_host + ':' + str(bind_port))
+    self.daemon = True
+    self.upstream = Upstream(upstream_url)
+    self.cache = QueryCache(self.upstream, max_size, live_delay, clock=clock)
+    self.httpd = ThreadingHTTPServer((bind_host, bind_port), ProxyHandler)
+    self.httpd.proxy = self
+    self.port = self.httpd.server_address[1]
+    self.logger = logging.getLogger('QueryProxy')
+
+  def run(self):
+    self.logger.info('Proxying ' + self.upstream.host + ':' + str(self.upstream.port) + ' on port ' + str(self.port))
+    self.httpd.serve_forever()
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Caching proxy of the date_histogram queries of dashboards')
+  parser.add_argument("--port", default=DEFAULT_PORT, type=int, help='Port on which to listen (default: ' + str(DEFAULT_PORT) + ')')
+  parser.add_argument("--upstream", default=DEFAULT_UPSTREAM, help='Url of elasticsearch (default: ' + DEFAULT_UPSTREAM + ')')
+  parser.add_argument("--cache-size", default=DEFAULT_CACHE_SIZE // (1024 * 1024), type=int, help='Size of the cache in MB (default: ' + str(DEFAULT_CACHE_SIZE // (1024 * 1024)) + ')')
+  parser.add_argument("--live-delay", default=DEFAULT_LIVE_DELAY, type=float, help='Seconds after which a bucket is complete and can be cached (default: ' + str(DEFAULT_LIVE_DELAY) + ')')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+  proxy = QueryProxy('0.0.0.0', args.port, args.upstream, max_size=args.cache_size * 1024 * 1024,
+                     live_delay=args.live_delay)
+  proxy.run()
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+"""Retries of the documents elasticsearch could not index for now, and
+dead letters for the ones it will never index.
+
+Failures are classified by their status: rejections of an overloaded
+cluster (429), unavailable nodes (502, 503, 504) and connection errors are
+retried with a jittered exponential backoff, while mapping conflicts or
+parse errors (4xx) are permanent.
+"""
+
+import heapq, json, random, threading, time
+
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+
+def is_retryable(status):
+  """Returns whether a bulk item or request failing with `status` may
+  succeed later. Connection errors have no numeric status."""
+  return not isinstance(status, int) or status in RETRYABLE_STATUSES
+
+def error_type(item):
+  """Returns the type of the error of a failed bulk response item, such as
+  ``mapper_parsing_exception``, or its status when it has no type"""
+  result = list(item.values())[0]
+  error = result.get('error')
+  if isinstance(error, dict) and 'type' in error:
+    return error['type']
+  return 'status_' + str(result.get('status'))
+
+class RetryQueue:
+  """Documents waiting to be sent again.
+
+  The n-th retry of a document is delayed by a random duration between 0
+  and ``min(max_delay, base_delay * 2 ** n)`` (full jitter), so that the
+  clients of a recovering cluster do not retry all at once.
+
+  :param base_delay: The maximum delay of the first retry, in seconds
+  :param max_delay: The maximum delay of any retry, in seconds
+  :param max_attempts: The number of retries of a document before it is
+                       given up
+  :param budget: The maximum number of documents waiting to be retried.
+                 Documents failing above it are given up
+  :param seed: Seed of the random generator of the jitter
+  """
+
+  def __init__(self, base_delay=0.5, max_delay=60, max_attempts=5, budget=100000, seed=None):
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.max_attempts = max_attempts
+    self.budget = budget
+    self.random = random.Random(seed)
+    # Heap of (due time, sequence, attempt, documents)
+    self.heap = []
+    self.sequence = 0
+    self.nb_docs = 0
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return self.nb_docs
+
+  def add(self, docs, attempt=0, now=None):
+    """Schedules the retry of `docs` (serialized action and source lines),
+    which failed `attempt` times before.
+
+    :returns: The list of the documents given up, because they were
+              retried `max_attempts` times or the budget is exhausted
+    """
+    if attempt >= self.max_attempts:
+      return docs
+    if now is None:
+      now = time.time()
+    with self.lock:
+      room = max(0, self.budget - self.nb_docs)
+      docs, given_up = docs[:room], docs[room:]
+      if docs:
+        delay = self.random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        heapq.heappush(self.heap, (now + delay, self.sequence, attempt + 1, docs))
+        self.sequence += 1
+        self.nb_docs += len(docs)
+    return given_up
+
+  def due(self, now=None, force=False):
+    """Returns the list of (attempt, documents) due at `now`, or all of them
+    if `force`"""
+    if now is None:
+      now = time.time()
+    due = []
+    with self.lock:
+      while self.heap and (force or self.heap[0][0] <= now):
+        due_time, sequence, attempt, docs = heapq.heappop(self.heap)
+        self.nb_docs -= len(docs)
+        due.append((attempt, docs))
+    return due
+
+  def next_due(self):
+    """Returns the time of the next retry, or None"""
+    with self.lock:
+      return self.heap[0][0] if self.heap else None
+
+class DeadLetterFile:
+  """Appends the documents given up to a file, one json object per line
+  holding the ``error``, the bulk ``action`` and the ``document``.
+
+  :param path: The path of the file
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.file = open(path, 'ab')
+    self.lock = threading.Lock()
+
+  def add(self, failures):
+    """:param failures: A list of (error, serialized document)"""
+    lines = []
+    for error, doc in failures:
+      action, source = doc.decode('utf-8').rstrip('\n').split('\n', 1)
+      lines.append(json.dumps({'error': error, 'action': json.loads(action),
+                               'document': json.loads(source)}, sort_keys=True) + '\n')
+    with self.lock:
+      self.file.write(''.join(lines).encode('utf-8'))
+      self.file.flush()
+
+  def close(self):
+    self.file.close()
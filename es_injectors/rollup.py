@@ -0,0 +1,215 @@
+#!/usr/bin/python
+"""Downsampling of the metrics written by `ElasticsearchSender`.
+
+For every resolution, the documents are grouped by metric (``_type``), tags
+and time bucket, and one document holding the min, max, sum and count of
+the bucket is written into a separate index. The value field of the rollup
+documents keeps the metric name and holds the average, so that the same
+queries can be used on raw and rolled-up indices.
+
+The finest resolution is computed from the raw documents, and each coarser
+resolution from the previous one. The end of the last rolled-up window is
+checkpointed for every resolution, so a new run only reads the new data.
+
+The raw documents are read from their ``_source``, which must be enabled.
+Rollup documents get an ``_id`` derived from their metric, tags and bucket,
+so that a window rolled up again (e.g. after a run stopped before its
+checkpoint) overwrites its documents instead of duplicating them.
+"""
+
+import argparse, hashlib, logging, time
+from elasticsearch import Elasticsearch
+from elasticsearch import helpers
+
+RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+DEFAULT_RESOLUTIONS = ['1m', '1h', '1d']
+
+CHECKPOINT_TYPE = 'checkpoint'
+
+STATS_SUFFIXES = ('_min', '_max', '_sum', '_count', '_last')
+
+def rollup_index_name(index, resolution):
+  """Returns the name of the index of the rollups of `index`. It must not
+  match the pattern of the raw indices."""
+  return 'rollup-' + resolution + '-' + index.rstrip('*-.')
+
+def rollup_id(metric, tags, bucket):
+  """Returns the ``_id`` of the rollup document of `metric`, `tags` (sorted
+  (key, value) pairs) and `bucket`"""
+  key = metric + ''.join(' ' + key + '=' + str(value) for key, value in tags) + ' ' + str(bucket)
+  return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+def rollup_docs(hits, index, resolution):
+  """Groups documents by metric, tags and time bucket, and returns one
+  rollup document for each group.
+
+  :param hits: An iterable of documents, as returned by ``helpers.scan``.
+               Documents holding a ``<metric>_count`` field (rollup
+               documents, or the ones pre-aggregated by the injector) are
+               merged as aggregates
+  :param index: The index in which the rollup documents will be written
+  :param resolution: The name of the resolution (a key of `RESOLUTIONS`)
+  """
+  bucket_size = RESOLUTIONS[resolution] * 1000
+  groups = {}
+  for hit in hits:
+    metric = hit['_type']
+    source = hit['_source']
+    bucket = int(float(source['timestamp'])) // bucket_size * bucket_size
+    tags = tuple(sorted((key, value) for key, value in source.items()
+                        if key != 'timestamp' and key != metric and
+                        not (key.startswith(metric) and key[len(metric):] in STATS_SUFFIXES)))
+    if metric + '_count' in source:
+      # Rollup documents, or documents pre-aggregated by the injector
+      stats = [source[metric + '_min'], source[metric + '_max'],
+               source[metric + '_sum'], source[metric + '_count']]
+    else:
+      value = float(source[metric])
+      stats = [value, value, value, 1]
+
+    key = (metric, tags, bucket)
+    current = groups.get(key)
+    if current is None:
+      groups[key] = stats
+    else:
+      current[0] = min(current[0], stats[0])
+      current[1] = max(current[1], stats[1])
+      current[2] += stats[2]
+      current[3] += stats[3]
+
+  docs = []
+  for (metric, tags, bucket), (minimum, maximum, total, count) in groups.items():
+    source = dict(tags)
+    source['timestamp'] = bucket
+    source[metric] = total / count
+    source[metric + '_min'] = minimum
+    source[metric + '_max'] = maximum
+    source[metric + '_sum'] = total
+    source[metric + '_count'] = count
+    docs.append({'_index': index, '_type': metric, '_id': rollup_id(metric, tags, bucket), '_source': source})
+  return docs
+
+class Rollup:
+  """Rolls up the documents of an index at several resolutions.
+
+  :param es: An Elasticsearch instance
+  :param index: The index (or index pattern) holding the raw documents
+  :param resolutions: The names of the resolutions, see `RESOLUTIONS`
+  :param delete_raw: Delete the raw documents once they have been rolled up
+                     at the finest resolution
+  :param delay: Buckets ending less than `delay` seconds ago are not rolled
+                up yet, to leave some time for late data
+  :param buckets_per_window: The number of buckets read at once. This bounds
+                             the memory used by a run
+  """
+
+  def __init__(self, es, index, resolutions=DEFAULT_RESOLUTIONS, delete_raw=False,
+               delay=60, buckets_per_window=60):
+    self.es = es
+    self.index = index
+    self.resolutions = sorted(resolutions, key=lambda resolution: RESOLUTIONS[resolution])
+    self.delete_raw = delete_raw
+    self.delay = delay
+    self.buckets_per_window = buckets_per_window
+    self.checkpoint_index = rollup_index_name(index, 'checkpoints')
+
+    self.logger = logging.getLogger('Rollup')
+
+  def get_checkpoint(self, resolution):
+    """Returns the end (epoch_millis) of the last window rolled up at
+    `resolution`, or None"""
+    result = self.es.get(index=self.checkpoint_index, doc_type=CHECKPOINT_TYPE, id=resolution, ignore=404)
+    if not result.get('found'):
+      return None
+    return int(result['_source']['timestamp'])
+
+  def set_checkpoint(self, resolution, timestamp):
+    self.es.index(index=self.checkpoint_index, doc_type=CHECKPOINT_TYPE, id=resolution,
+                  body={'timestamp': timestamp}, refresh=True)
+
+  def first_timestamp(self, index):
+    """Returns the smallest timestamp of `index`, or None if it is empty"""
+    if not self.es.indices.exists(index):
+      return None
+    result = self.es.search(index=index, body={'size': 1, 'sort': [{'timestamp': 'asc'}]})
+    hits = result['hits']['hits']
+    if not hits:
+      return None
+    return int(float(hits[0]['_source']['timestamp']))
+
+  def run(self, now=None):
+    """Rolls up all the complete buckets not rolled up yet, for every
+    resolution. Returns the number of rollup documents written."""
+    if now is None:
+      now = time.time()
+    end = int((now - self.delay) * 1000)
+
+    nb_docs = 0
+    source_index = self.index
+    from_rollup = False
+    for resolution in self.resolutions:
+      bucket_size = RESOLUTIONS[resolution] * 1000
+      resolution_end = end // bucket_size * bucket_size
+      nb_docs += self.run_resolution(resolution, source_index, from_rollup, resolution_end)
+
+      # Coarser resolutions are computed from this one, and can not go further
+      source_index = rollup_index_name(self.index, resolution)
+      from_rollup = True
+      checkpoint = self.get_checkpoint(resolution)
+      if checkpoint is None:
+        break
+      end = checkpoint
+    return nb_docs
+
+  def run_resolution(self, resolution, source_index, from_rollup, end):
+    bucket_size = RESOLUTIONS[resolution] * 1000
+    window_size = bucket_size * self.buckets_per_window
+    target_index = rollup_index_name(self.index, resolution)
+
+    start = self.get_checkpoint(resolution)
+    if start is None:
+      start = self.first_timestamp(source_index)
+      if start is None:
+        return 0
+      start = start // bucket_size * bucket_size
+
+    nb_docs = 0
+    while start < end:
+      window_end = min(start + window_size, end)
+      query = {'query': {'range': {'timestamp': {'gte': start, 'lt': window_end}}}}
+      hits = list(helpers.scan(self.es, index=source_index, query=query))
+
+      docs = rollup_docs(hits, target_index, resolution)
+      nb_success, errors = helpers.bulk(self.es, docs, raise_on_error=False)
+      if errors:
+        self.logger.error('Rollup ' + resolution + ' of [' + str(start) + ', ' + str(window_end) +
+                          '[ failed: ' + str(errors))
+        return nb_docs
+      nb_docs += nb_success
+
+      if self.delete_raw and not from_rollup:
+        deletions = ({'_op_type': 'delete', '_index': hit['_index'], '_type': hit['_type'], '_id': hit['_id']}
+                     for hit in hits)
+        helpers.bulk(self.es, deletions, raise_on_error=False)
+
+      self.set_checkpoint(resolution, window_end)
+      self.logger.info('Rolled up ' + str(len(hits)) + ' documents into ' + str(nb_success) +
+                       ' at ' + resolution + ' until ' + str(window_end))
+      start = window_end
+    return nb_docs
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--index", default='test-metrics', help='Index of the raw metrics (default: test-metrics)')
+  parser.add_argument("--resolutions", default=','.join(DEFAULT_RESOLUTIONS),
+                      help='Comma separated resolutions among ' + ', '.join(sorted(RESOLUTIONS)))
+  parser.add_argument("--delete-raw", action="store_true", help='Delete the raw documents once rolled up')
+  parser.add_argument("--delay", default=60, type=int, help='Seconds to wait for late data (default: 60)')
+  args = parser.parse_args()
+
+  logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+  rollup = Rollup(Elasticsearch(), args.index, args.resolutions.split(','),
+                  delete_raw=args.delete_raw, delay=args.delay)
+  logging.info('Written ' + str(rollup.run()) + ' rollup documents')
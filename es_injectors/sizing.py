@@ -0,0 +1,79 @@
+#!/usr/bin/python
+"""Sizing of the bulk requests from the latency elasticsearch answers them
+with.
+
+Small requests waste round trips, and large ones take long to answer and
+use a lot of the memory of the cluster. The number of documents per
+request is adapted so that requests are answered in about a target
+latency, and halved as soon as the cluster rejects documents (429), like
+the congestion window of TCP.
+"""
+
+import threading
+
+class AdaptiveChunkSize:
+  """The number of documents per bulk request (`chunk_size`), adapted from
+  the responses reported to `observe()`.
+
+  The latency a request of `chunk_size` documents would have is estimated
+  from each response, assuming it grows linearly with the number of
+  documents, and smoothed. When it is away from `target_latency` by more
+  than `tolerance`, `chunk_size` is multiplied by their ratio, but grows by
+  at most `max_growth` at once.
+
+  :param target_latency: The latency of a request to aim for, in seconds
+  :param initial: The initial number of documents per request
+  :param minimum: The minimum number of documents per request
+  :param maximum: The maximum number of documents per request
+  :param max_growth: The maximum growth of the size at once
+  :param smoothing: The weight of the last response in the estimated latency
+  :param tolerance: The relative distance to the target within which the
+                    size does not change
+  """
+
+  def __init__(self, target_latency=1.0, initial=500, minimum=50, maximum=20000, max_growth=1.25,
+               smoothing=0.3, tolerance=0.1):
+    self.target_latency = target_latency
+    self.minimum = minimum
+    self.maximum = maximum
+    self.max_growth = max_growth
+    self.smoothing = smoothing
+    self.tolerance = tolerance
+    self.chunk_size = max(minimum, min(maximum, initial))
+    # The estimated latency of a request of `chunk_size` documents
+    self.latency = None
+    self.nb_backoffs = 0
+    self.lock = threading.Lock()
+
+  def observe(self, duration, nb_docs, nb_rejected=0):
+    """Adapts the size to a response received after `duration` seconds, for
+    a request of `nb_docs` documents, `nb_rejected` of which were rejected
+    by an overloaded cluster.
+
+    Requests of less than half `chunk_size` documents (e.g. the end of a
+    batch) only count for their rejections: their latency is mostly the
+    overhead of a request."""
+    with self.lock:
+      if nb_rejected:
+        self.chunk_size = max(self.minimum, self.chunk_size // 2)
+        self.latency = None
+        self.nb_backoffs += 1
+        return
+      if nb_docs * 2 < self.chunk_size:
+        return
+      latency = duration * self.chunk_size / nb_docs
+      if self.latency is None:
+        self.latency = latency
+      else:
+        self.latency += self.smoothing * (latency - self.latency)
+      if self.latency <= 0:
+        ratio = self.max_growth
+      else:
+        ratio = self.target_latency / self.latency
+      if abs(ratio - 1) <= self.tolerance:
+        return
+      chunk_size = max(self.minimum, min(self.maximum, int(self.chunk_size * min(ratio, self.max_growth))))
+      if chunk_size != self.chunk_size:
+        # Estimated for the new size
+        self.latency = self.latency * chunk_size / self.chunk_size
+        self.chunk_size = chunk_size
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+"""A write-ahead spool keeping on disk the bulk requests that have not been
+acknowledged by elasticsearch yet.
+
+Records are appended to segment files, and read back in the same order.
+The position of the first record not acknowledged (the head) is saved in the
+``head`` file, and segments are deleted once all their records have been
+acknowledged. A record is::
+
+  length (4 bytes) | crc32 (4 bytes) | payload (length bytes)
+"""
+
+import os, struct, zlib, logging
+
+HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.spool'
+HEAD_FILE = 'head'
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+class Spool:
+  """An append-only queue of records, split in segment files of
+  `segment_size` bytes.
+
+  Positions are (segment, offset) tuples. `append()` returns the position
+  following the records written, which can be given to `ack()` once they
+  have been indexed. The position following each record is the same
+  whether it is returned by `append()` or by `read()`.
+
+  :param directory: The directory of the segment files
+  :param segment_size: The size above which a new segment file is started
+  :param max_size: The maximum size of all the segments. When it is
+                   exceeded, the oldest segments are deleted, even if their
+                   records were not acknowledged
+  :param write_buffer: The size of the write buffer of the segment file
+  """
+
+  def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, max_size=DEFAULT_MAX_SIZE,
+               write_buffer=1024 * 1024):
+    self.directory = directory
+    self.segment_size = segment_size
+    self.max_size = max_size
+    self.write_buffer = write_buffer
+    self.nb_dropped = 0
+    self.logger = logging.getLogger('Spool')
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                           if name.endswith(SEGMENT_SUFFIX))
+    self.sizes = dict((segment, os.path.getsize(self.segment_path(segment)))
+                      for segment in self.segments)
+
+    self.head = self.read_head()
+    if self.head is None or self.head[0] not in self.sizes:
+      self.head = (self.segments[0], 0) if self.segments else (0, 0)
+
+    # A new segment is started at each run, so that a record partially
+    # written before a crash is always at the end of a segment
+    self.file = None
+    self.open_segment(self.segments[-1] + 1 if self.segments else 0)
+
+  def segment_path(self, segment):
+    return os.path.join(self.directory, '%016d' % segment + SEGMENT_SUFFIX)
+
+  def open_segment(self, segment):
+    if self.file is not None:
+      self.file.close()
+    self.file = open(self.segment_path(segment), 'ab', self.write_buffer)
+    self.segments.append(segment)
+    self.sizes[segment] = 0
+    if self.empty():
+      self.head = (segment, 0)
+
+  def read_head(self):
+    try:
+      with open(os.path.join(self.directory, HEAD_FILE)) as head_file:
+        segment, offset = head_file.read().split()
+        return (int(segment), int(offset))
+    except (IOError, OSError, ValueError):
+      return None
+
+  def write_head(self):
+    path = os.path.join(self.directory, HEAD_FILE)
+    with open(path + '.tmp', 'w') as head_file:
+      head_file.write(str(self.head[0]) + ' ' + str(self.head[1]))
+    os.rename(path + '.tmp', path)
+
+  @property
+  def tail(self):
+    return (self.segments[-1], self.sizes[self.segments[-1]])
+
+  @property
+  def size(self):
+    return sum(self.sizes.values())
+
+  def empty(self):
+    return self.head == self.tail
+
+  def append(self, payloads, positions=None):
+    """Writes `payloads` (an iterable of bytes) at the end of the spool.
+
+    :param positions: An optional list, to which the position after each
+                      record is appended
+    :returns: The position after the last record written
+    """
+    for payload in payloads:
+      if self.sizes[self.segments[-1]] >= self.segment_size:
+        self.open_segment(self.segments[-1] + 1)
+      self.file.write(HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+      self.sizes[self.segments[-1]] += HEADER.size + len(payload)
+      if positions is not None:
+        positions.append(self.tail)
+    self.file.flush()
+
+    while self.size > self.max_size and len(self.segments) > 1:
+      self.drop_oldest_segment()
+    return self.tail
+
+  def drop_oldest_segment(self):
+    segment = self.segments[0]
+    if self.head[0] == segment:
+      self.nb_dropped += 1
+      self.logger.error('Spool larger than ' + str(self.max_size) + ' bytes, dropping ' +
+                        self.segment_path(segment))
+      self.head = (self.segments[1], 0)
+      self.write_head()
+    del self.segments[0]
+    del self.sizes[segment]
+    os.remove(self.segment_path(segment))
+
+  def ack(self, position):
+    """Acknowledges all the records before `position`, which is a position
+    returned by `append()` or `read()`. Positions before the head (e.g. in
+    a segment dropped meanwhile) are ignored."""
+    segment, offset = position
+    if segment in self.sizes and segment != self.segments[-1] and offset >= self.sizes[segment]:
+      # The end of a segment is the start of the next one
+      position = (self.segments[self.segments.index(segment) + 1], 0)
+    if position < self.head:
+      return
+    self.head = position
+    while self.segments[0] < position[0]:
+      self.drop_oldest_segment()
+    self.write_head()
+
+  def read(self, max_records):
+    """Returns up to `max_records` records starting from the head, as a list
+    of (payload, position after the record). Corrupted or incomplete records
+    end their segment."""
+    records = []
+    segment, offset = self.head
+    while len(records) < max_records and (segment, offset) != self.tail:
+      if offset >= self.sizes[segment]:
+        segment, offset = self.segments[self.segments.index(segment) + 1], 0
+        continue
+      with open(self.segment_path(segment), 'rb') as segment_file:
+        segment_file.seek(offset)
+        while len(records) < max_records and offset < self.sizes[segment]:
+          header = segment_file.read(HEADER.size)
+          if len(header) < HEADER.size:
+            offset = self.sizes[segment]
+            break
+          length, crc = HEADER.unpack(header)
+          payload = segment_file.read(length)
+          if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+            self.logger.error('Corrupted record in ' + self.segment_path(segment) + ' at ' + str(offset))
+            offset = self.sizes[segment]
+            break
+          offset += HEADER.size + length
+          records.append((payload, (segment, offset)))
+    if not records and (segment, offset) != self.head:
+      # Only corrupted records were found
+      self.ack((segment, offset))
+    return records
+
+  def close(self):
+    self.file.close()
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+"""Runtime statistics of the injector: counters, gauges and histograms.
+
+They are reported as tcollector lines (``metric timestamp value tags``),
+through the ``stats`` command of the line protocol or the optional HTTP
+endpoint served by `StatsServer`, or as json.
+"""
+
+import bisect, json, re, threading, time, logging
+try:
+  from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+  from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+PREFIX = 'es_injector'
+
+# The characters OpenTSDB rejects in tag values, e.g. the ':' of the
+# connections (ip:port)
+INVALID_TAG_CHARACTERS = re.compile(r'[^-\w./]')
+
+# Upper bounds of the histogram buckets
+DURATION_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+SIZE_BUCKETS = [1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000]
+
+class Histogram:
+  """Counts values in fixed buckets. Percentiles are approximated by the
+  upper bound of their bucket.
+
+  :param bounds: The sorted upper bounds of the buckets. Larger values are
+                 counted in an additional bucket
+  """
+
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.sum = 0
+    self.max = 0
+
+  def add(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.sum += value
+    if value > self.max:
+      self.max = value
+
+  def percentile(self, ratio):
+    if not self.count:
+      return 0
+    rank = ratio * self.count
+    seen = 0
+    for i, count in enumerate(self.counts):
+      seen += count
+      if seen >= rank:
+        return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+    return self.max
+
+  def snapshot(self):
+    return {'count': self.count, 'sum': self.sum, 'max': self.max,
+            'p50': self.percentile(0.5), 'p90': self.percentile(0.9), 'p99': self.percentile(0.99)}
+
+class Stats:
+  """Statistics shared by the servers, client connections and sender.
+  Updates are done once per batch of lines, not once per line."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.start_time = time.time()
+    self.lines_received = 0
+    self.connections = {}
+    self.docs_accepted = 0
+    self.parse_errors = {}
+    self.docs_indexed = 0
+    self.bulk_errors = 0
+    self.bulk_bytes = 0
+    self.duplicates = 0
+    self.retries = 0
+    self.dead_letters = {}
+    self.flush_duration = Histogram(DURATION_BUCKETS)
+    self.flush_docs = Histogram(SIZE_BUCKETS)
+    # Callables returning the current value of a gauge
+    self.gauges = {}
+
+  def add_lines(self, connection, nb_lines):
+    """Counts `nb_lines` received from `connection` (a string)"""
+    with self.lock:
+      self.lines_received += nb_lines
+      self.connections[connection] = self.connections.get(connection, 0) + nb_lines
+
+  def connection_closed(self, connection):
+    with self.lock:
+      self.connections.pop(connection, None)
+
+  def add_docs(self, nb_docs, parse_errors):
+    """Counts the documents accepted, and the invalid lines by reason"""
+    with self.lock:
+      self.docs_accepted += nb_docs
+      for reason, count in parse_errors.items():
+        self.parse_errors[reason] = self.parse_errors.get(reason, 0) + count
+
+  def add_flush(self, duration, nb_docs, nb_errors, nb_duplicates=0):
+    """Records a batch shipped in `duration` seconds, from which
+    `nb_duplicates` points were dropped"""
+    with self.lock:
+      self.duplicates += nb_duplicates
+      self.flush_duration.add(duration * 1000)
+      self.flush_docs.add(nb_docs)
+      self.docs_indexed += nb_docs - nb_errors
+      self.bulk_errors += nb_errors
+
+  def add_bulk_bytes(self, nb_bytes):
+    """Counts the bytes of a bulk request body, as sent (compressed or not)"""
+    with self.lock:
+      self.bulk_bytes += nb_bytes
+
+  def add_retries(self, nb_docs):
+    """Counts documents scheduled to be sent again"""
+    with self.lock:
+      self.retries += nb_docs
+
+  def add_dead_letters(self, counts):
+    """Counts the documents given up, by error type"""
+    with self.lock:
+      for name, count in counts.items():
+        self.dead_letters[name] = self.dead_letters.get(name, 0) + count
+
+  def snapshot(self):
+    """Returns all the statistics as a dict"""
+    with self.lock:
+      snapshot = {
+        'uptime': time.time() - self.start_time,
+        'lines_received': self.lines_received,
+        'connections': dict(self.connections),
+        'docs_accepted': self.docs_accepted,
+        'parse_errors': dict(self.parse_errors),
+        'docs_indexed': self.docs_indexed,
+        'bulk_errors': self.bulk_errors,
+        'bulk_bytes': self.bulk_bytes,
+        'duplicates': self.duplicates,
+        'retries': self.retries,
+        'dead_letters': dict(self.dead_letters),
+        'flush_duration_ms': self.flush_duration.snapshot(),
+        'flush_docs': self.flush_docs.snapshot(),
+      }
+    for name, gauge in self.gauges.items():
+      snapshot[name] = gauge()
+    return snapshot
+
+  def lines(self, timestamp=None, prefix=PREFIX):
+    """Returns the statistics as tcollector lines"""
+    if timestamp is None:
+      timestamp = int(time.time())
+    snapshot = self.snapshot()
+    lines = []
+
+    def add(name, value, tag=None, tag_value=None):
+      line = prefix + '.' + name + ' ' + str(timestamp) + ' ' + str(value)
+      if tag is not None:
+        line += ' ' + tag + '=' + INVALID_TAG_CHARACTERS.sub('_', tag_value)
+      lines.append(line)
+
+    for name, value in sorted(snapshot.items()):
+      if name == 'connections':
+        add('connections', len(value))
+        for connection, nb_lines in sorted(value.items()):
+          add('connection.lines_received', nb_lines, 'connection', connection)
+      elif name == 'parse_errors' or name == 'dead_letters':
+        for reason, count in sorted(value.items()):
+          add(name, count, 'reason', reason)
+      elif isinstance(value, dict):
+        for key, histogram_value in sorted(value.items()):
+          add(name, histogram_value, 'type', key)
+      else:
+        add(name, value)
+    return lines
+
+class StatsHandler(BaseHTTPRequestHandler):
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    stats = self.server.stats
+    if self.path == '/stats':
+      body = ''.join(line + '\n' for line in stats.lines())
+      content_type = 'text/plain'
+    elif self.path == '/stats.json':
+      body = json.dumps(stats.snapshot(), sort_keys=True)
+      content_type = 'application/json'
+    else:
+      self.send_error(404)
+      return
+    body = body.encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+class StatsServer(threading.Thread):
+  """Serves the statistics over HTTP: ``/stats`` as tcollector lines and
+  ``/stats.json`` as json."""
+
+  def __init__(self, bind_host, bind_port, stats):
+    threading.Thread.__init__(self, name='StatsServer: ' + bind_host + ':' + str(bind_port))
+    self.daemon = True
+    self.httpd = HTTPServer((bind_host, bind_port), StatsHandler)
+    self.httpd.stats = stats
+    self.port = self.httpd.server_address[1]
+    self.logger = logging.getLogger('StatsServer')
+
+  def run(self):
+    self.logger.info('Serving statistics on port ' + str(self.port))
+    self.httpd.serve_forever()
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+"""Runs the injector in several processes, to use more than one core.
+
+Every worker binds the same port with ``SO_REUSEPORT``, so that the kernel
+spreads the incoming connections between them, and has its own server and
+sender. The parent process only supervises them: SIGTERM and SIGINT are
+forwarded to the workers, which flush their buffers before exiting.
+"""
+
+import os, signal, logging, time
+
+# Minimum delay between two restarts of a worker which keeps dying (seconds)
+RESTART_DELAY = 1
+
+class Workers:
+  """Forks `nb_workers` processes, each calling ``target(worker_id)``.
+
+  :param nb_workers: The number of processes
+  :param target: The function run by each worker. It should return once
+                 the worker received SIGTERM and flushed its buffer
+  :param restart: Restart the workers exiting before being stopped
+  """
+
+  def __init__(self, nb_workers, target, restart=True):
+    self.nb_workers = nb_workers
+    self.target = target
+    self.restart = restart
+    # pid -> worker id
+    self.pids = {}
+    self.stopping = False
+    self.logger = logging.getLogger('Workers')
+
+  def start(self, worker_id):
+    pid = os.fork()
+    if pid == 0:
+      # The parent forwards the signals: a Ctrl-C on the terminal must not
+      # interrupt the workers in the middle of a flush
+      signal.signal(signal.SIGINT, signal.SIG_IGN)
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      status = 0
+      try:
+        self.target(worker_id)
+      except BaseException:
+        self.logger.exception('Worker ' + str(worker_id) + ' failed')
+        status = 1
+      finally:
+        logging.shutdown()
+        os._exit(status)
+    self.pids[pid] = worker_id
+    self.logger.info('Started worker ' + str(worker_id) + ' (pid ' + str(pid) + ')')
+
+  def stop(self, signum=None, frame=None):
+    """Asks every worker to flush and exit"""
+    self.stopping = True
+    for pid in list(self.pids):
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except OSError:
+        pass
+
+  def run(self):
+    """Starts the workers and waits until they all exited. Returns the
+    number of workers which exited with an error."""
+    signal.signal(signal.SIGTERM, self.stop)
+    signal.signal(signal.SIGINT, self.stop)
+    for worker_id in range(0, self.nb_workers):
+      self.start(worker_id)
+
+    nb_failed = 0
+    started = dict((worker_id, time.time()) for worker_id in range(0, self.nb_workers))
+    while self.pids:
+      try:
+        pid, status = os.wait()
+      except OSError:
+        break
+      worker_id = self.pids.pop(pid, None)
+      if worker_id is None:
+        continue
+      if status:
+        nb_failed += 1
+      self.logger.info('Worker ' + str(worker_id) + ' (pid ' + str(pid) + ') exited with status ' + str(status))
+      if self.restart and not self.stopping:
+        time.sleep(max(0, started[worker_id] + RESTART_DELAY - time.time()))
+        started[worker_id] = time.time()
+        if not self.stopping:
+          self.start(worker_id)
+    return nb_failed
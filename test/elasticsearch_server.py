@@ -0,0 +1,226 @@
+"""A lightweight in-process HTTP server standing in for an elasticsearch
+cluster, to test and load-test the injector on a single machine.
+
+It implements the bulk, count, index creation/deletion/existence, template,
+flush/refresh and sniffing endpoints. Indexed documents are only counted
+(documents with an ``_id`` already indexed are counted once).
+Latency, 429 rejections and partial item failures can be injected.
+"""
+
+import json, random, threading, time, gzip, zlib, fnmatch, io
+try:
+  from http.server import HTTPServer, BaseHTTPRequestHandler
+  from socketserver import ThreadingMixIn
+except ImportError:
+  from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+  from SocketServer import ThreadingMixIn
+
+VERSION = '6.8.0'
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class ElasticsearchHandler(BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    self.dispatch('GET')
+
+  def do_POST(self):
+    self.dispatch('POST')
+
+  def do_PUT(self):
+    self.dispatch('PUT')
+
+  def do_DELETE(self):
+    self.dispatch('DELETE')
+
+  def do_HEAD(self):
+    self.dispatch('HEAD')
+
+  def read_body(self):
+    length = int(self.headers.get('Content-Length') or 0)
+    body = self.rfile.read(length) if length else b''
+    if self.headers.get('Content-Encoding') == 'gzip':
+      body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+    elif self.headers.get('Content-Encoding') == 'deflate':
+      body = zlib.decompress(body)
+    return body
+
+  def send_json(self, status, response=None):
+    body = json.dumps(response).encode('utf-8') if response is not None else b''
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json; charset=UTF-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    if self.command != 'HEAD':
+      self.wfile.write(body)
+
+  def dispatch(self, method):
+    server = self.server.elasticsearch
+    path = self.path.split('?')[0]
+    parts = [part for part in path.split('/') if part]
+    body = self.read_body()
+    status, response = server.handle(method, parts, body)
+    self.send_json(status, response)
+
+class ElasticsearchServer(threading.Thread):
+  """Serves a fake elasticsearch cluster on `host`:`port` (0 picks a free
+  port, available in `port` once started).
+
+  :param latency: Seconds waited before answering each bulk request
+  :param doc_latency: Seconds waited more for each document of a bulk request
+  :param reject_ratio: Ratio of bulk requests rejected with a 429 status
+  :param item_failure_ratio: Ratio of bulk items failing with a 400 status
+  :param item_reject_ratio: Ratio of bulk items rejected with a 429 status
+  :param seed: Seed of the random generator used for the failures
+  """
+
+  def __init__(self, host='127.0.0.1', port=0, latency=0, reject_ratio=0, item_failure_ratio=0, seed=0,
+               item_reject_ratio=0, doc_latency=0):
+    threading.Thread.__init__(self, name='ElasticsearchServer')
+    self.daemon = True
+    self.latency = latency
+    self.doc_latency = doc_latency
+    self.reject_ratio = reject_ratio
+    self.item_failure_ratio = item_failure_ratio
+    self.item_reject_ratio = item_reject_ratio
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+
+    self.indices = {}
+    # index -> ids of the documents indexed with an _id
+    self.ids = {}
+    self.templates = {}
+    self.nb_bulk_requests = 0
+    self.nb_rejected = 0
+    self.nb_failed_items = 0
+    self.nb_rejected_items = 0
+
+    self.httpd = ThreadingHTTPServer((host, port), ElasticsearchHandler)
+    self.httpd.elasticsearch = self
+    self.host, self.port = self.httpd.server_address[:2]
+
+  @property
+  def url(self):
+    return 'http://' + self.host + ':' + str(self.port)
+
+  def run(self):
+    self.httpd.serve_forever(poll_interval=0.1)
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+  def count(self, index=None):
+    """Returns the number of documents in the indices matching `index`,
+    which can hold wildcards and commas"""
+    with self.lock:
+      return sum(count for name, count in self.indices.items() if self.matches(name, index))
+
+  @staticmethod
+  def matches(name, pattern):
+    if pattern is None or pattern in ('_all', '*'):
+      return True
+    return any(fnmatch.fnmatch(name, part) for part in pattern.split(','))
+
+  def handle(self, method, parts, body):
+    """Returns the (status, json response) of a request"""
+    if not parts:
+      return 200, {'name': 'fake', 'cluster_name': 'fake',
+                   'version': {'number': VERSION}, 'tagline': 'You Know, for Search'}
+    if parts[-1] == '_bulk':
+      return self.bulk(parts[0] if len(parts) > 1 else None, body)
+    if parts[-1] == '_count':
+      return 200, {'count': self.count(parts[0] if len(parts) > 1 else None),
+                   '_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+    if parts[0] == '_nodes':
+      return 200, {'cluster_name': 'fake', 'nodes': {'fake': {
+        'name': 'fake', 'version': VERSION, 'roles': ['master', 'data', 'ingest'],
+        'http': {'publish_address': self.host + ':' + str(self.port)}}}}
+    if parts[0] == '_template' and len(parts) == 2:
+      if method == 'PUT':
+        self.templates[parts[1]] = json.loads(body.decode('utf-8'))
+        return 200, {'acknowledged': True}
+      if parts[1] in self.templates:
+        return 200, {parts[1]: self.templates[parts[1]]}
+      return 404, {}
+    if parts[-1] in ('_flush', '_refresh'):
+      return 200, {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+    if len(parts) == 1:
+      return self.index(method, parts[0])
+    return 400, {'error': 'Unsupported request: ' + method + ' /' + '/'.join(parts), 'status': 400}
+
+  def index(self, method, name):
+    with self.lock:
+      if method == 'HEAD' or method == 'GET':
+        if any(self.matches(index, name) for index in self.indices):
+          return 200, {}
+        return 404, None
+      if method == 'PUT':
+        if name in self.indices:
+          return 400, {'error': {'type': 'resource_already_exists_exception'}, 'status': 400}
+        self.indices[name] = 0
+        return 200, {'acknowledged': True}
+      if method == 'DELETE':
+        deleted = [index for index in self.indices if self.matches(index, name)]
+        if not deleted:
+          return 404, {'error': {'type': 'index_not_found_exception'}, 'status': 404}
+        for index in deleted:
+          del self.indices[index]
+          self.ids.pop(index, None)
+        return 200, {'acknowledged': True}
+    return 400, {'error': 'Unsupported request: ' + method + ' /' + name, 'status': 400}
+
+  def bulk(self, default_index, body):
+    if self.latency or self.doc_latency:
+      time.sleep(self.latency + self.doc_latency * (body.count(b'\n') // 2))
+
+    with self.lock:
+      self.nb_bulk_requests += 1
+      if self.reject_ratio and self.random.random() < self.reject_ratio:
+        self.nb_rejected += 1
+        return 429, {'error': {'type': 'es_rejected_execution_exception'}, 'status': 429}
+
+    lines = body.decode('utf-8').splitlines()
+    items, errors, i = [], False, 0
+    while i < len(lines):
+      if not lines[i]:
+        i += 1
+        continue
+      action = json.loads(lines[i])
+      op_type, meta = list(action.items())[0]
+      index = meta.get('_index', default_index)
+      i += 1 if op_type == 'delete' else 2
+
+      with self.lock:
+        if self.item_failure_ratio and self.random.random() < self.item_failure_ratio:
+          self.nb_failed_items += 1
+          errors = True
+          items.append({op_type: {'_index': index, 'status': 400,
+                                  'error': {'type': 'mapper_parsing_exception', 'reason': 'injected failure'}}})
+          continue
+        if self.item_reject_ratio and self.random.random() < self.item_reject_ratio:
+          self.nb_rejected_items += 1
+          errors = True
+          items.append({op_type: {'_index': index, 'status': 429,
+                                  'error': {'type': 'es_rejected_execution_exception', 'reason': 'injected rejection'}}})
+          continue
+        if op_type == 'delete':
+          self.indices[index] = max(0, self.indices.get(index, 0) - 1)
+          items.append({op_type: {'_index': index, 'status': 200}})
+        elif '_id' in meta and meta['_id'] in self.ids.setdefault(index, set()):
+          # Overwritten
+          items.append({op_type: {'_index': index, '_id': meta['_id'], 'status': 200}})
+        else:
+          if '_id' in meta:
+            self.ids[index].add(meta['_id'])
+          self.indices[index] = self.indices.get(index, 0) + 1
+          items.append({op_type: {'_index': index, 'status': 201}})
+
+    return 200, {'took': 1, 'errors': errors, 'items': items}
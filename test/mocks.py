@@ -1,5 +1,5 @@
 
-import logging
+import logging, fnmatch
 
 class MockLoggingHandler(logging.Handler):
   """Mock logging handler to check for expected logs.
@@ -30,4 +30,152 @@ class MockLoggingHandler(logging.Handler):
       self.release()
 
   def __str__(self):
-    return str(self.messages)
\ No newline at end of file
+    return str(self.messages)
+
+class MockTransport(object):
+  """Mock transport only implementing compressed bulk requests, whose
+  ``Content-Encoding`` are available in ``encodings``"""
+
+  def __init__(self, es):
+    from elasticsearch.serializer import JSONSerializer
+    self.serializer = JSONSerializer()
+    self.es = es
+    self.encodings = []
+
+  def perform_request(self, method, url, headers=None, params=None, body=None):
+    import zlib
+    assert (method, url) == ('POST', '/_bulk')
+    self.encodings.append(headers.get('content-encoding'))
+    return self.es.bulk(zlib.decompress(body, 32 + zlib.MAX_WBITS))
+
+class MockElasticsearch(object):
+  """Mock elasticsearch client only implementing the bulk API.
+
+  Every bulk body received is available in ``bodies``, the action lines in
+  ``actions`` and the documents in ``docs``. Each item is reported as created.
+  A connection error is raised while ``unavailable`` is True.
+  """
+
+  def __init__(self):
+    self.transport = MockTransport(self)
+    self.bodies = []
+    self.actions = []
+    self.docs = []
+    self.unavailable = False
+
+  def bulk(self, body, *args, **kwargs):
+    if self.unavailable:
+      from elasticsearch import ConnectionError
+      raise ConnectionError('N/A', 'Connection refused', None)
+    if isinstance(body, bytes):
+      body = body.decode('utf-8')
+    self.bodies.append(body)
+    lines = body.splitlines()
+    items = []
+    for i in range(0, len(lines), 2):
+      self.actions.append(self.transport.serializer.loads(lines[i]))
+      self.docs.append(self.transport.serializer.loads(lines[i + 1]))
+      items.append({'index': {'status': 201}})
+    return {'errors': False, 'items': items}
+
+class MockIndices(object):
+
+  def __init__(self, es):
+    self.es = es
+
+  def exists(self, index):
+    return bool(self.es.matching(index))
+
+class MockDocumentsElasticsearch(object):
+  """Mock elasticsearch client keeping the documents in memory, for the
+  clients reading what they wrote (e.g. `rollup.Rollup`).
+
+  It implements the bulk (index and delete), index, get, indices.exists and
+  search APIs. Searches support ``range`` queries on ``timestamp``, a sort
+  on ``timestamp`` and scrolls, which return every hit at once. Documents
+  are available in ``documents``: index -> _id -> (_type, _source).
+  """
+
+  def __init__(self):
+    self.transport = MockTransport(self)
+    self.indices = MockIndices(self)
+    self.documents = {}
+    self.nb_ids = 0
+
+  def matching(self, index):
+    return [name for name in sorted(self.documents) if fnmatch.fnmatch(name, index)]
+
+  def bulk(self, body, *args, **kwargs):
+    lines = [self.transport.serializer.loads(line) for line in body.splitlines() if line.strip()]
+    items = []
+    while lines:
+      (op_type, action), = lines.pop(0).items()
+      if op_type == 'delete':
+        found = self.documents.get(action['_index'], {}).pop(action['_id'], None) is not None
+        items.append({'delete': {'_id': action['_id'], 'status': 200 if found else 404}})
+        continue
+      result = self.index(action['_index'], action['_type'], lines.pop(0), id=action.get('_id'))
+      items.append({op_type: {'_id': result['_id'], 'status': 201}})
+    return {'errors': False, 'items': items}
+
+  def index(self, index, doc_type, body, id=None, **kwargs):
+    if id is None:
+      self.nb_ids += 1
+      id = 'id' + str(self.nb_ids)
+    self.documents.setdefault(index, {})[id] = (doc_type, body)
+    return {'_id': id, 'result': 'created'}
+
+  def get(self, index, doc_type, id, **kwargs):
+    document = self.documents.get(index, {}).get(id)
+    if document is None:
+      return {'found': False}
+    return {'found': True, '_id': id, '_source': document[1]}
+
+  def search(self, index, body=None, scroll=None, size=10, **kwargs):
+    hits = []
+    bounds = (body or {}).get('query', {}).get('range', {}).get('timestamp', {})
+    for name in self.matching(index):
+      for id, (doc_type, source) in self.documents[name].items():
+        timestamp = source['timestamp']
+        if timestamp < bounds.get('gte', timestamp) or timestamp >= bounds.get('lt', timestamp + 1):
+          continue
+        hits.append({'_index': name, '_type': doc_type, '_id': id, '_source': source})
+    if body and body.get('sort') != '_doc' and 'sort' in body:
+      hits.sort(key=lambda hit: hit['_source']['timestamp'])
+    response = {'_shards': {'total': 1, 'successful': 1}, 'hits': {'total': len(hits), 'hits': hits}}
+    if scroll is not None:
+      response['_scroll_id'] = 'scroll'
+    else:
+      response['hits']['hits'] = hits[:(body or {}).get('size', size)]
+    return response
+
+  def scroll(self, *args, **kwargs):
+    return {'_shards': {'total': 1, 'successful': 1}, 'hits': {'total': 0, 'hits': []}}
+
+  def clear_scroll(self, *args, **kwargs):
+    return {}
+
+class MockInjector(object):
+  """Mock injector recording every ``push`` call in ``pushes``, and
+  answering to ``version`` like `ElasticsearchSender`."""
+
+  def __init__(self):
+    import threading
+    self.pushes = []
+    self.flushed = False
+    self.lock = threading.Lock()
+
+  @property
+  def lines(self):
+    with self.lock:
+      return [line for lines in self.pushes for line in lines]
+
+  def push(self, metrics, socket=None, logging_prefix=''):
+    from es_injectors.elasticsearch_injector import VERSION
+    if socket is not None and 'version' in metrics:
+      socket.sendall( (VERSION + '\n').encode() )
+    with self.lock:
+      self.pushes.append(list(metrics))
+
+  def flush(self):
+    self.flushed = True
@@ -0,0 +1,68 @@
+import unittest
+from es_injectors.aggregation import WindowAggregator
+from es_injectors import elasticsearch_injector as es
+from test.mocks import MockElasticsearch
+
+def point(value, timestamp, host='a'):
+  return ('cpu', {'cpu': float(value), 'timestamp': timestamp, 'host': host})
+
+class TestWindowAggregator(unittest.TestCase):
+
+  def test_windows(self):
+    aggregator = WindowAggregator(window=10, grace=5)
+    self.assertEqual(aggregator.add([point(1, 1000), point(3, 2000), point(2, 9999),
+                                      point(7, 5000, host='b'), point(5, 10000)]), [])
+    self.assertEqual(aggregator.nb_series, 3)
+
+    # 15s is the end of the first window plus the grace period
+    docs = aggregator.add([point(4, 15000)])
+    docs = sorted(docs, key=lambda doc: doc[1]['host'])
+    self.assertEqual(docs, [
+      ('cpu', {'host': 'a', 'timestamp': 0, 'cpu': 2.0, 'cpu_min': 1.0, 'cpu_max': 3.0,
+               'cpu_sum': 6.0, 'cpu_count': 3, 'cpu_last': 2.0}),
+      ('cpu', {'host': 'b', 'timestamp': 0, 'cpu': 7.0, 'cpu_min': 7.0, 'cpu_max': 7.0,
+               'cpu_sum': 7.0, 'cpu_count': 1, 'cpu_last': 7.0})])
+
+    # Late point
+    self.assertEqual(aggregator.add([point(8, 3000)]), [
+      ('cpu', {'host': 'a', 'timestamp': 0, 'cpu': 8.0, 'cpu_min': 8.0, 'cpu_max': 8.0,
+               'cpu_sum': 8.0, 'cpu_count': 1, 'cpu_last': 8.0})])
+    self.assertEqual(aggregator.nb_late, 1)
+
+    docs = aggregator.expire(force=True)
+    self.assertEqual([doc[1]['cpu_sum'] for doc in docs], [9.0])
+    self.assertEqual(aggregator.nb_series, 0)
+
+  def test_expire(self):
+    aggregator = WindowAggregator(window=10, grace=5)
+    aggregator.add([point(1, 1000)])
+    self.assertEqual(aggregator.expire(now=14), [])
+    self.assertEqual(len(aggregator.expire(now=15)), 1)
+
+  def test_future_points(self):
+    aggregator = WindowAggregator(window=10, grace=5, max_future=60, clock=lambda: 100)
+    aggregator.add([point(1, 90000)])
+    # Ahead of the clock, it does not close the window of 90s
+    self.assertEqual(aggregator.add([point(2, 130000)]), [])
+    self.assertEqual(aggregator.watermark, 100000)
+    self.assertEqual(aggregator.nb_series, 2)
+    # Too far ahead: emitted alone
+    self.assertEqual(aggregator.add([point(3, 200000)]), [('cpu', {
+      'cpu': 3.0, 'cpu_min': 3.0, 'cpu_max': 3.0, 'cpu_sum': 3.0, 'cpu_count': 1, 'cpu_last': 3.0,
+      'timestamp': 200000, 'host': 'a'})])
+    self.assertEqual((aggregator.nb_future, aggregator.nb_late), (1, 0))
+    self.assertEqual(len(aggregator.add([point(4, 91000)])), 0)
+    self.assertEqual(len(aggregator.expire(now=105)), 1)
+
+  def test_sender(self):
+    mock_es = MockElasticsearch()
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                    aggregator = WindowAggregator(window=10))
+    sender.push(['put cpu ' + str(i) + ' ' + str(1454962560000 + i * 100) + ' host=a' for i in range(0, 50)])
+    sender.flush()
+    self.assertEqual(len(mock_es.docs), 1)
+    self.assertEqual(mock_es.docs[0]['cpu_count'], 50)
+    self.assertEqual(sender.stats.snapshot()['docs_accepted'], 50)
+
+if __name__ == "__main__":
+  unittest.main(verbosity=2)
@@ -0,0 +1,103 @@
+import unittest, socket, threading, time
+from es_injectors import async_server
+from es_injectors import elasticsearch_injector as es
+from test.mocks import MockInjector
+
+class TestAsyncAggregatorServer(unittest.TestCase):
+
+  def setUp(self):
+    self.injector = MockInjector()
+    self.server = async_server.AsyncAggregatorServer('127.0.0.1', 0, self.injector, max_connections=2)
+    self.server.start()
+    while self.server.server is None:
+      time.sleep(0.01)
+    self.port = self.server.server.sockets[0].getsockname()[1]
+
+  def tearDown(self):
+    self.server.stop()
+    self.server.join(2)
+    self.assertTrue(self.injector.flushed)
+
+  def _wait_lines(self, nb):
+    for i in range(0, 200):
+      if len(self.injector.lines) >= nb:
+        break
+      time.sleep(0.01)
+
+  def test_many_clients(self):
+    sockets = [socket.create_connection(('127.0.0.1', self.port)) for i in range(0, 2)]
+    for i, client_socket in enumerate(sockets):
+      client_socket.sendall(('put metric' + str(i) + ' 1 1454962560 host=me\n' * 50).encode())
+    for client_socket in sockets:
+      client_socket.close()
+    self._wait_lines(100)
+    self.assertEqual(len(self.injector.lines), 100)
+    self.assertEqual(self.injector.lines[0].count('\n'), 0)
+
+  def test_max_connections(self):
+    sockets = [socket.create_connection(('127.0.0.1', self.port)) for i in range(0, 2)]
+    time.sleep(0.1)
+    rejected = socket.create_connection(('127.0.0.1', self.port))
+    rejected.settimeout(1)
+    self.assertEqual(rejected.recv(1024), b'')
+    for client_socket in sockets + [rejected]:
+      client_socket.close()
+
+  def test_version(self):
+    client_socket = socket.create_connection(('127.0.0.1', self.port))
+    client_socket.settimeout(1)
+    client_socket.sendall(b'version\n')
+    self.assertEqual(client_socket.recv(1024).decode(), es.VERSION + '\n')
+    client_socket.close()
+
+  def test_pause(self):
+    self.injector.accepting = threading.Event()
+    sockets = [socket.create_connection(('127.0.0.1', self.port)) for i in range(0, 2)]
+    for client_socket in sockets:
+      client_socket.sendall(b'put metric 1 1454962560 host=me\n' * 10)
+    time.sleep(0.1)
+    self.assertEqual(self.injector.lines, [])
+    # Both connections are woken up
+    self.injector.accepting.set()
+    self._wait_lines(20)
+    self.assertEqual(len(self.injector.lines), 20)
+
+    # Paused again: the read already waiting completes, not the next one
+    self.injector.accepting.clear()
+    sockets[0].sendall(b'put metric 2 1454962560 host=me\n')
+    self._wait_lines(21)
+    sockets[0].sendall(b'put metric 3 1454962560 host=me\n')
+    time.sleep(0.1)
+    self.assertEqual(len(self.injector.lines), 21)
+    self.injector.accepting.set()
+    self._wait_lines(22)
+    self.assertEqual(len(self.injector.lines), 22)
+    for client_socket in sockets:
+      client_socket.close()
+
+  def test_batches(self):
+    client_socket = socket.create_connection(('127.0.0.1', self.port))
+    client_socket.sendall(b'put metric 1 1454962560 host=me\n' * 100 + b'put metric 2 14549')
+    self._wait_lines(100)
+    client_socket.sendall(b'62560 host=me\nput metric 3 1454962560 host=me')
+    client_socket.close()
+    self._wait_lines(102)
+    # The complete lines received together are pushed at once
+    self.assertTrue(len(self.injector.pushes) < 10)
+    self.assertEqual(self.injector.lines[-2:], ['put metric 2 1454962560 host=me', 'put metric 3 1454962560 host=me'])
+
+  def test_stop_with_clients(self):
+    client_socket = socket.create_connection(('127.0.0.1', self.port))
+    client_socket.sendall(b'put metric 1 1454962560 host=me\n')
+    self._wait_lines(1)
+    # The client stays connected
+    self.server.stop()
+    self.server.join(2)
+    self.assertFalse(self.server.is_alive())
+    self.assertTrue(self.injector.flushed)
+    client_socket.settimeout(1)
+    self.assertEqual(client_socket.recv(1024), b'')
+    client_socket.close()
+
+if __name__ == "__main__":
+  unittest.main(verbosity=2)
@@ -0,0 +1,101 @@
+import unittest, tempfile, shutil, gzip, zlib, io
+from elasticsearch import Elasticsearch
+from es_injectors import compression
+from es_injectors import elasticsearch_injector as es
+from es_injectors.spool import Spool
+from test.mocks import MockElasticsearch
+from test.elasticsearch_server import ElasticsearchServer
+
+BODY = b'{"index":{"_index":"bogus_index","_type":"metric1"}}\n{"metric1":1.0,"host":"machine1"}\n'
+
+class TestCodec(unittest.TestCase):
+
+  def test_compress(self):
+    docs = [BODY] * 1000
+    for name in compression.CODECS:
+      codec = compression.Codec(name, 6)
+      body = codec.compress_docs(docs)
+      self.assertEqual(compression.encoding_of(body), name)
+      self.assertEqual(compression.decompress(body), BODY * 1000)
+      self.assertTrue(len(body) < len(BODY) * 1000 / 10)
+      self.assertEqual(compression.decompress(codec.compress_docs([BODY.decode('utf-8')])), BODY)
+    self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(compression.Codec('gzip').compress([BODY]))).read(), BODY)
+    self.assertEqual(zlib.decompress(compression.Codec('deflate', 9).compress([BODY])), BODY)
+    self.assertIsNone(compression.encoding_of(BODY))
+    self.assertEqual(compression.decompress(BODY), BODY)
+    self.assertRaises(ValueError, compression.Codec, 'lz4')
+    self.assertRaises(ValueError, compression.Codec, 'gzip', 10)
+
+  def test_writer(self):
+    stream = io.BytesIO()
+    stream.close = lambda: None
+    with compression.Codec('deflate').writer(stream) as writer:
+      writer.write(BODY)
+      writer.write(BODY)
+    self.assertEqual(zlib.decompress(stream.getvalue()), BODY * 2)
+
+class TestCompressedSender(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_compressed_bulk(self):
+    mock_es = MockElasticsearch()
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                    chunk_size = 100, compression = compression.Codec('gzip'))
+    sender.push(['put metric1 ' + str(i) + ' 1454962560 host=machine1' for i in range(0, 250)])
+    sender.flush()
+    self.assertEqual(mock_es.transport.encodings, ['gzip'] * 3)
+    self.assertEqual([doc['metric1'] for doc in mock_es.docs], [float(i) for i in range(0, 250)])
+    self.assertTrue(0 < sender.stats.bulk_bytes < sum(len(body) for body in mock_es.bodies) / 4)
+
+  def test_retry(self):
+    mock_es = MockElasticsearch()
+    mock_es.unavailable = True
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                    compression = compression.Codec('deflate'),
+                                    retry_queue = es.RetryQueue(base_delay=0))
+    sender.push(['put metric1 ' + str(i) + ' 1454962560' for i in range(0, 10)])
+    sender.flush()
+    self.assertEqual(len(sender.retry_queue), 10)
+    mock_es.unavailable = False
+    sender.flush()
+    self.assertEqual(len(mock_es.docs), 10)
+    # Retried compressed
+    self.assertEqual(set(mock_es.transport.encodings), set(['deflate']))
+
+  def test_spool(self):
+    mock_es = MockElasticsearch()
+    mock_es.unavailable = True
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                    spool = Spool(self.directory), compression = compression.Codec('gzip'))
+    sender.push(['put metric1 ' + str(i) + ' 1454962560' for i in range(0, 3)])
+    sender.flush()
+    self.assertTrue(sender.backlogged)
+    sender.close()
+
+    # Replayed by a sender which does not compress
+    mock_es = MockElasticsearch()
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                    spool = Spool(self.directory))
+    sender.flush()
+    self.assertEqual([doc['metric1'] for doc in mock_es.docs], [0.0, 1.0, 2.0])
+    self.assertEqual(mock_es.transport.encodings, ['gzip'])
+    sender.close()
+
+  def test_server(self):
+    server = ElasticsearchServer(item_failure_ratio=0.1)
+    server.start()
+    self.addCleanup(server.stop)
+    for name in compression.CODECS:
+      sender = es.ElasticsearchSender(es.OpenTsdbParser(), Elasticsearch([server.url]), 'metrics-' + name,
+                                      background_flush = False, compression = compression.Codec(name))
+      sender.push(['put metric1 ' + str(i) + ' 1454962560 host=machine1' for i in range(0, 1000)])
+      sender.close()
+      # Failed items are found in the compressed bodies
+      nb_failed = sum(sender.stats.dead_letters.values())
+      self.assertTrue(nb_failed > 0)
+      self.assertEqual(server.count('metrics-' + name), 1000 - nb_failed)
@@ -1,8 +1,8 @@
 #!/usr/bin/python3
 
-import unittest, logging, time
+import unittest, logging, time, socket, threading
 from es_injectors import elasticsearch_injector as es
-from test.mocks import MockLoggingHandler
+from test.mocks import MockLoggingHandler, MockElasticsearch, MockInjector
 
 class TestOpenTsdbParser(unittest.TestCase):
 
@@ -66,6 +66,309 @@ class TestOpenTsdbParser(unittest.TestCase):
            'cluster': 'cluster1'}), msg=self._logger_handler)
 
 
+  def test_parse_many(self):
+    parser = es.OpenTsdbParser()
+    errors = {}
+    docs = parser.parse_many(['one', 'put one', 'put one two', 'put one two three four',
+                              'put one 1 2 three', 'put one nan 2', 'put one 1 two',
+                              'put metric.1 42.42 1454962560 host=machine1 cluster=cluster1',
+                              'put metric1 42 1454962560'], errors)
+    self.assertEqual(docs, [
+      ('metric-1', {'timestamp': 1454962560, 'host': 'machine1', 'metric-1': 42.42, 'cluster': 'cluster1'}),
+      ('metric1', {'timestamp': 1454962560, 'metric1': 42.0})])
+    self.assertEqual(errors, {'invalid_put_line': 1, 'incorrect_metric': 2, 'invalid_value': 2,
+                              'invalid_tag': 1, 'invalid_timestamp': 1})
+    self.assertEqual(self._logger_handler.messages['warning'], [])
+
+    # The cached tags must not be shared between documents
+    docs = parser.parse_many(['put m 1 1454962560 host=a', 'put m 2 1454962561 host=a'])
+    self.assertEqual(docs[0][1]['m'], 1.0)
+    self.assertEqual(docs[1][1]['m'], 2.0)
+
+    # A trailing space is an empty tag, even once the series without tags is cached
+    errors = {}
+    docs = parser.parse_many(['put m 1 1454962560', 'put m 1 1454962560 '], errors)
+    self.assertEqual(len(docs), 1)
+    self.assertEqual(errors, {'invalid_tag': 1})
+
+    parser = es.OpenTsdbParser(time_unit='s')
+    docs = parser.parse_many(['put metric1 42.42 1454962560 host=machine1'])
+    self.assertEqual(docs[0][1]['timestamp'], 1454962560000)
+
+  def test_parse_points(self):
+    parser = es.OpenTsdbParser(time_unit='s')
+    errors = {}
+    points = parser.parse_points(['put metric.1 1 1454962560 host=a', 'put metric.1 2 1454962561 host=a',
+                                  'put metric.1 3 1454962562 host=a=b', 'put metric1 4 1454962563'], errors)
+    self.assertEqual(points, [('metric-1', 'host=a', {'host': 'a'}, 1.0, 1454962560000),
+                              ('metric-1', 'host=a', {'host': 'a'}, 2.0, 1454962561000),
+                              ('metric1', '', {}, 4.0, 1454962563000)])
+    self.assertEqual(errors, {'invalid_tag': 1})
+    # The points of a series share their tags
+    self.assertTrue(points[0][1] is points[1][1] and points[0][2] is points[1][2])
+
+class TestBackgroundFlush(unittest.TestCase):
+
+  def test_push_does_not_ship(self):
+    mock_es = MockElasticsearch()
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index',
+                                         buffer_size = 10, background_flush = False)
+
+    metrics = ['put metric1 42.42 1454962560 host=machine1 cluster=cluster1' for i in range(0, 11)]
+    es_injector.push(metrics)
+    self.assertEqual(len(es_injector.buffer), 0)
+    self.assertEqual(len(es_injector.pending), 1)
+    self.assertEqual(mock_es.docs, [])
+
+    es_injector.flush()
+    self.assertEqual(len(es_injector.pending), 0)
+    self.assertEqual(len(mock_es.docs), 11)
+    self.assertEqual(mock_es.actions[0], {'index': {'_index': 'bogus_index', '_type': 'metric1'}})
+    self.assertEqual(mock_es.docs[0], {'metric1': 42.42, 'timestamp': 1454962560,
+                                       'host': 'machine1', 'cluster': 'cluster1'})
+
+  def test_flusher_thread(self):
+    mock_es = MockElasticsearch()
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index',
+                                         buffer_size = 10)
+    metrics = ['put metric1 42.42 1454962560 host=machine1 cluster=cluster1' for i in range(0, 11)]
+    es_injector.push(metrics)
+    es_injector.close()
+    self.assertEqual(len(mock_es.docs), 11)
+
+  def test_flusher_survives_errors(self):
+    mock_es = MockElasticsearch()
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index',
+                                         buffer_size = 10, high_watermark = 100)
+    bodies = []
+    def bulk(body):
+      if not bodies:
+        bodies.append(body)
+        raise ValueError('bogus')
+      return MockElasticsearch.bulk(mock_es, body)
+    mock_es.bulk = bulk
+    metrics = ['put metric1 42.42 1454962560 host=machine1' for i in range(0, 11)]
+    es_injector.push(metrics)
+    es_injector.push(metrics)
+    es_injector.close()
+    self.assertEqual(len(mock_es.docs), 11)
+    self.assertEqual(es_injector.stats.dead_letters, {'ship_error': 11})
+    self.assertEqual(es_injector.nb_buffered, 0)
+
+  def test_max_delay_without_new_data(self):
+    mock_es = MockElasticsearch()
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index',
+                                         max_delay = 0.1)
+    es_injector.push(['put metric1 42.42 1454962560 host=machine1'])
+    time.sleep(0.5)
+    self.assertEqual(len(mock_es.docs), 1)
+    es_injector.close()
+
+  def test_parallel_shipping(self):
+    mock_es = MockElasticsearch()
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                         chunk_size = 10, thread_count = 4)
+    es_injector.push(['put metric1 ' + str(i) + ' 1454962560 host=machine1' for i in range(0, 95)])
+    es_injector.flush()
+    self.assertEqual(len(mock_es.bodies), 10)
+    self.assertEqual(sorted(doc['metric1'] for doc in mock_es.docs), [float(i) for i in range(0, 95)])
+
+class TestIndices(unittest.TestCase):
+
+  def test_time_based_index(self):
+    mock_es = MockElasticsearch()
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'metrics-%Y.%m.%d', background_flush = False)
+    # Monday 8 February 2016, 20:16:00 UTC and the following day
+    es_injector.push(['put metric1 1 1454962560000 host=machine1', 'put metric1 2 1455048960000 host=machine1'])
+    es_injector.flush()
+    self.assertEqual([action['index']['_index'] for action in mock_es.actions], ['metrics-2016.02.08', 'metrics-2016.02.09'])
+
+  def test_index_template(self):
+    template = es.index_template('metrics-%Y.%m.%d', '2.4.1')
+    self.assertEqual(template['template'], 'metrics-*')
+    mapping = template['mappings']['_default_']
+    self.assertEqual(mapping['properties']['timestamp'], {'type': 'date', 'format': 'epoch_millis'})
+    self.assertEqual(mapping['dynamic_templates'][0]['strings']['mapping']['index'], 'not_analyzed')
+
+    self.assertNotIn('settings', template)
+
+    template = es.index_template('test-metrics', '6.8.0', refresh_interval='60s')
+    self.assertEqual(template['index_patterns'], ['test-metrics*'])
+    self.assertEqual(template['settings'], {'index': {'refresh_interval': '60s'}})
+    self.assertEqual(template['mappings']['_default_']['dynamic_templates'][0]['strings']['mapping'], {'type': 'keyword'})
+
+class TestSeriesInterning(unittest.TestCase):
+
+  def test_series_interning(self):
+    mock_es = MockElasticsearch()
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False)
+    es_injector.push(['put metric1 ' + str(i) + ' 1454962560 host=machine' + str(i % 2) for i in range(0, 10)] +
+                     [u'put métric 1e20 1454962560'])
+    self.assertEqual(len(es_injector.buffer), 11)
+    self.assertEqual(len(es_injector.prefixes), 3)
+    es_injector.flush()
+    self.assertEqual(mock_es.docs[3], {'metric1': 3.0, 'timestamp': 1454962560, 'host': 'machine1'})
+    self.assertEqual(mock_es.docs[10], {u'métric': 1e20, 'timestamp': 1454962560})
+    self.assertEqual(mock_es.actions[10], {'index': {'_index': 'bogus_index', '_type': u'métric'}})
+
+    # Queued buffers keep their series when they are forgotten
+    es_injector.push(['put metric1 1 1454962560 host=machine1'])
+    es_injector.swap()
+    batch = es_injector.pending[0]
+    es_injector.prefixes.extend([''] * es.MAX_CACHED_SERIES)
+    es_injector.push(['put metric2 2 1454962560'])
+    es_injector.swap()
+    self.assertEqual(es_injector.prefixes, [])
+    self.assertEqual(batch.bodies(10)[0][1], 1)
+    es_injector.flush()
+    self.assertEqual(mock_es.docs[11:], [{'metric1': 1.0, 'timestamp': 1454962560, 'host': 'machine1'},
+                                         {'metric2': 2.0, 'timestamp': 1454962560}])
+
+class TestDedup(unittest.TestCase):
+
+  def test_dedup(self):
+    mock_es = MockElasticsearch()
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                         dedup = True)
+    es_injector.push(['put metric1 1 1454962560 host=machine1 cluster=cluster1',
+                      'put metric1 2 1454962560 cluster=cluster1 host=machine1',
+                      'put metric1 3 1454962561 host=machine1 cluster=cluster1',
+                      'put metric1 4 1454962560 host=machine2 cluster=cluster1'])
+    es_injector.flush()
+    self.assertEqual([doc['metric1'] for doc in mock_es.docs], [2.0, 3.0, 4.0])
+    ids = [action['index']['_id'] for action in mock_es.actions]
+    self.assertEqual(len(set(ids)), 3)
+    self.assertTrue(ids[0].endswith('-1454962560'))
+    self.assertEqual(ids[0].split('-')[0], ids[1].split('-')[0])
+    self.assertEqual(mock_es.actions[0]['index']['_type'], 'metric1')
+    self.assertEqual(es_injector.stats.duplicates, 1)
+    self.assertEqual(es_injector.stats.flush_docs.sum, 3)
+
+    # The same points get the same ids in the next batches
+    es_injector.push(['put metric1 5 1454962560 cluster=cluster1 host=machine1'])
+    es_injector.flush()
+    self.assertEqual(mock_es.actions[-1]['index']['_id'], ids[0])
+
+class TestWatermarks(unittest.TestCase):
+
+  def test_watermarks(self):
+    mock_es = MockElasticsearch()
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                         buffer_size = 10, high_watermark = 20, low_watermark = 5)
+    es_injector.push(['put metric1 ' + str(i) + ' 1454962560 host=machine1' for i in range(0, 15)])
+    self.assertTrue(es_injector.accepting.is_set())
+    es_injector.push(['put metric1 ' + str(i) + ' 1454962560 host=machine1' for i in range(0, 5)])
+    self.assertFalse(es_injector.accepting.is_set())
+    # The buffer is queued, even below `buffer_size`
+    self.assertEqual(len(es_injector.buffer), 0)
+    self.assertEqual(es_injector.stats.snapshot()['reading_paused'], 1)
+    es_injector.flush()
+    self.assertTrue(es_injector.accepting.is_set())
+    self.assertEqual(es_injector.nb_buffered, 0)
+    self.assertEqual(len(mock_es.docs), 20)
+
+class TestClientThread(unittest.TestCase):
+
+  def _run(self, chunks, recv_size=es.RECV_SIZE):
+    injector = MockInjector()
+    server_socket, client_socket = socket.socketpair()
+    thread = es.ClientThread(server_socket, 'localhost', 0, injector, recv_size=recv_size)
+    thread.start()
+    for chunk in chunks:
+      client_socket.sendall(chunk)
+      time.sleep(0.05)
+    client_socket.close()
+    thread.join(2)
+    return injector
+
+  def test_one_push_per_read(self):
+    injector = self._run([b'put a 1 1\nput b 2 2\nput c 3 3\n'])
+    self.assertEqual(injector.pushes, [['put a 1 1', 'put b 2 2', 'put c 3 3']])
+
+  def test_partial_lines(self):
+    injector = self._run([b'put a 1', b' 1\nput b', b' 2 2\nput c 3 3\n', b'put d 4 4'])
+    self.assertEqual(injector.lines, ['put a 1 1', 'put b 2 2', 'put c 3 3', 'put d 4 4'])
+
+  def test_split_character(self):
+    line = u'put m\u00e9tric 1 1 host=h\u00f4te\n'.encode('utf-8')
+    cut = line.index(b'\xc3') + 1
+    injector = self._run([line[:cut], line[cut:]])
+    self.assertEqual(injector.lines, [u'put m\u00e9tric 1 1 host=h\u00f4te'])
+
+  def test_backpressure(self):
+    mock_es = MockElasticsearch()
+    injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                      high_watermark = 10)
+    server_socket, client_socket = socket.socketpair()
+    thread = es.ClientThread(server_socket, 'localhost', 0, injector, recv_size=64)
+    thread.start()
+    client_socket.sendall(b''.join(b'put metric1 1 ' + str(i).encode() + b'\n' for i in range(0, 100)))
+    time.sleep(0.2)
+    self.assertFalse(injector.accepting.is_set())
+    self.assertTrue(10 <= injector.nb_buffered < 20)
+    client_socket.close()
+    for i in range(0, 200):
+      injector.flush()
+      if not thread.is_alive() and not injector.nb_buffered:
+        break
+      time.sleep(0.01)
+    self.assertEqual(len(mock_es.docs), 100)
+
+  def test_small_recv_size(self):
+    injector = self._run([b'put a 1 1\nput b 2 2\n'], recv_size=4)
+    self.assertEqual(injector.lines, ['put a 1 1', 'put b 2 2'])
+
+class TestUdpServer(unittest.TestCase):
+
+  def _start(self, injector, **kwargs):
+    server = es.UdpServer('127.0.0.1', 0, injector, **kwargs)
+    server.start()
+    while server.bound_port is None:
+      time.sleep(0.01)
+    self.addCleanup(server.join, 2)
+    self.addCleanup(server.stop)
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.addCleanup(udp_socket.close)
+    return server, udp_socket
+
+  def test_batches(self):
+    injector = MockInjector()
+    injector.accepting = threading.Event()
+    server, udp_socket = self._start(injector)
+    # Datagrams received while paused are pushed at once
+    for i in range(0, 10):
+      udp_socket.sendto(b'put a 1 1\nput b 2 2\n', ('127.0.0.1', server.bound_port))
+    udp_socket.sendto(b'put c 3 3', ('127.0.0.1', server.bound_port))
+    time.sleep(0.1)
+    injector.accepting.set()
+    for i in range(0, 100):
+      if injector.pushes:
+        break
+      time.sleep(0.01)
+    self.assertEqual(len(injector.pushes), 1)
+    self.assertEqual(len(injector.lines), 21)
+    self.assertEqual(injector.lines[-2:], ['put b 2 2', 'put c 3 3'])
+    server.stop()
+    server.join(2)
+    self.assertTrue(injector.flushed)
+
+  @unittest.skipIf(es.SO_RXQ_OVFL is None, 'Dropped datagrams are only counted on Linux')
+  def test_dropped(self):
+    injector = MockInjector()
+    injector.accepting = threading.Event()
+    server, udp_socket = self._start(injector, rcvbuf=4096)
+    for i in range(0, 200):
+      udp_socket.sendto(b'put a 1 1\n' * 50, ('127.0.0.1', server.bound_port))
+    injector.accepting.set()
+    time.sleep(0.1)
+    # The kernel reports the drops with the next datagram received
+    udp_socket.sendto(b'put b 2 2\n', ('127.0.0.1', server.bound_port))
+    for i in range(0, 100):
+      if 'put b 2 2' in injector.lines:
+        break
+      time.sleep(0.01)
+    self.assertTrue(server.nb_dropped > 0)
+    self.assertEqual(len(injector.lines), (200 - server.nb_dropped) * 50 + 1)
 
 from elasticsearch.helpers.test import get_test_client, ElasticsearchTestCase as BaseTestCase
 
@@ -0,0 +1,59 @@
+import unittest, logging
+from elasticsearch import Elasticsearch, TransportError
+from es_injectors import elasticsearch_injector as es
+from test.elasticsearch_server import ElasticsearchServer
+
+class TestElasticsearchServer(unittest.TestCase):
+
+  def start(self, **kwargs):
+    server = ElasticsearchServer(**kwargs)
+    server.start()
+    self.addCleanup(server.stop)
+    client = Elasticsearch([server.url], sniff_on_start=True)
+    return server, client
+
+  def test_indices_and_count(self):
+    server, client = self.start()
+    self.assertFalse(client.indices.exists('metrics'))
+    client.indices.create('metrics')
+    self.assertTrue(client.indices.exists('metrics'))
+    self.assertEqual(client.count(index='metrics')['count'], 0)
+    client.indices.delete('metrics')
+    self.assertFalse(client.indices.exists('metrics'))
+
+  def test_sender(self):
+    server, client = self.start()
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), client, 'metrics-%Y.%m', background_flush = False)
+    sender.push(['put metric1 ' + str(i) + ' 1454962560000 host=machine1' for i in range(0, 1200)])
+    sender.flush()
+    self.assertEqual(server.nb_bulk_requests, 3)
+    self.assertEqual(client.count(index='metrics-*')['count'], 1200)
+    self.assertEqual(server.count('metrics-2016.02'), 1200)
+
+  def test_dedup(self):
+    server, client = self.start()
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), client, 'metrics', background_flush = False, dedup = True)
+    metrics = ['put metric1 ' + str(i) + ' ' + str(1454962560000 + i) + ' host=machine1' for i in range(0, 100)]
+    sender.push(metrics)
+    sender.flush()
+    # An agent sending its points again
+    sender.push(metrics)
+    sender.flush()
+    self.assertEqual(server.count('metrics'), 100)
+    self.assertEqual(server.nb_bulk_requests, 2)
+
+  def test_failures(self):
+    server, client = self.start(reject_ratio=1)
+    self.assertRaises(TransportError, client.bulk, body='{"index":{"_index":"a","_type":"t"}}\n{}\n')
+    self.assertEqual(server.nb_rejected, 1)
+
+    server, client = self.start(item_failure_ratio=0.5)
+    body = '{"index":{"_index":"a","_type":"t"}}\n{}\n' * 100
+    response = client.bulk(body=body)
+    self.assertTrue(response['errors'])
+    failed = [item for item in response['items'] if item['index']['status'] == 400]
+    self.assertEqual(len(failed), server.nb_failed_items)
+    self.assertEqual(server.count('a'), 100 - len(failed))
+
+if __name__ == "__main__":
+  unittest.main(verbosity=2)
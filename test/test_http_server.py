@@ -0,0 +1,92 @@
+import unittest, json, gzip, zlib, io
+try:
+  from http.client import HTTPConnection
+except ImportError:
+  from httplib import HTTPConnection
+from es_injectors import elasticsearch_injector as es
+from es_injectors.http_server import HttpServer
+from test.mocks import MockElasticsearch
+
+class TestHttpServer(unittest.TestCase):
+
+  def setUp(self):
+    self.es = MockElasticsearch()
+    self.sender = es.ElasticsearchSender(es.OpenTsdbParser(), self.es, 'bogus_index', background_flush = False)
+    self.server = HttpServer('127.0.0.1', 0, self.sender)
+    self.server.start()
+    self.addCleanup(self.server.stop)
+    self.connection = HTTPConnection('127.0.0.1', self.server.port, timeout=5)
+    self.addCleanup(self.connection.close)
+
+  def put(self, body, path='/api/put', headers={}):
+    self.connection.request('POST', path, body, headers)
+    response = self.connection.getresponse()
+    data = response.read()
+    return response.status, json.loads(data.decode('utf-8')) if data else None
+
+  def test_put(self):
+    points = [{'metric': 'sys.cpu', 'timestamp': 1454962560, 'value': 42.42, 'tags': {'host': 'machine1'}},
+              {'metric': 'sys.cpu', 'timestamp': 1454962560001, 'value': '1', 'tags': {'host': 'machine2'}}]
+    self.assertEqual(self.put(json.dumps(points)), (204, None))
+    # A single point, on the same connection
+    self.assertEqual(self.put(json.dumps({'metric': 'mem', 'timestamp': 1454962560, 'value': 3})), (204, None))
+    self.assertEqual(self.server.stats.lines_received, 3)
+    self.sender.flush()
+    self.assertEqual(self.es.docs, [
+      {'sys-cpu': 42.42, 'timestamp': 1454962560000, 'host': 'machine1'},
+      {'sys-cpu': 1.0, 'timestamp': 1454962560001, 'host': 'machine2'},
+      {'mem': 3.0, 'timestamp': 1454962560000}])
+    self.assertEqual(self.es.actions[0], {'index': {'_index': 'bogus_index', '_type': 'sys-cpu'}})
+
+  def test_compressed(self):
+    body = json.dumps([{'metric': 'm', 'timestamp': 1454962560, 'value': i, 'tags': {'host': 'h'}}
+                       for i in range(0, 1000)]).encode('utf-8')
+    compressed = io.BytesIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+      gzip_file.write(body)
+    self.assertEqual(self.put(compressed.getvalue(), headers={'Content-Encoding': 'gzip'}), (204, None))
+    self.assertEqual(self.put(zlib.compress(body), headers={'Content-Encoding': 'deflate'}), (204, None))
+    self.sender.flush()
+    self.assertEqual(len(self.es.docs), 2000)
+
+  def test_chunked(self):
+    body = json.dumps([{'metric': 'm', 'timestamp': 1454962560, 'value': 1}]).encode('utf-8')
+    self.connection.putrequest('POST', '/api/put')
+    self.connection.putheader('Transfer-Encoding', 'chunked')
+    self.connection.endheaders()
+    for data in (body[:10], body[10:]):
+      self.connection.send(('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n')
+    self.connection.send(b'0\r\n\r\n')
+    self.assertEqual(self.connection.getresponse().status, 204)
+
+  def test_invalid(self):
+    points = [{'metric': 'm', 'timestamp': 1454962560, 'value': 1},
+              {'metric': 'm', 'timestamp': 'now', 'value': 1},
+              {'metric': 'm', 'timestamp': 1454962560, 'value': 'nan'},
+              {'timestamp': 1454962560, 'value': 1}]
+    self.assertEqual(self.put(json.dumps(points)), (400, {'success': 1, 'failed': 3}))
+    status, response = self.put(json.dumps(points), path='/api/put?details')
+    self.assertEqual(status, 200)
+    self.assertEqual([error['error'] for error in response['errors']],
+                     ['invalid_timestamp', 'invalid_value', 'incorrect_metric'])
+    self.assertEqual(self.put(json.dumps(points), path='/api/put?summary'), (200, {'success': 1, 'failed': 3}))
+    self.assertEqual(self.sender.stats.parse_errors, {'invalid_timestamp': 3, 'invalid_value': 3, 'incorrect_metric': 3})
+
+    self.assertEqual(self.put('[{')[0], 400)
+    self.assertEqual(self.put('[]', path='/api/query')[0], 404)
+    self.assertEqual(self.put('[]'), (204, None))
+
+  def test_invalid_encoding(self):
+    body = json.dumps([{'metric': 'm', 'timestamp': 1454962560, 'value': 1}]).encode('utf-8')
+    # Discarded: the connection is kept
+    self.assertEqual(self.put(body, headers={'Content-Encoding': 'br'})[0], 400)
+    self.assertEqual(self.put(body), (204, None))
+
+    # Not deflate: the rest of the body is not read, and the connection is closed
+    self.connection.request('POST', '/api/put', b'x' * 200000, {'Content-Encoding': 'deflate'})
+    response = self.connection.getresponse()
+    response.read()
+    self.assertEqual((response.status, response.getheader('Connection')), (400, 'close'))
+    self.assertEqual(self.put(body), (204, None))
+    self.sender.flush()
+    self.assertEqual(len(self.es.docs), 2)
@@ -0,0 +1,224 @@
+import unittest, json, random, threading
+try:
+  from http.client import HTTPConnection
+  from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+  from httplib import HTTPConnection
+  from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from es_injectors import query_proxy
+
+START = 1454962560000
+
+class HistogramHandler(BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    self.send(200, {'version': {'number': '6.8.2'}})
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+    if not self.path.split('?')[0].endswith('/_msearch'):
+      self.send(404, {'error': 'not found'})
+      return
+    lines = [json.loads(line) for line in body.split('\n') if line]
+    self.send(200, {'responses': [self.server.search(lines[i + 1]) for i in range(0, len(lines), 2)]})
+
+  def send(self, status, response):
+    data = json.dumps(response).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+class HistogramServer(HTTPServer):
+  """Elasticsearch answering the date_histogram searches of Grafana over
+  `docs`, a list of (timestamp, value). The ranges searched are available
+  in ``ranges``."""
+
+  def __init__(self, docs):
+    HTTPServer.__init__(self, ('127.0.0.1', 0), HistogramHandler)
+    self.docs = docs
+    self.ranges = []
+    self.url = 'http://127.0.0.1:' + str(self.server_address[1])
+    threading.Thread(target=self.serve_forever).start()
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+  def search(self, body):
+    bounds = body['query']['bool']['filter'][0]['range']['timestamp']
+    gte, lte = int(bounds['gte']), int(bounds['lte'])
+    self.ranges.append((gte, lte))
+    name, aggregation = list(body['aggs'].items())[0]
+    histogram = aggregation['date_histogram']
+    # Calendar intervals as 30 days
+    interval = query_proxy.parse_interval(histogram['interval']) or 30 * 24 * 3600 * 1000
+    docs = [(timestamp, value) for timestamp, value in self.docs if gte <= timestamp <= lte]
+    by_key = {}
+    for timestamp, value in docs:
+      by_key.setdefault(timestamp // interval * interval, []).append(value)
+    keys = list(by_key)
+    if 'extended_bounds' in histogram:
+      keys.append(int(histogram['extended_bounds']['min']) // interval * interval)
+      keys.append(int(histogram['extended_bounds']['max']) // interval * interval)
+    buckets = []
+    for key in range(min(keys), max(keys) + 1, interval) if keys else []:
+      values = by_key.get(key, [])
+      if len(values) >= histogram.get('min_doc_count', 0):
+        buckets.append({'key': key, 'doc_count': len(values),
+                        '1': {'value': sum(values) / len(values) if values else None}})
+    return {'took': 1, 'timed_out': False, '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': len(docs), 'max_score': 0.0, 'hits': []},
+            'aggregations': {name: {'buckets': buckets}}, 'status': 200}
+
+def grafana_search(gte, lte, interval='10s', bounds=True):
+  histogram = {'interval': interval, 'field': 'timestamp', 'min_doc_count': 0, 'format': 'epoch_millis'}
+  if bounds:
+    histogram['extended_bounds'] = {'min': gte, 'max': lte}
+  return {'size': 0,
+          'query': {'bool': {'filter': [
+            {'range': {'timestamp': {'gte': str(gte), 'lte': str(lte), 'format': 'epoch_millis'}}},
+            {'query_string': {'analyze_wildcard': True, 'query': 'host:machine1'}}]}},
+          'aggs': {'2': {'date_histogram': histogram, 'aggs': {'1': {'avg': {'field': 'cpu'}}}}}}
+
+class TestQueryProxy(unittest.TestCase):
+
+  def setUp(self):
+    rng = random.Random(0)
+    # A point every 3 seconds for 12 hours, with holes
+    docs = [(START + i * 3000 + rng.randint(0, 2999), rng.uniform(0, 100)) for i in range(0, 12 * 1200)
+            if rng.random() > 0.1 and not 4000 <= i < 4100]
+    self.upstream = HistogramServer(docs)
+    self.addCleanup(self.upstream.stop)
+    self.now = (START + 12 * 3600 * 1000) / 1000.0
+    self.proxy = query_proxy.QueryProxy('127.0.0.1', 0, self.upstream.url, live_delay=60, clock=lambda: self.now)
+    self.proxy.start()
+    self.addCleanup(self.proxy.stop)
+    self.connection = HTTPConnection('127.0.0.1', self.proxy.port, timeout=5)
+    self.addCleanup(self.connection.close)
+
+  def request(self, method, path, body=None):
+    self.connection.request(method, path, body, {'Content-Type': 'application/json'})
+    response = self.connection.getresponse()
+    return response.status, json.loads(response.read().decode('utf-8'))
+
+  def msearch(self, searches):
+    body = ''.join(json.dumps({'index': 'test-metrics', 'search_type': 'query_then_fetch'}) + '\n' +
+                   json.dumps(search) + '\n' for search in searches)
+    status, response = self.request('POST', '/_msearch', body)
+    self.assertEqual(status, 200)
+    return response['responses']
+
+  def direct(self, search):
+    response = self.upstream.search(search)
+    self.upstream.ranges.pop()
+    return response
+
+  def assertSameResponse(self, response, expected):
+    self.assertEqual(response['aggregations'], expected['aggregations'])
+    self.assertEqual(response['hits']['total'], expected['hits']['total'])
+
+  def test_same_responses(self):
+    rng = random.Random(1)
+    for i in range(0, 50):
+      interval = rng.choice(['1s', '10s', '1m', '5m'])
+      gte = START + rng.randint(0, 12 * 3600 * 1000)
+      lte = min(gte + rng.randint(0, 6 * 3600 * 1000), int(self.now * 1000))
+      bounds = rng.random() > 0.3
+      search = grafana_search(gte, lte, interval, bounds)
+      # Twice: missing from the cache, then from it
+      for response in self.msearch([search, search]):
+        self.assertSameResponse(response, self.direct(search))
+    snapshot = self.proxy.cache.snapshot()
+    self.assertTrue(snapshot['cache_hits'] > 0)
+    self.assertTrue(snapshot['cached_buckets'] > snapshot['fetched_buckets'])
+
+  def test_refreshes(self):
+    # A dashboard of the last 6 hours, refreshed every 10 seconds
+    nb_buckets = 0
+    for refresh in range(0, 30):
+      lte = int(self.now * 1000)
+      search = grafana_search(lte - 6 * 3600 * 1000, lte)
+      response = self.msearch([search])[0]
+      self.assertSameResponse(response, self.direct(search))
+      nb_buckets += len(response['aggregations']['2']['buckets'])
+      if refresh == 0:
+        first_ranges = len(self.upstream.ranges)
+        self.proxy.cache.fetched_buckets = 0
+      self.now += 10
+    # Only the live tail is requested again
+    self.assertTrue(self.proxy.cache.fetched_buckets * 10 < nb_buckets)
+    self.assertTrue(all(lte - gte < 20 * 60 * 1000 for gte, lte in self.upstream.ranges[first_ranges:]))
+
+  def test_search(self):
+    search = grafana_search(START + 3600 * 1000, START + 7200 * 1000 - 1, '1m')
+    status, response = self.request('POST', '/test-metrics/_search', json.dumps(search))
+    self.assertEqual(status, 200)
+    self.assertSameResponse(response, self.direct(search))
+    self.assertNotIn('status', response)
+    self.assertEqual(self.proxy.cache.snapshot()['cached_searches'], 1)
+
+  def test_key(self):
+    search = grafana_search(START + 3600 * 1000, START + 7200 * 1000 - 1, '1m')
+    self.request('POST', '/test-metrics/_search', json.dumps(search))
+    # Other indices, or other parameters: not the same buckets
+    self.request('POST', '/other-metrics/_search', json.dumps(search))
+    body = json.dumps({}) + '\n' + json.dumps(search) + '\n'
+    self.request('POST', '/test-metrics/_msearch?max_concurrent_searches=1', body)
+    self.assertEqual(self.proxy.cache.snapshot()['cache_hits'], 0)
+    self.request('POST', '/test-metrics/_msearch', body)
+    self.assertTrue(self.proxy.cache.snapshot()['cache_hits'] > 0)
+
+  def test_not_cached(self):
+    # Live data only, a calendar interval, hits, and a pipeline aggregation
+    derivative = grafana_search(START, START + 3600 * 1000)
+    derivative['aggs']['2']['aggs']['3'] = {'derivative': {'buckets_path': '1'}}
+    searches = [grafana_search(int(self.now * 1000) - 30000, int(self.now * 1000)),
+                grafana_search(START, START + 3600 * 1000, '1M'),
+                dict(grafana_search(START, START + 3600 * 1000), size=10),
+                derivative]
+    self.msearch(searches)
+    self.assertEqual(self.upstream.ranges, [(int(search['query']['bool']['filter'][0]['range']['timestamp']['gte']),
+                                             int(search['query']['bool']['filter'][0]['range']['timestamp']['lte']))
+                                            for search in searches])
+    self.assertEqual(self.proxy.cache.snapshot()['cached_searches'], 0)
+    # Forwarded as is
+    self.assertEqual(self.request('GET', '/'), (200, {'version': {'number': '6.8.2'}}))
+    self.assertEqual(self.request('POST', '/test-metrics/_doc', '{}')[0], 404)
+
+class TestLruCache(unittest.TestCase):
+
+  def test_lru(self):
+    cache = query_proxy.LruCache(10)
+    cache.put('a', 1, 4)
+    cache.put('b', 2, 4)
+    self.assertEqual(cache.get('a'), 1)
+    cache.put('c', 3, 4)
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+    self.assertEqual((cache.size, cache.nb_evictions), (8, 1))
+    cache.put('d', 4, 11)
+    self.assertIsNone(cache.get('d'))
+
+  def test_pipeline(self):
+    search = grafana_search(START, START + 3600 * 1000)
+    self.assertIsNotNone(query_proxy.HistogramQuery.parse({}, search))
+    for name in ('derivative', 'moving_avg', 'serial_diff', 'cumulative_sum'):
+      search['aggs']['2']['aggs']['3'] = {name: {'buckets_path': '1'}}
+      self.assertIsNone(query_proxy.HistogramQuery.parse({}, search))
+    # Computed from each bucket alone
+    search['aggs']['2']['aggs']['3'] = {'bucket_script': {'buckets_path': {'a': '1'}, 'script': 'params.a * 2'}}
+    self.assertIsNotNone(query_proxy.HistogramQuery.parse({}, search))
+
+  def test_parse_interval(self):
+    self.assertEqual(query_proxy.parse_interval('10s'), 10000)
+    self.assertEqual(query_proxy.parse_interval('1d'), 86400000)
+    self.assertEqual(query_proxy.parse_interval(500), 500)
+    self.assertIsNone(query_proxy.parse_interval('1M'))
+    self.assertIsNone(query_proxy.parse_interval('week'))
@@ -0,0 +1,98 @@
+import unittest, tempfile, shutil, os, json
+from elasticsearch import Elasticsearch
+from es_injectors import retry
+from es_injectors import elasticsearch_injector as es
+from test.mocks import MockElasticsearch
+from test.elasticsearch_server import ElasticsearchServer
+
+class TestRetryQueue(unittest.TestCase):
+
+  def test_classification(self):
+    self.assertTrue(retry.is_retryable(429))
+    self.assertTrue(retry.is_retryable(503))
+    self.assertTrue(retry.is_retryable('N/A'))
+    self.assertFalse(retry.is_retryable(400))
+    self.assertEqual(retry.error_type({'index': {'status': 400, 'error': {'type': 'mapper_parsing_exception'}}}),
+                     'mapper_parsing_exception')
+    self.assertEqual(retry.error_type({'index': {'status': 409}}), 'status_409')
+
+  def test_backoff(self):
+    queue = retry.RetryQueue(base_delay=1, max_delay=5, max_attempts=3, seed=0)
+    self.assertEqual(queue.add([b'a'], now=0), [])
+    self.assertEqual(queue.add([b'b'], attempt=2, now=0), [])
+    self.assertEqual(len(queue), 2)
+    self.assertTrue(0 <= queue.next_due() <= 4)
+    self.assertEqual(queue.due(now=0), [])
+    self.assertEqual(sorted(queue.due(now=4)), [(1, [b'a']), (3, [b'b'])])
+    self.assertEqual(len(queue), 0)
+    self.assertIsNone(queue.next_due())
+    # Given up after `max_attempts` retries
+    self.assertEqual(queue.add([b'a'], attempt=3, now=0), [b'a'])
+
+  def test_budget(self):
+    queue = retry.RetryQueue(budget=3)
+    self.assertEqual(queue.add([b'a', b'b'], now=0), [])
+    self.assertEqual(queue.add([b'c', b'd'], now=0), [b'd'])
+    self.assertEqual(len(queue.due(force=True)), 2)
+    self.assertEqual(queue.add([b'e'], now=0), [])
+
+class TestSenderRetries(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_unavailable(self):
+    mock_es = MockElasticsearch()
+    mock_es.unavailable = True
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                    retry_queue = retry.RetryQueue(base_delay=0))
+    sender.push(['put metric1 ' + str(i) + ' 1454962560 host=machine1' for i in range(0, 10)])
+    sender.flush()
+    self.assertEqual(len(sender.retry_queue), 10)
+    self.assertEqual(sender.nb_buffered, 10)
+    mock_es.unavailable = False
+    sender.flush()
+    self.assertEqual(len(mock_es.docs), 10)
+    self.assertEqual(sender.nb_buffered, 0)
+    # Also retried right away by the first flush, without delay
+    self.assertEqual(sender.stats.retries, 20)
+
+  def test_classified_item_failures(self):
+    server = ElasticsearchServer(item_failure_ratio=0.1, item_reject_ratio=0.2)
+    server.start()
+    self.addCleanup(server.stop)
+    path = os.path.join(self.directory, 'dead_letters')
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), Elasticsearch([server.url]), 'metrics',
+                                    background_flush = False, dead_letters = retry.DeadLetterFile(path),
+                                    retry_queue = retry.RetryQueue(base_delay=0, max_attempts=20))
+    sender.push(['put metric1 ' + str(i) + ' 1454962560 host=machine1' for i in range(0, 1000)])
+    sender.flush()
+    while len(sender.retry_queue):
+      sender.flush()
+    sender.close()
+
+    # Rejected documents are retried until indexed, failed ones are given up
+    self.assertTrue(server.nb_rejected_items > 0)
+    self.assertEqual(server.count('metrics'), 1000 - server.nb_failed_items)
+    self.assertEqual(sender.stats.dead_letters, {'mapper_parsing_exception': server.nb_failed_items})
+    with open(path) as dead_letters:
+      lines = [json.loads(line) for line in dead_letters]
+    self.assertEqual(len(lines), server.nb_failed_items)
+    self.assertEqual(lines[0]['action'], {'index': {'_index': 'metrics', '_type': 'metric1'}})
+    self.assertEqual(lines[0]['document']['host'], 'machine1')
+    self.assertEqual(lines[0]['error']['index']['status'], 400)
+
+  def test_retries_exhausted(self):
+    mock_es = MockElasticsearch()
+    mock_es.unavailable = True
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                    retry_queue = retry.RetryQueue(base_delay=0, max_attempts=2))
+    sender.push(['put metric1 1 1454962560 host=machine1'])
+    for i in range(0, 4):
+      sender.flush()
+    self.assertEqual(sender.stats.dead_letters, {'retries_exhausted': 1})
+    self.assertEqual(sender.nb_buffered, 0)
+    self.assertEqual(mock_es.docs, [])
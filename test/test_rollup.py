@@ -0,0 +1,118 @@
+import unittest
+from es_injectors import rollup
+from test.mocks import MockDocumentsElasticsearch
+
+def hit(metric, value, timestamp, **tags):
+  source = dict(tags)
+  source[metric] = value
+  source['timestamp'] = timestamp
+  return {'_type': metric, '_source': source}
+
+class TestRollupDocs(unittest.TestCase):
+
+  def test_raw(self):
+    hits = [hit('cpu', 1, 60000, host='a'), hit('cpu', 3, 119999, host='a'),
+            hit('cpu', 5, 120000, host='a'), hit('cpu', 7, 60000, host='b')]
+    docs = rollup.rollup_docs(hits, 'metrics-rollup-1m', '1m')
+    docs = sorted(docs, key=lambda doc: (doc['_source']['host'], doc['_source']['timestamp']))
+    # Derived from the metric, tags and bucket
+    ids = [doc.pop('_id') for doc in docs]
+    self.assertEqual(ids[0], rollup.rollup_id('cpu', (('host', 'a'),), 60000))
+    self.assertEqual(len(set(ids)), 3)
+    self.assertEqual(docs, [
+      {'_index': 'metrics-rollup-1m', '_type': 'cpu', '_source': {'host': 'a', 'timestamp': 60000,
+        'cpu': 2.0, 'cpu_min': 1.0, 'cpu_max': 3.0, 'cpu_sum': 4.0, 'cpu_count': 2}},
+      {'_index': 'metrics-rollup-1m', '_type': 'cpu', '_source': {'host': 'a', 'timestamp': 120000,
+        'cpu': 5.0, 'cpu_min': 5.0, 'cpu_max': 5.0, 'cpu_sum': 5.0, 'cpu_count': 1}},
+      {'_index': 'metrics-rollup-1m', '_type': 'cpu', '_source': {'host': 'b', 'timestamp': 60000,
+        'cpu': 7.0, 'cpu_min': 7.0, 'cpu_max': 7.0, 'cpu_sum': 7.0, 'cpu_count': 1}}])
+
+  def test_from_rollup(self):
+    minutes = rollup.rollup_docs([hit('cpu', i, i * 60000, host='a') for i in range(0, 120)],
+                                 'metrics-rollup-1m', '1m')
+    hours = rollup.rollup_docs(minutes, 'metrics-rollup-1h', '1h')
+    hours = sorted(hours, key=lambda doc: doc['_source']['timestamp'])
+    self.assertEqual([doc['_source'] for doc in hours], [
+      {'host': 'a', 'timestamp': 0, 'cpu': 29.5, 'cpu_min': 0.0, 'cpu_max': 59.0, 'cpu_sum': 1770.0, 'cpu_count': 60},
+      {'host': 'a', 'timestamp': 3600000, 'cpu': 89.5, 'cpu_min': 60.0, 'cpu_max': 119.0, 'cpu_sum': 5370.0, 'cpu_count': 60}])
+
+  def test_pre_aggregated(self):
+    aggregated = {'_type': 'cpu', '_source': {'host': 'a', 'timestamp': 0, 'cpu': 2.0, 'cpu_min': 1.0,
+                  'cpu_max': 3.0, 'cpu_sum': 6.0, 'cpu_count': 3, 'cpu_last': 2.0}}
+    docs = rollup.rollup_docs([aggregated, hit('cpu', 6, 10000, host='a')], 'metrics-rollup-1m', '1m')
+    self.assertEqual([doc['_source'] for doc in docs], [
+      {'host': 'a', 'timestamp': 0, 'cpu': 3.0, 'cpu_min': 1.0, 'cpu_max': 6.0, 'cpu_sum': 12.0, 'cpu_count': 4}])
+
+class TestRollup(unittest.TestCase):
+
+  def setUp(self):
+    self.es = MockDocumentsElasticsearch()
+    self.add(0, 2 * 3600)
+
+  def add(self, start, end):
+    """Indexes a point every 10 seconds for hosts a and b, from `start` to
+    `end` (seconds, excluded)"""
+    for timestamp in range(start, end, 10):
+      for host in ('a', 'b'):
+        self.es.index('test-metrics', 'cpu', {'cpu': float(timestamp % 600), 'timestamp': timestamp * 1000,
+                                              'host': host})
+
+  def rollups(self, resolution):
+    return self.es.documents.get(rollup.rollup_index_name('test-metrics', resolution), {})
+
+  def checkpoints(self):
+    return dict((resolution, source['timestamp']) for resolution, (doc_type, source)
+                in self.es.documents['rollup-checkpoints-test-metrics'].items())
+
+  def test_run(self):
+    runner = rollup.Rollup(self.es, 'test-metrics', delay=60)
+    # The buckets ending more than 60s ago: up to 1:30
+    self.assertEqual(runner.run(now=5460), 2 * 90 + 2)
+    self.assertEqual(self.checkpoints(), {'1m': 5400000, '1h': 3600000})
+    self.assertEqual(len(self.rollups('1m')), 2 * 90)
+    self.assertEqual(sorted((source['host'], source['cpu_count'], source['cpu_sum'])
+                            for doc_type, source in self.rollups('1h').values()),
+                     [('a', 360, 106200.0), ('b', 360, 106200.0)])
+    self.assertEqual(len(self.es.documents['test-metrics']), 2 * 720)
+
+  def test_incremental(self):
+    runner = rollup.Rollup(self.es, 'test-metrics', delay=60)
+    runner.run(now=5460)
+    scanned = []
+    search = self.es.search
+    def recording_search(index, body=None, **kwargs):
+      scanned.append((index, body['query']['range']['timestamp']) if 'query' in body else (index, None))
+      return search(index, body, **kwargs)
+    self.es.search = recording_search
+
+    self.add(2 * 3600, 3 * 3600)
+    self.assertEqual(runner.run(now=3 * 3600 + 60), 2 * 90 + 2 * 2)
+    # Only the new windows are read
+    self.assertEqual(scanned[0], ('test-metrics', {'gte': 5400000, 'lt': 9000000}))
+    self.assertEqual(scanned[1], ('test-metrics', {'gte': 9000000, 'lt': 10800000}))
+    self.assertEqual(self.checkpoints(), {'1m': 10800000, '1h': 10800000})
+    self.assertEqual(len(self.rollups('1m')), 2 * 180)
+    self.assertEqual(len(self.rollups('1h')), 2 * 3)
+    self.assertEqual(runner.run(now=3 * 3600 + 60), 0)
+
+  def test_rerun_without_checkpoint(self):
+    runner = rollup.Rollup(self.es, 'test-metrics', delay=60)
+    runner.run(now=5460)
+    rollups = dict(self.rollups('1m'))
+    # A run stopped before writing its checkpoint: the windows are rolled up again
+    del self.es.documents['rollup-checkpoints-test-metrics']
+    self.assertEqual(runner.run(now=5460), 2 * 90 + 2)
+    self.assertEqual(self.rollups('1m'), rollups)
+    self.assertEqual(len(self.rollups('1h')), 2)
+
+  def test_delete_raw(self):
+    runner = rollup.Rollup(self.es, 'test-metrics', delete_raw=True, delay=60)
+    runner.run(now=5460)
+    timestamps = [source['timestamp'] for doc_type, source in self.es.documents['test-metrics'].values()]
+    self.assertEqual(len(timestamps), 2 * 180)
+    self.assertTrue(min(timestamps) >= 5400000)
+    # The rollups are kept
+    self.assertEqual(len(self.rollups('1m')), 2 * 90)
+
+if __name__ == "__main__":
+  unittest.main(verbosity=2)
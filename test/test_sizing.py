@@ -0,0 +1,93 @@
+import unittest
+from elasticsearch import Elasticsearch
+from es_injectors import elasticsearch_injector as es
+from es_injectors.sizing import AdaptiveChunkSize
+from test.mocks import MockElasticsearch
+from test.elasticsearch_server import ElasticsearchServer
+
+class TestAdaptiveChunkSize(unittest.TestCase):
+
+  def test_converges(self):
+    # 10ms per request and 0.1ms per document: 990 documents in 0.1s
+    sizer = AdaptiveChunkSize(target_latency=0.1, initial=100, maximum=100000)
+    sizes = []
+    for i in range(0, 100):
+      sizer.observe(0.01 + 0.0001 * sizer.chunk_size, sizer.chunk_size)
+      sizes.append(sizer.chunk_size)
+    # Grows by 25% at most at once
+    self.assertEqual(sizes[:3], [125, 156, 195])
+    self.assertTrue(800 <= sizer.chunk_size <= 1200)
+
+    # The cluster slows down
+    for i in range(0, 100):
+      sizer.observe(0.01 + 0.001 * sizer.chunk_size, sizer.chunk_size)
+    self.assertTrue(80 <= sizer.chunk_size <= 120)
+
+  def test_backoff(self):
+    sizer = AdaptiveChunkSize(target_latency=1, initial=1000, minimum=100)
+    sizer.observe(0.1, 1000, nb_rejected=1)
+    self.assertEqual((sizer.chunk_size, sizer.nb_backoffs), (500, 1))
+    for i in range(0, 5):
+      sizer.observe(0.1, 10, nb_rejected=10)
+    self.assertEqual(sizer.chunk_size, 100)
+
+  def test_small_requests(self):
+    sizer = AdaptiveChunkSize(target_latency=1, initial=1000)
+    # Mostly the overhead of a request: not representative
+    sizer.observe(0.5, 10)
+    self.assertEqual(sizer.chunk_size, 1000)
+    sizer.observe(0.1, 1000)
+    self.assertEqual(sizer.chunk_size, 1250)
+
+class TestSenderSizing(unittest.TestCase):
+
+  def test_chunk_bytes(self):
+    self.assertEqual(es.chunk_bounds(['a' * 10] * 5, 2), [(0, 2), (2, 4), (4, 5)])
+    self.assertEqual(es.chunk_bounds(['a' * 10] * 5, 10, 25), [(0, 2), (2, 4), (4, 5)])
+    self.assertEqual(es.chunk_bounds(['a' * 30, 'a', 'a'], 10, 25), [(0, 1), (1, 3)])
+
+    mock_es = MockElasticsearch()
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                    chunk_bytes = 4096)
+    sender.push(['put metric1 ' + str(i) + ' 1454962560 host=machine1 tag=' + 'x' * (i % 100) for i in range(0, 500)])
+    sender.flush()
+    self.assertEqual(len(mock_es.docs), 500)
+    self.assertTrue(len(mock_es.bodies) > 10)
+    self.assertTrue(all(len(body) <= 4096 for body in mock_es.bodies))
+
+  def test_buffer_bytes(self):
+    mock_es = MockElasticsearch()
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                    buffer_bytes = 20000)
+    sender.push(['put metric1 1 ' + str(1454962560 + i) + ' host=machine1' for i in range(0, 10)])
+    sender.flush()
+    self.assertTrue(100 < sender.doc_bytes < 130)
+    # Handed over once about 20000 bytes of documents are buffered
+    for i in range(0, 1000):
+      sender.push(['put metric1 1 ' + str(1454962560 + i) + ' host=machine1'])
+      if sender.pending:
+        break
+    self.assertTrue(150 < i < 200)
+
+  def test_adapts_to_cluster(self):
+    server = ElasticsearchServer(latency=0.005, doc_latency=0.0001)
+    server.start()
+    self.addCleanup(server.stop)
+    sizer = AdaptiveChunkSize(target_latency=0.1, initial=50)
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), Elasticsearch([server.url]), 'metrics',
+                                    background_flush = False, sizer = sizer)
+    lines = ['put metric1 ' + str(i) + ' 1454962560 host=machine1' for i in range(0, 1000)]
+    for i in range(0, 5):
+      sender.push(lines)
+    sender.flush()
+    self.assertEqual(server.count('metrics'), 5000)
+    # Grown until requests take about 100ms
+    self.assertTrue(sizer.chunk_size > 100)
+    self.assertTrue(0.07 < sizer.latency < 0.13)
+    self.assertEqual(sender.stats.snapshot()['chunk_size'], sizer.chunk_size)
+
+    server.reject_ratio = 1
+    sender.push(lines)
+    sender.flush()
+    self.assertTrue(sizer.nb_backoffs > 0)
+    self.assertEqual(sizer.chunk_size, sizer.minimum)
@@ -0,0 +1,182 @@
+import unittest, tempfile, shutil, os, time
+from es_injectors.spool import Spool
+from es_injectors import elasticsearch_injector as es
+from test.mocks import MockElasticsearch
+
+class TestSpool(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_append_read_ack(self):
+    spool = Spool(self.directory, segment_size=20)
+    self.assertTrue(spool.empty())
+    position = spool.append([b'one', b'two'])
+    spool.append([b'three'])
+    self.assertEqual([payload for payload, position in spool.read(10)], [b'one', b'two', b'three'])
+
+    spool.ack(position)
+    self.assertEqual([payload for payload, position in spool.read(10)], [b'three'])
+    spool.ack(spool.read(10)[-1][1])
+    self.assertTrue(spool.empty())
+    spool.close()
+
+  def test_restart(self):
+    spool = Spool(self.directory, segment_size=20)
+    position = spool.append([b'one'])
+    spool.append([b'two'])
+    spool.ack(position)
+    spool.close()
+
+    spool = Spool(self.directory, segment_size=20)
+    self.assertFalse(spool.empty())
+    self.assertEqual([payload for payload, position in spool.read(10)], [b'two'])
+    spool.ack(spool.read(10)[-1][1])
+    self.assertTrue(spool.empty())
+    spool.close()
+
+  def test_segments_deleted(self):
+    spool = Spool(self.directory, segment_size=10)
+    position = spool.append([b'0123456789', b'0123456789', b'0123456789'])
+    self.assertEqual(len(os.listdir(self.directory)), 3)
+    spool.ack(position)
+    self.assertEqual(sorted(os.listdir(self.directory)), ['0000000000000002.spool', 'head'])
+    spool.close()
+
+  def test_max_size(self):
+    spool = Spool(self.directory, segment_size=10, max_size=40)
+    spool.append([b'first-----', b'second----', b'third-----'])
+    self.assertEqual(spool.nb_dropped, 1)
+    self.assertEqual([payload for payload, position in spool.read(10)], [b'second----', b'third-----'])
+    spool.close()
+
+  def test_corrupted_record(self):
+    spool = Spool(self.directory)
+    spool.append([b'one'])
+    spool.close()
+    path = os.path.join(self.directory, '0000000000000000.spool')
+    with open(path, 'r+b') as segment_file:
+      segment_file.seek(8)
+      segment_file.write(b'ONE')
+
+    spool = Spool(self.directory)
+    self.assertEqual(spool.read(10), [])
+    self.assertTrue(spool.empty())
+    spool.close()
+
+class TestSenderSpool(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_outage(self):
+    mock_es = MockElasticsearch()
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                         spool = Spool(self.directory), chunk_size = 2)
+    mock_es.unavailable = True
+    es_injector.push(['put metric1 ' + str(i) + ' 1454962560' for i in range(0, 3)])
+    es_injector.flush()
+    self.assertTrue(es_injector.backlogged)
+    es_injector.push(['put metric1 ' + str(i) + ' 1454962560' for i in range(3, 5)])
+    es_injector.flush()
+    self.assertEqual(mock_es.docs, [])
+
+    mock_es.unavailable = False
+    es_injector.flush()
+    self.assertFalse(es_injector.backlogged)
+    self.assertEqual([doc['metric1'] for doc in mock_es.docs], [float(i) for i in range(0, 5)])
+    self.assertTrue(es_injector.spool.empty())
+
+    es_injector.push(['put metric1 5 1454962560'])
+    es_injector.flush()
+    self.assertEqual(len(mock_es.docs), 6)
+    es_injector.close()
+
+  def test_replay_after_restart(self):
+    spool = Spool(self.directory)
+    spool.append([b'{"index":{"_index":"bogus_index","_type":"metric1"}}\n{"metric1":1.0}\n'])
+    spool.close()
+
+    mock_es = MockElasticsearch()
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                         spool = Spool(self.directory))
+    self.assertTrue(es_injector.backlogged)
+    es_injector.flush()
+    self.assertEqual(mock_es.docs, [{'metric1': 1.0}])
+    es_injector.close()
+
+  def test_replay_rate(self):
+    spool = Spool(self.directory)
+    spool.append([b'{"index":{"_index":"bogus_index","_type":"metric1"}}\n{"metric1":' + str(i).encode('utf-8') + b'}\n'
+                  for i in range(0, 20)])
+    spool.close()
+
+    mock_es = MockElasticsearch()
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                         spool = Spool(self.directory), replay_rate = 5)
+    # Called after every batch: still 5 documents per second
+    for i in range(0, 10):
+      es_injector.replay()
+    self.assertEqual(len(mock_es.docs), 5)
+    time.sleep(0.5)
+    es_injector.replay()
+    self.assertTrue(7 <= len(mock_es.docs) <= 8)
+    self.assertTrue(es_injector.backlogged)
+    es_injector.close()
+
+  def test_live_during_replay(self):
+    spool = Spool(self.directory)
+    spool.append([b'{"index":{"_index":"bogus_index","_type":"metric1"}}\n{"metric1":' + str(i).encode('utf-8') + b'}\n'
+                  for i in range(0, 20)])
+    spool.close()
+
+    mock_es = MockElasticsearch()
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                         spool = Spool(self.directory), replay_rate = 5)
+    self.assertTrue(es_injector.backlogged)
+    # The new batches are not held back by the replay
+    es_injector.push(['put metric2 ' + str(i) + ' 1454962560' for i in range(0, 10)])
+    es_injector.flush()
+    self.assertEqual([doc['metric2'] for doc in mock_es.docs if 'metric2' in doc], [float(i) for i in range(0, 10)])
+    self.assertEqual(len([doc for doc in mock_es.docs if 'metric1' in doc]), 5)
+    self.assertTrue(es_injector.backlogged)
+
+    # They are not sent again by the replay either
+    es_injector.replay_rate = es_injector.replay_tokens = 100
+    es_injector.replay()
+    self.assertFalse(es_injector.backlogged)
+    self.assertTrue(es_injector.spool.empty())
+    self.assertEqual(len([doc for doc in mock_es.docs if 'metric1' in doc]), 20)
+    self.assertEqual(len([doc for doc in mock_es.docs if 'metric2' in doc]), 10)
+    es_injector.close()
+
+  def test_partly_delivered(self):
+    mock_es = MockElasticsearch()
+    bulk = mock_es.bulk
+    def failing_bulk(body, *args, **kwargs):
+      # Only the second request fails
+      mock_es.unavailable = len(mock_es.bodies) == 1
+      return bulk(body, *args, **kwargs)
+    mock_es.bulk = failing_bulk
+    es_injector = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False,
+                                         spool = Spool(self.directory), chunk_size = 2)
+    es_injector.push(['put metric1 ' + str(i) + ' 1454962560' for i in range(0, 4)])
+    es_injector.flush()
+    self.assertTrue(es_injector.backlogged)
+    self.assertEqual(len(mock_es.docs), 2)
+
+    mock_es.bulk = bulk
+    mock_es.unavailable = False
+    es_injector.flush()
+    self.assertFalse(es_injector.backlogged)
+    self.assertEqual(sorted(doc['metric1'] for doc in mock_es.docs), [float(i) for i in range(0, 4)])
+    es_injector.close()
+
+if __name__ == "__main__":
+  unittest.main(verbosity=2)
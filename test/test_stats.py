@@ -0,0 +1,74 @@
+import unittest, socket
+from es_injectors import stats
+from es_injectors import elasticsearch_injector as es
+from test.mocks import MockElasticsearch
+try:
+  from urllib.request import urlopen
+except ImportError:
+  from urllib2 import urlopen
+
+class TestHistogram(unittest.TestCase):
+
+  def test_percentiles(self):
+    histogram = stats.Histogram([1, 10, 100])
+    for value in range(1, 101):
+      histogram.add(value)
+    self.assertEqual(histogram.count, 100)
+    self.assertEqual(histogram.max, 100)
+    self.assertEqual(histogram.percentile(0.05), 10)
+    self.assertEqual(histogram.percentile(0.5), 100)
+    histogram.add(1000)
+    self.assertEqual(histogram.percentile(1), 1000)
+
+class TestStats(unittest.TestCase):
+
+  def test_sender_stats(self):
+    mock_es = MockElasticsearch()
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), mock_es, 'bogus_index', background_flush = False)
+    sender.push(['put metric1 1 1454962560', 'put metric1 x 1454962560', 'one'])
+    self.assertEqual(sender.stats.snapshot()['buffer_docs'], 1)
+    sender.flush()
+
+    snapshot = sender.stats.snapshot()
+    self.assertEqual(snapshot['docs_accepted'], 1)
+    self.assertEqual(snapshot['docs_indexed'], 1)
+    self.assertEqual(snapshot['parse_errors'], {'invalid_value': 1, 'invalid_put_line': 1})
+    self.assertEqual(snapshot['flush_docs']['count'], 1)
+    self.assertEqual(snapshot['buffer_docs'], 0)
+
+    lines = sender.stats.lines(timestamp=1454962560)
+    self.assertIn('es_injector.docs_indexed 1454962560 1', lines)
+    self.assertIn('es_injector.parse_errors 1454962560 1 reason=invalid_value', lines)
+
+    # OpenTSDB rejects ':' in tag values
+    sender.stats.add_lines('127.0.0.1:4242', 2)
+    sender.stats.add_lines('udp:8888', 1)
+    lines = sender.stats.lines(timestamp=1454962560)
+    self.assertIn('es_injector.connection.lines_received 1454962560 2 connection=127.0.0.1_4242', lines)
+    self.assertIn('es_injector.connection.lines_received 1454962560 1 connection=udp_8888', lines)
+    # tcollector format: metric timestamp value [tags]
+    for line in lines:
+      elements = line.split(' ')
+      self.assertEqual(elements[1], '1454962560')
+      float(elements[2])
+
+  def test_stats_command(self):
+    sender = es.ElasticsearchSender(es.OpenTsdbParser(), MockElasticsearch(), 'bogus_index', background_flush = False)
+    server_socket, client_socket = socket.socketpair()
+    sender.push(['stats'], socket=server_socket)
+    client_socket.settimeout(1)
+    data = client_socket.recv(65536).decode()
+    self.assertTrue(data.startswith('es_injector.'))
+    self.assertTrue(data.endswith('\n'))
+    self.assertEqual(sender.stats.snapshot()['parse_errors'], {})
+
+  def test_http(self):
+    server = stats.StatsServer('127.0.0.1', 0, stats.Stats())
+    server.start()
+    self.addCleanup(server.stop)
+    url = 'http://127.0.0.1:' + str(server.port)
+    self.assertIn('es_injector.lines_received', urlopen(url + '/stats').read().decode())
+    self.assertIn('"lines_received": 0', urlopen(url + '/stats.json').read().decode())
+
+if __name__ == "__main__":
+  unittest.main(verbosity=2)
@@ -0,0 +1,81 @@
+import unittest, os, signal, socket, tempfile, threading, time
+from es_injectors import workers
+from es_injectors import elasticsearch_injector as es
+from test.mocks import MockInjector
+
+@unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork'), 'SO_REUSEPORT and fork required')
+class TestWorkers(unittest.TestCase):
+
+  def test_reuse_port(self):
+    first = es.AggregatorServer('127.0.0.1', 0, MockInjector(), reuse_port=True)
+    first.start()
+    while first.bound_port is None:
+      time.sleep(0.01)
+    second = es.AggregatorServer('127.0.0.1', first.bound_port, MockInjector(), reuse_port=True)
+    second.start()
+    while second.bound_port is None:
+      time.sleep(0.01)
+
+    for i in range(0, 20):
+      client_socket = socket.create_connection(('127.0.0.1', first.bound_port))
+      client_socket.sendall(b'put metric1 1 1454962560\n')
+      client_socket.close()
+    time.sleep(0.2)
+    for server in (first, second):
+      server.stop()
+      server.join(2)
+      self.assertFalse(server.is_alive())
+      self.assertTrue(server.injector.flushed)
+    self.assertEqual(len(first.injector.lines) + len(second.injector.lines), 20)
+
+  def test_stop_flushes_every_worker(self):
+    directory = tempfile.mkdtemp()
+
+    def target(worker_id):
+      server = es.AggregatorServer('127.0.0.1', 0, MockInjector())
+      signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+      open(os.path.join(directory, 'started-' + str(worker_id)), 'w').close()
+      server.run()
+      if server.injector.flushed:
+        open(os.path.join(directory, 'flushed-' + str(worker_id)), 'w').close()
+
+    main_thread = threading.current_thread().ident
+
+    def stop():
+      # Stops the supervisor once every worker is started. The signal must
+      # interrupt the wait of the main thread
+      while len(os.listdir(directory)) < 3:
+        time.sleep(0.01)
+      signal.pthread_kill(main_thread, signal.SIGTERM)
+
+    supervisor = workers.Workers(3, target)
+    threading.Thread(target=stop).start()
+    previous = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+    try:
+      self.assertEqual(supervisor.run(), 0)
+    finally:
+      signal.signal(signal.SIGTERM, previous[0])
+      signal.signal(signal.SIGINT, previous[1])
+    self.assertEqual(sorted(os.listdir(directory)), ['flushed-0', 'flushed-1', 'flushed-2',
+                                                     'started-0', 'started-1', 'started-2'])
+
+  def test_restart(self):
+    directory = tempfile.mkdtemp()
+
+    def target(worker_id):
+      nb_runs = len(os.listdir(directory))
+      open(os.path.join(directory, str(nb_runs)), 'w').close()
+      if nb_runs >= 1:
+        os.kill(os.getppid(), signal.SIGTERM)
+        time.sleep(1)
+      raise ValueError('Crash')
+
+    workers.RESTART_DELAY = 0
+    previous = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+    try:
+      self.assertEqual(workers.Workers(1, target).run(), 2)
+    finally:
+      signal.signal(signal.SIGTERM, previous[0])
+      signal.signal(signal.SIGINT, previous[1])
+      workers.RESTART_DELAY = 1
+    self.assertEqual(sorted(os.listdir(directory)), ['0', '1'])